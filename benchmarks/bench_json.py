@@ -0,0 +1,48 @@
+"""
+Times each installed JSON codec on the work it does per message: parsing a
+wal2json change. Every codec writes with the standard library, so writing
+is not compared.
+
+    pip install -e . && python benchmarks/bench_json.py --rows 10 --number 20000
+"""
+from __future__ import division, print_function
+import timeit
+
+import click
+
+from pg2kinesis.codec import available_codecs, get_codec
+
+
+def wal2json_transaction(rows):
+    change = {
+        'kind': 'update',
+        'schema': 'public',
+        'table': 'some_table',
+        'columnnames': ['id', 'uuid', 'name', 'price', 'tags', 'note'],
+        'columntypes': ['integer', 'uuid', 'character varying', 'numeric', 'text[]', 'text'],
+        'columnvalues': [42, '00079f3e-0479-4475-acff-4f225cc5188a', 'O\'Brien été / ☃',
+                         1234.5, '{a,b}', 'x' * 200],
+    }
+    return {'xid': 1234567, 'change': [change] * rows}
+
+
+@click.command()
+@click.option('--rows', default=10, help='Row changes in each parsed transaction.')
+@click.option('--number', default=20000, help='Times each operation runs.')
+def main(rows, number):
+    transaction = wal2json_transaction(rows)
+    payload = get_codec('json').dumps_bytes(transaction)
+
+    print('{:<10} {:>14} {:>14}'.format('codec', 'loads us', 'vs json'))
+    reference = None
+    for name in reversed(available_codecs()):
+        codec = get_codec(name)
+        assert codec.loads(payload) == transaction
+
+        loads = timeit.timeit(lambda: codec.loads(payload), number=number) / number * 1e6
+        reference = reference or loads
+        print('{:<10} {:>14.2f} {:>13.2f}x'.format(name, loads, reference / loads))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""
+Offline throughput benchmarks of the hot paths a change goes through: parsing
+it in the formatter, writing the record, aggregating it in the StreamWriter
+and the whole of Consume. Kinesis is replaced by a stub and replication
+messages are fabricated, so no database or AWS account is needed.
+
+Every case reports changes per second and bytes per second, of its input or,
+for the produce cases, of the records written, and changes per second of CPU
+time of this process. The parallel cases show how formatting scales over
+--format-workers processes. Their workers' CPU time is not counted, so on a
+host with a core per worker the CPU rate is what the pipeline can reach,
+whereas on fewer cores the workers take turns with the pipeline and the
+wall clock rate is all there is. Results can be saved and compared with an
+earlier run:
+
+    pip install -e .
+    python benchmarks/bench_pipeline.py --save before.json
+    python benchmarks/bench_pipeline.py --compare before.json
+"""
+from __future__ import division, print_function
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+import datetime
+import json
+import logging
+import platform
+import time
+import timeit
+
+import click
+
+from pg2kinesis import stream
+from pg2kinesis.__main__ import Consume
+from pg2kinesis.codec import get_codec
+from pg2kinesis.formatter import Change, CSVPayloadFormatter, FullChange
+from pg2kinesis.ledger import LsnLedger
+from pg2kinesis.log import logger
+from pg2kinesis.parallel import FormatterFactory, FormatterPool
+from pg2kinesis.slot import PrimaryKeyMapItem
+
+try:
+    process_time = time.process_time
+except AttributeError:
+    process_time = time.clock
+
+TABLE = 'public.bench'
+PKEY_MAP = {TABLE: PrimaryKeyMapItem(TABLE, 'id', 'integer', 1)}
+
+# What SlotReader hands to consume.
+FakeMessage = namedtuple('FakeMessage', 'payload, data_start, data_size, cursor')
+
+
+class FakeCursor(object):
+    def send_feedback(self, **kwargs):
+        pass
+
+
+class StubKinesis(object):
+    """
+    Accepts every record straight away.
+    """
+
+    class Waiter(object):
+        def wait(self, **kwargs):
+            pass
+
+    def create_stream(self, **kwargs):
+        pass
+
+    def get_waiter(self, name):
+        return self.Waiter()
+
+    def list_shards(self, **kwargs):
+        return {'Shards': [{'ShardId': 'shardId-000000000000',
+                            'HashKeyRange': {'StartingHashKey': '0', 'EndingHashKey': str(2 ** 128 - 1)}}]}
+
+    def put_record(self, **kwargs):
+        return {'SequenceNumber': '1', 'ShardId': 'shardId-000000000000'}
+
+    def put_records(self, Records, **kwargs):
+        return {'FailedRecordCount': 0,
+                'Records': [{'SequenceNumber': '1', 'ShardId': 'shardId-000000000000'} for _ in Records]}
+
+
+@contextmanager
+def stub_kinesis():
+    client = stream.boto3.client
+    stream.boto3.client = lambda *args, **kwargs: StubKinesis()
+    try:
+        yield
+    finally:
+        stream.boto3.client = client
+
+
+def columns(width, row):
+    """
+    :return: (name, type, value) of the columns of a row, id first.
+    """
+    cols = [('id', 'integer', row)]
+    for i in range(1, width):
+        if i % 3 == 1:
+            cols.append(('n{}'.format(i), 'bigint', row * i))
+        elif i % 3 == 2:
+            cols.append(('price{}'.format(i), 'numeric', row / 7))
+        else:
+            cols.append(('note{}'.format(i), 'text', "row {} isn't short, column {}".format(row, i)))
+    return cols
+
+
+def test_decoding_payloads(width, txn_size):
+    payloads = ['BEGIN 1234']
+    for row in range(txn_size):
+        payloads.append('table {}: UPDATE: {}'.format(TABLE, ' '.join(
+            "{}[{}]:'{}'".format(name, col_type, str(value).replace("'", "''")) if col_type == 'text'
+            else '{}[{}]:{}'.format(name, col_type, value)
+            for name, col_type, value in columns(width, row))))
+    payloads.append('COMMIT 1234')
+    return payloads
+
+
+def wal2json_row(width, row):
+    cols = columns(width, row)
+    schema, table = TABLE.split('.')
+    return {'kind': 'update', 'schema': schema, 'table': table,
+            'columnnames': [c[0] for c in cols], 'columntypes': [c[1] for c in cols],
+            'columnvalues': [c[2] for c in cols]}
+
+
+def wal2json_payloads(width, txn_size):
+    codec = get_codec('json')
+    return [codec.dumps_bytes({'xid': 1234, 'change': [wal2json_row(width, row) for row in range(txn_size)]})]
+
+
+def wal2json_v2_payloads(width, txn_size):
+    codec = get_codec('json')
+    payloads = [b'{"action":"B","xid":1234}']
+    for row in range(txn_size):
+        change = wal2json_row(width, row)
+        payloads.append(codec.dumps_bytes({
+            'action': 'U', 'schema': change['schema'], 'table': change['table'],
+            'columns': [{'name': n, 'type': t, 'value': v}
+                        for n, t, v in zip(change['columnnames'], change['columntypes'], change['columnvalues'])]}))
+    payloads.append(b'{"action":"C","xid":1234}')
+    return payloads
+
+
+def payload_bytes(payloads):
+    return sum(len(p) for p in payloads)
+
+
+def consume_all(consume, fake_messages):
+    for m in fake_messages:
+        consume(m)
+    if consume.format_pool is not None:
+        consume._publish_formatted(keep=0)
+
+
+def cases(widths, txn_sizes, batch_size, format_workers=()):
+    """
+    Yields the name of each case, the function it times, the changes each
+    call handles and the bytes each call reads or writes.
+    """
+    for width in widths:
+        for txn_size in txn_sizes:
+            suffix = 'w{}/t{}'.format(width, txn_size)
+
+            for plugin, make_payloads, options in (
+                    ('test_decoding', test_decoding_payloads, {}),
+                    ('wal2json', wal2json_payloads, {}),
+                    ('wal2json-v2', wal2json_v2_payloads, {'wal2json_format_version': 2})):
+                payloads = make_payloads(width, txn_size)
+                for full_change in (False, True):
+                    formatter = CSVPayloadFormatter(PKEY_MAP, plugin.split('-')[0], full_change, **options)
+                    yield ('format/{}{}/{}'.format(plugin, '/full' if full_change else '', suffix),
+                           lambda formatter=formatter, payloads=payloads: [formatter(p) for p in payloads],
+                           txn_size, payload_bytes(payloads))
+
+        formatter = CSVPayloadFormatter(PKEY_MAP)
+        changes = [FullChange(xid=1234, change=wal2json_row(width, row)) for row in range(100)]
+        messages = [formatter.produce_formatted_message(c) for c in changes]
+        yield ('produce/CSVPayload/full/w{}'.format(width),
+               lambda formatter=formatter, changes=changes: [formatter.produce_formatted_message(c) for c in changes],
+               len(changes), sum(len(m.fmt_msg) for m in messages))
+
+        with stub_kinesis():
+            writer = stream.StreamWriter('bench', batch_size=batch_size, ledger=LsnLedger())
+        yield ('put_message/full/w{}/b{}'.format(width, batch_size),
+               lambda writer=writer, messages=messages: [writer.put_message(m) for m in messages],
+               len(messages), sum(len(m.fmt_msg) for m in messages))
+
+        for txn_size in txn_sizes:
+            payloads = test_decoding_payloads(width, txn_size)
+            ledger = LsnLedger()
+            with stub_kinesis():
+                writer = stream.StreamWriter('bench', batch_size=batch_size, ledger=ledger)
+            consume = Consume(CSVPayloadFormatter(PKEY_MAP), writer, ledger)
+            cursor = FakeCursor()
+            fake_messages = [FakeMessage(p, lsn, len(p), cursor) for lsn, p in enumerate(payloads, 1)]
+            yield ('consume/test_decoding/w{}/t{}/b{}'.format(width, txn_size, batch_size),
+                   lambda consume=consume, fake_messages=fake_messages: [consume(m) for m in fake_messages],
+                   txn_size, payload_bytes(payloads))
+
+            # Many transactions, many batches of them, so there is something to spread over the workers.
+            payloads = wal2json_payloads(width, txn_size) * max(32, 4096 // txn_size)
+            fake_messages = [FakeMessage(p, lsn, len(p), cursor) for lsn, p in enumerate(payloads, 1)]
+            for workers in format_workers:
+                pool = None
+                if workers:
+                    pool = FormatterPool(FormatterFactory('CSVPayload', 'wal2json', True, None,
+                                                          primary_key_map=PKEY_MAP), workers)
+                ledger = LsnLedger()
+                with stub_kinesis():
+                    writer = stream.StreamWriter('bench', batch_size=batch_size, ledger=ledger)
+                consume = Consume(CSVPayloadFormatter(PKEY_MAP, 'wal2json', True), writer, ledger, format_pool=pool)
+                yield ('consume/wal2json/full/w{}/t{}/b{}/p{}'.format(width, txn_size, batch_size, workers),
+                       lambda consume=consume, fake_messages=fake_messages: consume_all(consume, fake_messages),
+                       txn_size * len(payloads), payload_bytes(payloads))
+                if pool is not None:
+                    pool.terminate()
+
+    formatter = CSVPayloadFormatter(PKEY_MAP)
+    changes = [Change(xid=1234, table=TABLE, operation='UPDATE', pkey=str(row)) for row in range(100)]
+    yield ('produce/CSVPayload/pkey', lambda: [formatter.produce_formatted_message(c) for c in changes],
+           len(changes), sum(len(formatter.produce_formatted_message(c).fmt_msg) for c in changes))
+
+
+def measure(func, changes, nbytes, duration):
+    """
+    Calls func until duration seconds have been spent in it.
+
+    :return: changes per second and bytes per second, and changes per second
+        of CPU time of this process.
+    """
+    calls = 0
+    elapsed = 0
+    cpu = 0
+    while elapsed < duration:
+        started, cpu_started = timeit.default_timer(), process_time()
+        func()
+        elapsed += timeit.default_timer() - started
+        cpu += process_time() - cpu_started
+        calls += 1
+    return changes * calls / elapsed, nbytes * calls / elapsed, changes * calls / cpu
+
+
+@click.command()
+@click.option('--widths', default='4,16,64', help='Comma separated column counts of the rows.')
+@click.option('--txn-sizes', default='1,100', help='Comma separated rows per transaction.')
+@click.option('--batch-size', default=1, help='StreamWriter batch size.')
+@click.option('--format-workers', default='0,1,2,4',
+              help='Comma separated worker process counts of the parallel cases, 0 formats in line.')
+@click.option('--duration', default=1.0, help='Seconds spent on each case.')
+@click.option('--filter', 'name_filter', default='', help='Only run cases whose name contains this.')
+@click.option('--save', type=click.Path(), help='Write the results as JSON to this file.')
+@click.option('--compare', type=click.Path(exists=True), help='Results of an earlier run to compare with.')
+def main(widths, txn_sizes, batch_size, format_workers, duration, name_filter, save, compare):
+    logger.setLevel(logging.WARNING)
+    baseline = json.load(open(compare))['results'] if compare else {}
+
+    results = OrderedDict()
+    print('{:<48} {:>14} {:>12} {:>14} {:>9}'.format('case', 'changes/s', 'MB/s', 'CPU changes/s', 'change'))
+    for name, func, changes, nbytes in cases([int(w) for w in widths.split(',')],
+                                             [int(t) for t in txn_sizes.split(',')], batch_size,
+                                             [int(p) for p in format_workers.split(',')]):
+        if name_filter not in name:
+            continue
+        func()  # warm up
+        per_sec, bytes_per_sec, per_cpu_sec = measure(func, changes, nbytes, duration)
+        results[name] = {'changes_per_sec': per_sec, 'bytes_per_sec': bytes_per_sec,
+                         'changes_per_cpu_sec': per_cpu_sec}
+
+        before = baseline.get(name, {}).get('changes_per_sec')
+        delta = '{:+.1f}%'.format((per_sec / before - 1) * 100) if before else ''
+        print('{:<48} {:>14,.0f} {:>12.2f} {:>14,.0f} {:>9}'.format(name, per_sec, bytes_per_sec / 1048576,
+                                                                   per_cpu_sec, delta))
+
+    if save:
+        with open(save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'run_at': datetime.datetime.utcnow().isoformat(),
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,26 @@
 from __future__ import division
+import json
+import threading
 import time
 
+import boto3
+import botocore.config
 import click
 
 from .slot import SlotReader
+from .tables import parse_tables
 from .formatter import get_formatter
-from .stream import StreamWriter
+from .codec import CODECS
+from .compress import COMPRESSORS, get_compressor
+from .stream import StreamWriter, PARTITION_STRATEGIES
+from .pipeline import SenderPool
+from .parallel import FormatterFactory, FormatterPool
+from .ledger import LsnLedger
+from .controller import BatchController
+from .snapshot import Backfill
+from .spool import FSYNC_POLICIES, Spool, SpoolDrainer, SpoolWriter
+from .ratelimit import ShardRateLimiter, SHARD_BYTES_PER_SEC, SHARD_RECORDS_PER_SEC
+from . import metrics
 from .log import logger
 
 @click.command()
@@ -18,51 +33,387 @@ from .log import logger
 @click.option('--pg-slot-name', '-s', default='pg2kinesis',
               help='Postgres replication slot name.')
 @click.option('--pg-slot-output-plugin', default='test_decoding',
-              type=click.Choice(['test_decoding', 'wal2json']),
+              type=click.Choice(['test_decoding', 'wal2json', 'pgoutput']),
               help='Postgres replication slot output plugin')
+@click.option('--pg-publication', default='pg2kinesis',
+              help='Comma separated publications the pgoutput plugin streams the tables of.')
+@click.option('--wal2json-format-version', default=1, type=click.IntRange(1, 2),
+              help='wal2json output format. 2 sends every row change as a message of its own.')
+@click.option('--wal2json-write-in-chunks', default=False, is_flag=True,
+              help='Have wal2json format 1 send a transaction a row at a time.')
 @click.option('--stream-name', '-k', default='pg2kinesis',
               help='Kinesis stream name.')
 @click.option('--message-formatter', '-f', default='CSVPayload',
-              type=click.Choice(['CSVPayload', 'CSV']),
+              type=click.Choice(['CSVPayload', 'CSV', 'MsgPack', 'Protobuf', 'Avro']),
               help='Kinesis record formatter.')
+@click.option('--json-codec', default=None, type=click.Choice(list(CODECS)),
+              help='JSON library to parse changes with, the standard library writes them. Defaults to the fastest '
+                   'one installed.')
+@click.option('--compression', default='none', type=click.Choice(['none'] + list(COMPRESSORS)),
+              help='Compress every record sent to Kinesis that gets smaller for it, behind a 2 byte header.')
+@click.option('--compression-level', default=None, type=int,
+              help='Compression level, the codec\'s default if not given.')
 @click.option('--table-pat', help='Optional regular expression for table names.')
+@click.option('--tables', help='Comma separated schema.table names to replicate, * matches any schema or table. '
+                               'wal2json and pgoutput leave the changes of other tables on the server.')
+@click.option('--exclude-tables', help='Comma separated schema.table names not to replicate, like --tables.')
 @click.option('--full-change', default=False, is_flag=True,
               help='Emit all columns of a changed row.')
+@click.option('--transaction-envelopes', default=False, is_flag=True,
+              help='Publish each transaction as one record holding all of its changes, split only when it '
+                   'would not fit in a Kinesis record.')
 @click.option('--create-slot', default=False, is_flag=True,
               help='Attempt to on start create a the slot.')
 @click.option('--recreate-slot', default=False, is_flag=True,
               help='Deletes the slot on start if it exists and then creates.')
-def main(pg_dbname, pg_host, pg_port, pg_user, pg_sslmode, pg_slot_name, pg_slot_output_plugin,
-         stream_name, message_formatter, table_pat, full_change, create_slot, recreate_slot):
+@click.option('--snapshot', default=False, is_flag=True,
+              help='Create the slot and first publish every row as of its start point. The slot must not exist, '
+                   'see --recreate-slot.')
+@click.option('--snapshot-workers', default=4, type=click.IntRange(1, None),
+              help='Connections copying the snapshot in parallel.')
+@click.option('--snapshot-chunk-rows', default=100000, type=click.IntRange(1, None),
+              help='Rows per chunk the snapshot of a table is copied in.')
+@click.option('--batch-size', default=1, type=click.IntRange(1, 500),
+              help='Aggregated records sent per PutRecords call. 1 sends each with PutRecord.')
+@click.option('--format-workers', default=0, type=click.IntRange(0, None),
+              help='Processes formatting changes in parallel, results are still published in LSN order. '
+                   'Only for wal2json format 1 without --wal2json-write-in-chunks. 0 formats in line.')
+@click.option('--sender-threads', default=0, type=click.IntRange(0, None),
+              help='Send from this many background threads, in parallel across shards and in order within one. '
+                   '0 publishes inline with reading.')
+@click.option('--send-queue-bytes', default=64 * 1024 * 1024, type=click.IntRange(1, None),
+              help='Bytes of changes that may wait for the sender threads before reading blocks.')
+@click.option('--send-window', default=13, type=click.IntRange(1, None),
+              help='Seconds a partially filled aggregate may wait before it is sent.')
+@click.option('--engine', default='blocking', type=click.Choice(['blocking', 'asyncio']),
+              help='asyncio reads the slot on an event loop while sends run concurrently. Python 3.5+.')
+@click.option('--max-in-flight', default=4, type=click.IntRange(1, None),
+              help='Sends the asyncio engine runs at once before reading waits.')
+@click.option('--spool-dir', type=click.Path(file_okay=False),
+              help='Spool changes to this directory and acknowledge them once they are on disk, '
+                   'a background thread ships the spool to Kinesis.')
+@click.option('--spool-max-bytes', default=1024 ** 3, type=click.IntRange(1, None),
+              help='Disk space the spool may take before reading the slot waits for it to drain.')
+@click.option('--spool-segment-bytes', default=64 * 1024 ** 2, type=click.IntRange(1, None),
+              help='Size of the spool segment files.')
+@click.option('--spool-fsync', default='interval', type=click.Choice(FSYNC_POLICIES),
+              help='fsync the spool after every record, every --spool-fsync-interval seconds or never.')
+@click.option('--spool-fsync-interval', default=1.0, type=click.FloatRange(0, None),
+              help='Seconds between fsyncs of the spool.')
+@click.option('--keepalive-interval', default=10, type=click.IntRange(1, None),
+              help='Seconds between status updates to Postgres when there is nothing new to acknowledge.')
+@click.option('--partition-by', default=None, type=click.Choice(PARTITION_STRATEGIES),
+              help='What each record is partitioned on, aggregating per shard, which needs kinesis:ListShards. '
+                   'By default an aggregate is keyed on the xid of its first record.')
+@click.option('--shard-count', default=1, type=click.IntRange(1, None),
+              help='Shards to create the stream with if it does not exist.')
+@click.option('--rate-limit', default=False, is_flag=True,
+              help='Pace writes to each shard instead of backing off when throttled.')
+@click.option('--shard-bytes-per-sec', default=SHARD_BYTES_PER_SEC, type=click.IntRange(1, None),
+              help='Bytes per second the rate limiter allows each shard.')
+@click.option('--shard-records-per-sec', default=SHARD_RECORDS_PER_SEC, type=click.IntRange(1, None),
+              help='Records per second the rate limiter allows each shard.')
+@click.option('--lag-interval', default=10, type=click.IntRange(0, None),
+              help='Seconds between polls of the replication lag of the slot. 0 disables it.')
+@click.option('--lag-warn-bytes', default=1024 ** 3, type=click.IntRange(1, None),
+              help='Log a warning when the slot is this many bytes of WAL behind.')
+@click.option('--catch-up-bytes', default=0, type=click.IntRange(0, None),
+              help='While the slot is this many bytes of WAL behind on start, read it in batches over SQL rather '
+                   'than streaming it. 0 always streams.')
+@click.option('--catch-up-changes', default=10000, type=click.IntRange(1, None),
+              help='Changes per batch when catching up.')
+@click.option('--adaptive', default=False, is_flag=True,
+              help='Tune the send window, aggregate size and, with the asyncio engine, sends in flight to the lag '
+                   'of the slot and throttling. --send-window and --max-in-flight become maximums.')
+@click.option('--adaptive-busy-bytes', default=64 * 1024 ** 2, type=click.IntRange(1, None),
+              help='Lag from which --adaptive batches for throughput rather than latency.')
+@click.option('--metrics-port', default=0, type=click.IntRange(0, 65535),
+              help='Serve Prometheus metrics on this port at /metrics. 0 disables it.')
+@click.option('--statsd-host', help='Push metrics to StatsD on this host.')
+@click.option('--statsd-port', default=8125, type=click.IntRange(1, 65535), help='StatsD port.')
+@click.option('--statsd-prefix', default='pg2kinesis', help='Prefix of the StatsD metric names.')
+@click.option('--config', 'config_file', type=click.File('r'),
+              help='Run every pipeline of this JSON file in one process, see the README. The other options '
+                   'are the defaults of the pipelines.')
+def main(config_file, metrics_port, statsd_host, statsd_port, statsd_prefix, **options):
+    if metrics_port:
+        metrics.PrometheusServer(metrics.REGISTRY, metrics_port).start()
+    if statsd_host:
+        metrics.StatsdReporter(metrics.REGISTRY, statsd_host, statsd_port, statsd_prefix).start()
+
+    if config_file is not None:
+        run_pipelines(json.load(config_file), options, watch_metrics=bool(metrics_port or statsd_host))
+    else:
+        run_pipeline(watch_metrics=bool(metrics_port or statsd_host), **options)
+
+
+def run_pipelines(config, options, retry_limit=60, watch_metrics=False):
+    """
+    Runs a pipeline per entry of config['pipelines'], each replicating on a
+    thread of its own. Their StreamWriters share one Kinesis client and, with
+    rate_limit, one rate limiter. A pipeline that fails is logged and
+    restarted, backing off up to retry_limit seconds, without disturbing the
+    others.
+
+    :param config: {"defaults": {...}, "pipelines": [{"name": ..., ...}, ...]}
+        where the keys are the names of main's options with underscores.
+    :param options: main's options, the defaults under config['defaults'].
+    :param watch_metrics: export the state of every pipeline, labeled with its name.
+    """
+    pipelines = []
+    for pipeline in config['pipelines']:
+        pipeline_options = dict(options)
+        pipeline_options.update(config.get('defaults', {}))
+        pipeline_options.update(pipeline)
+        name = pipeline_options.pop('name', None) or pipeline_options['pg_slot_name']
+        unknown = set(pipeline_options) - set(options)
+        if unknown:
+            raise click.UsageError('Unknown options of pipeline {}: {}'.format(name, ', '.join(sorted(unknown))))
+        pipelines.append((name, pipeline_options))
+
+    kinesis = boto3.client('kinesis', config=botocore.config.Config(max_pool_connections=10 * len(pipelines)))
+    rate_limiter = None
+    if any(pipeline_options['rate_limit'] for _, pipeline_options in pipelines):
+        rate_limiter = ShardRateLimiter(options['shard_bytes_per_sec'], options['shard_records_per_sec'])
+
+    threads = []
+    for name, pipeline_options in pipelines:
+        thread = threading.Thread(target=_supervise, name='pg2kinesis-{}'.format(name),
+                                  args=(name, pipeline_options, kinesis, rate_limiter, retry_limit, watch_metrics))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    # Joined with a timeout so Control-C still gets through.
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(1)
+
+
+def _supervise(name, pipeline_options, kinesis, rate_limiter, retry_limit, watch_metrics=False):
+    back_off = 1
+    while True:
+        started = time.time()
+        try:
+            logger.info('Starting pipeline %s' % name)
+            run_pipeline(kinesis=kinesis,
+                         shared_rate_limiter=rate_limiter if pipeline_options['rate_limit'] else None,
+                         watch_metrics=watch_metrics, pipeline=name, **pipeline_options)
+            return
+        except Exception:
+            if time.time() - started > retry_limit:
+                back_off = 1
+            logger.exception('Pipeline %s failed, restarting it in %ss' % (name, back_off))
+            time.sleep(back_off)
+            back_off = min(back_off * 2, retry_limit)
+
+
+def run_pipeline(pg_dbname, pg_host, pg_port, pg_user, pg_sslmode, pg_slot_name, pg_slot_output_plugin, pg_publication,
+                 wal2json_format_version, wal2json_write_in_chunks, stream_name, message_formatter, json_codec,
+                 compression, compression_level, table_pat, tables, exclude_tables, full_change, transaction_envelopes,
+                 create_slot, recreate_slot, snapshot, snapshot_workers, snapshot_chunk_rows, batch_size,
+                 format_workers, sender_threads, send_queue_bytes, send_window, engine, max_in_flight, spool_dir,
+                 spool_max_bytes, spool_segment_bytes, spool_fsync, spool_fsync_interval, keepalive_interval,
+                 partition_by, shard_count, rate_limit, shard_bytes_per_sec, shard_records_per_sec, lag_interval,
+                 lag_warn_bytes, catch_up_bytes, catch_up_changes, adaptive, adaptive_busy_bytes, kinesis=None,
+                 shared_rate_limiter=None, watch_metrics=False, pipeline=None):
+    """
+    Replicates one slot to one stream until it fails. Its metrics are
+    labeled with pipeline, the slot name by default.
+    """
+    pipeline = pipeline or pg_slot_name
 
     if full_change:
-        assert message_formatter == 'CSVPayload', 'Full changes must be formatted as JSON.'
-        assert pg_slot_output_plugin == 'wal2json', 'Full changes must use wal2json.'
+        assert message_formatter != 'CSV', 'Full changes cannot be formatted as CSV.'
+
+    tables = parse_tables(tables)
+    exclude_tables = parse_tables(exclude_tables)
+    if (tables or exclude_tables) and pg_slot_output_plugin == 'test_decoding':
+        logger.warning('test_decoding cannot filter tables on the server, they are filtered after decoding.')
 
     logger.info('Starting pg2kinesis')
-    logger.info('Getting kinesis stream writer')
-    writer = StreamWriter(stream_name)
 
     with SlotReader(pg_dbname, pg_host, pg_port, pg_user, pg_sslmode, pg_slot_name,
-                    pg_slot_output_plugin) as reader:
+                    pg_slot_output_plugin, wal2json_format_version=wal2json_format_version,
+                    wal2json_write_in_chunks=wal2json_write_in_chunks,
+                    publication_names=pg_publication, tables=tables, exclude_tables=exclude_tables) as reader:
+
+        snapshot_name = _prepare_slot(reader, pg_slot_output_plugin, create_slot, recreate_slot, snapshot)
 
-        if recreate_slot:
-            reader.delete_slot()
-            reader.create_slot()
-        elif create_slot:
-            reader.create_slot()
+        controller = None
+        if adaptive:
+            assert lag_interval, '--adaptive follows the lag of the slot, it needs --lag-interval.'
+            controller = BatchController(send_window, max_in_flight, adaptive_busy_bytes, pipeline=pipeline)
+
+        if lag_interval:
+            reader.start_lag_monitor(lag_interval, lag_warn_bytes, pipeline)
+            if controller is not None:
+                reader.lag_monitor.listeners.append(controller)
 
         pk_map = reader.primary_key_map
         formatter = get_formatter(message_formatter, pk_map,
-                                  pg_slot_output_plugin, full_change, table_pat)
+                                  pg_slot_output_plugin, full_change, table_pat,
+                                  wal2json_format_version=wal2json_format_version,
+                                  wal2json_write_in_chunks=wal2json_write_in_chunks,
+                                  json_codec=json_codec, tables=tables, exclude_tables=exclude_tables,
+                                  transaction_envelopes=transaction_envelopes)
+
+        format_pool = spool = drainer = async_writer = consume = None
+        try:
+            if format_workers:
+                assert formatter.parallel_safe, \
+                    'Only wal2json format 1 without write-in-chunks can be formatted in parallel.'
+                format_pool = FormatterPool(FormatterFactory(message_formatter, pg_slot_output_plugin, full_change,
+                                                             table_pat, db_config=reader.db_config,
+                                                             wal2json_format_version=wal2json_format_version,
+                                                             json_codec=json_codec, tables=tables,
+                                                             exclude_tables=exclude_tables,
+                                                             transaction_envelopes=transaction_envelopes),
+                                            format_workers)
+
+            logger.info('Getting kinesis stream writer')
+            ledger = LsnLedger()
+            if shared_rate_limiter is not None:
+                rate_limiter = shared_rate_limiter.for_stream(stream_name)
+            else:
+                rate_limiter = ShardRateLimiter(shard_bytes_per_sec, shard_records_per_sec) if rate_limit else None
+            compressor = get_compressor(compression, compression_level)
+
+            def make_writer(writer_ledger):
+                return StreamWriter(stream_name, send_window=send_window, batch_size=batch_size, ledger=writer_ledger,
+                                    partition_by=partition_by, primary_key_map=pk_map, shard_count=shard_count,
+                                    rate_limiter=rate_limiter, compressor=compressor, kinesis=kinesis,
+                                    controller=controller)
 
-        consume = Consume(formatter, writer)
+            if snapshot_name is not None:
+                if partition_by in (None, 'xid'):
+                    logger.warning('Every row of the snapshot has xid 0 and goes to one shard, '
+                                   '--partition-by pkey would spread them.')
+                Backfill(reader.db_config, snapshot_name, snapshot_workers, snapshot_chunk_rows).run(
+                    formatter, make_writer(None), format_pool)
 
-        # Blocking. Responds to Control-C.
-        reader.process_replication_stream(consume)
+            if engine == 'asyncio':
+                assert not spool_dir and not sender_threads, \
+                    'The asyncio engine sends concurrently on its own, drop --spool-dir and --sender-threads.'
+
+            if spool_dir:
+                assert not sender_threads, 'The spool is drained by a thread of its own, drop --sender-threads.'
+                spool = Spool(spool_dir, spool_max_bytes, spool_segment_bytes, spool_fsync, spool_fsync_interval)
+                drainer = SpoolDrainer(spool, make_writer).start()
+                writer = SpoolWriter(spool, ledger, drainer)
+            elif engine == 'asyncio':
+                from .aio import AsyncWriter
+                writer = async_writer = AsyncWriter(make_writer(ledger), max_in_flight)
+                if controller is not None:
+                    controller.async_writer = writer
+            else:
+                writer = make_writer(ledger)
+
+            if sender_threads:
+                consume = PipelinedConsume(formatter, writer, ledger, send_queue_bytes, sender_threads,
+                                           keepalive_interval=keepalive_interval, format_pool=format_pool)
+            else:
+                consume = Consume(formatter, writer, ledger, keepalive_interval=keepalive_interval,
+                                  format_pool=format_pool)
+
+            if watch_metrics:
+                watch(consume, rate_limiter, spool, pipeline)
+
+            if catch_up_bytes:
+                # Inline, whatever the engine, as every batch is flushed before the slot is advanced.
+                catch_up = Consume(formatter, writer if spool is not None else make_writer(ledger), ledger,
+                                   keepalive_interval=keepalive_interval, format_pool=format_pool)
+                reader.catch_up(catch_up, catch_up_bytes, catch_up_changes)
+
+            # Blocking. Responds to Control-C.
+            if engine == 'asyncio':
+                from . import aio
+                aio.run(reader, consume, writer)
+            else:
+                reader.process_replication_stream(consume, consume.tick)
+        finally:
+            _shut_down(consume, format_pool, async_writer, drainer, spool)
+
+
+def _prepare_slot(reader, output_plugin, create_slot, recreate_slot, snapshot):
+    """
+    Creates the slot, and for pgoutput its publications, as asked.
+
+    :return: the name of the snapshot exported with the slot, or None.
+    """
+    if recreate_slot:
+        reader.delete_slot()
+
+    # Before the slot: pgoutput looks the publications up as of the WAL it
+    # decodes, so one created after the slot does not exist for it.
+    if (create_slot or recreate_slot or snapshot) and output_plugin == 'pgoutput':
+        reader.create_publication()
+
+    if snapshot:
+        return reader.create_slot(export_snapshot=True)
+    elif create_slot or recreate_slot:
+        reader.create_slot()
+    return None
+
+
+def _shut_down(consume, format_pool, async_writer, drainer, spool):
+    """
+    Stops the threads and processes run_pipeline started, whichever of them
+    it got to, so a pipeline restarted after a failure leaves none behind.
+    What they were still sending was never acknowledged.
+    """
+    stops = []
+    if isinstance(consume, PipelinedConsume):
+        stops.append(consume.pool.terminate)
+    if format_pool is not None:
+        stops.append(format_pool.terminate)
+    if async_writer is not None:
+        stops.append(async_writer.close)
+    if drainer is not None:
+        stops.append(drainer.stop)
+    if spool is not None:
+        stops.append(spool.close)
+
+    for stop in stops:
+        try:
+            stop()
+        except Exception:
+            logger.exception('Unable to shut down cleanly')
+
+
+def watch(consume, rate_limiter=None, spool=None, pipeline='pg2kinesis'):
+    """
+    Points the gauges of pipeline at the state of consume, read each time
+    metrics are collected. The rate limiter is shared by the pipelines of a
+    --config, so its gauge is not labeled.
+    """
+    metrics.PENDING_CHANGES.labels(pipeline=pipeline).set_function(lambda: len(consume.ledger))
+    metrics.FLUSHED_LSN.labels(pipeline=pipeline).set_function(lambda: consume.flushed_lsn)
+    if isinstance(consume, PipelinedConsume):
+        metrics.QUEUE_DEPTH.labels(pipeline=pipeline).set_function(lambda: len(consume.pool.queue))
+        metrics.QUEUE_BYTES.labels(pipeline=pipeline).set_function(lambda: consume.pool.queue.bytes)
+    if rate_limiter is not None:
+        metrics.RATE_LIMITER_WAITED.set_function(lambda: rate_limiter.waited)
+    if spool is not None:
+        metrics.SPOOL_BYTES.labels(pipeline=pipeline).set_function(lambda: spool.bytes)
+        metrics.SPOOL_UNDRAINED_BYTES.labels(pipeline=pipeline).set_function(
+            lambda: spool.write_pos - spool.drained_pos)
 
 class Consume(object):
-    def __init__(self, formatter, writer):
+    """
+    Formats and publishes each change as it is read from the slot.
+
+    With a ledger, feedback acknowledges the highest LSN that, along with
+    everything before it, the writer has delivered. Without one, the LSN of
+    the change being read is acknowledged whenever a put happens.
+
+    tick is meant to be called by the SlotReader while the slot is quiet so
+    partial aggregates still get sent and Postgres still hears from us.
+
+    With a FormatterPool payloads are formatted in its worker processes and
+    published as their turn comes, in the order they were read.
+    """
+    def __init__(self, formatter, writer, ledger=None, keepalive_interval=10, format_pool=None):
         self.cum_msg_count = 0
         self.cum_msg_size = 0
         self.msg_window_size = 0
@@ -71,17 +422,38 @@ class Consume(object):
 
         self.formatter = formatter
         self.writer = writer
+        self.ledger = ledger
+        self.flushed_lsn = 0
+        self.keepalive_interval = keepalive_interval
+        self.last_feedback = 0
+        self.format_pool = format_pool
 
     def __call__(self, change):
-        self.cum_msg_count += 1
-        self.cum_msg_size += change.data_size
+        self._count(change)
 
-        self.msg_window_size += change.data_size
-        self.msg_window_count += 1
+        if self.format_pool is None:
+            self._publish(change, self.formatter(change.payload))
+            return
 
-        fmt_msgs = self.formatter(change.payload)
+        self.format_pool.submit(change, change.payload)
+        self._publish_formatted()
 
-        progress_msg = 'xid: {:12} win_count:{:>10} win_size:{:>10}mb cum_count:{:>10} cum_size:{:>10}mb'
+    def _publish_formatted(self, keep=None):
+        for change, fmt_msgs in self.format_pool.completed(keep):
+            if fmt_msgs:
+                # Only the workers' formatters see the transactions.
+                self.formatter.cur_xact = fmt_msgs[-1].change.xid
+            self._publish(change, fmt_msgs)
+
+    def _publish(self, change, fmt_msgs):
+        if self.ledger is not None:
+            token = self.ledger.track(change.data_start, len(fmt_msgs))
+            for fmt_msg in fmt_msgs:
+                self.writer.put_message(fmt_msg, token)
+                self._log_progress()
+
+            self._send_feedback(change.cursor)
+            return
 
         for fmt_msg in fmt_msgs:
             did_put = self.writer.put_message(fmt_msg)
@@ -89,16 +461,121 @@ class Consume(object):
                 change.cursor.send_feedback(flush_lsn=change.data_start)
                 logger.info('Flushed LSN: {}'.format(change.data_start))
 
-            int_time = int(time.time())
-            if not int_time % 10 and int_time != self.cur_window:
-                logger.info(progress_msg.format(
-                    self.formatter.cur_xact, self.msg_window_count,
-                    self.msg_window_size / 1048576, self.cum_msg_count,
-                    self.cum_msg_size / 1048576))
+            self._log_progress()
+
+    def tick(self, cursor):
+        if self.format_pool is not None:
+            # The slot is quiet, send what was read to the workers.
+            self.format_pool.dispatch()
+            self._publish_formatted()
+        # Sends the partial aggregate if the writer's send window has lapsed.
+        self.writer.put_message(None)
+        self._keepalive(cursor)
+        self._log_progress()
+
+    def flush(self, cursor):
+        """
+        Publishes everything read so far, without waiting for the send
+        window, and acknowledges it.
+        """
+        if self.format_pool is not None:
+            self._publish_formatted(keep=0)
+        self.writer.flush()
+        self._send_feedback(cursor)
+
+    def close(self):
+        if self.format_pool is not None:
+            self._publish_formatted(keep=0)
+            self.format_pool.close()
+
+    def _keepalive(self, cursor):
+        if self.ledger is not None:
+            self._send_feedback(cursor)
+
+            # With nothing in flight everything the server has sent us is
+            # delivered, so we can acknowledge up to its end of WAL. This keeps
+            # restart_lsn moving when the WAL is written by other databases.
+            # Payloads still in the format pool are not in the ledger yet.
+            # wal_end is only available from psycopg2 2.8.
+            wal_end = getattr(cursor, 'wal_end', 0)
+            formatting = len(self.format_pool) if self.format_pool is not None else 0
+            if not len(self.ledger) and not formatting and wal_end > self.flushed_lsn:
+                cursor.send_feedback(flush_lsn=wal_end)
+                logger.debug('Idle, flushed LSN: {}'.format(wal_end))
+                self.flushed_lsn = wal_end
+                self.last_feedback = time.time()
+
+        if time.time() - self.last_feedback > self.keepalive_interval:
+            cursor.send_feedback()
+            self.last_feedback = time.time()
+
+    def _send_feedback(self, cursor):
+        flushed_lsn = self.ledger.flushed_lsn
+        if flushed_lsn > self.flushed_lsn:
+            cursor.send_feedback(flush_lsn=flushed_lsn)
+            logger.info('Flushed LSN: {}'.format(flushed_lsn))
+            self.flushed_lsn = flushed_lsn
+            self.last_feedback = time.time()
+
+    def _count(self, change):
+        metrics.MESSAGES_CONSUMED.inc()
+        metrics.BYTES_CONSUMED.inc(change.data_size)
+
+        self.cum_msg_count += 1
+        self.cum_msg_size += change.data_size
+
+        self.msg_window_size += change.data_size
+        self.msg_window_count += 1
+
+    def _log_progress(self):
+        progress_msg = 'xid: {:12} win_count:{:>10} win_size:{:>10}mb cum_count:{:>10} cum_size:{:>10}mb'
+
+        int_time = int(time.time())
+        if not int_time % 10 and int_time != self.cur_window:
+            logger.info(progress_msg.format(
+                self.formatter.cur_xact, self.msg_window_count,
+                self.msg_window_size / 1048576, self.cum_msg_count,
+                self.cum_msg_size / 1048576))
+
+            self.cur_window = int_time
+            self.msg_window_size = 0
+            self.msg_window_count = 0
+
+
+class PipelinedConsume(Consume):
+    """
+    Formats on the replication thread and hands the result to a SenderPool
+    so throttling on the Kinesis side never stops us reading the slot.
+
+    Feedback is sent from here, the replication thread, since the cursor is
+    not thread safe, and only for LSNs the ledger says were delivered.
+    """
+    def __init__(self, formatter, writer, ledger, max_bytes, senders=1, keepalive_interval=10, format_pool=None):
+        super(PipelinedConsume, self).__init__(formatter, writer, ledger, keepalive_interval, format_pool)
+        self.pool = SenderPool(writer, max_bytes, senders)
+
+    def _publish(self, change, fmt_msgs):
+        token = self.ledger.track(change.data_start, len(fmt_msgs))
+        if fmt_msgs:
+            self.pool.submit(token, fmt_msgs, change.data_size)
+
+        self._send_feedback(change.cursor)
+        self._log_progress()
+
+    def tick(self, cursor):
+        if self.format_pool is not None:
+            # The slot is quiet, send what was read to the workers.
+            self.format_pool.dispatch()
+            self._publish_formatted()
+        # The senders check the send window for us, no need to block here.
+        if not len(self.pool.queue):
+            self.pool.submit(None, [None], 0)
+        self._keepalive(cursor)
+        self._log_progress()
 
-                self.cur_window = int_time
-                self.msg_window_size = 0
-                self.msg_window_count = 0
+    def close(self):
+        super(PipelinedConsume, self).close()
+        self.pool.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,181 @@
+"""
+An asyncio engine for replication, for Python 3.5 and later.
+
+process_replication_stream reads the slot and sends to Kinesis on one
+thread, so a send holds up reading. Here the replication socket is watched by
+an event loop instead: messages are read with read_message as the socket
+becomes readable and go through Consume as before, while the aggregates that
+are ready are sent as tasks, at most max_in_flight at a time and one per
+shard, so each shard still gets its records in order. boto3 has no asyncio
+interface, so the sends themselves run in a thread pool.
+
+Ordering and feedback are those of Consume with a ledger: changes are read,
+formatted and aggregated in LSN order, and only LSNs whose messages are all
+delivered are acknowledged, whichever order the sends complete in.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import time
+
+from .log import logger
+from .pipeline import SendOrder
+
+
+class AsyncWriter(object):
+    """
+    Takes the place of the StreamWriter given to Consume. put_message
+    aggregates on the loop and starts whatever is ready to send as a task.
+    Sends past max_in_flight, or to a shard a send is under way to, wait
+    their turn, see SendOrder, and the engine stops reading the slot until
+    they are under way.
+    """
+
+    def __init__(self, writer, max_in_flight=4):
+        self.writer = writer
+        self.max_in_flight = max_in_flight
+        self.error = None
+        if max_in_flight > 1:
+            writer.load_shards()
+        self._executor = ThreadPoolExecutor(max_in_flight)
+        self._order = SendOrder()
+        self._in_flight = set()
+
+    def __len__(self):
+        """
+        :return: the sends waiting or under way.
+        """
+        return len(self._order) + len(self._in_flight)
+
+    def put_message(self, fmt_msg, token=None):
+        """
+        Must be called on the event loop.
+
+        :return: what is on its way to Kinesis (truthy) or None.
+        """
+        if self.error is not None:
+            raise self.error
+
+        ready = [(records, tokens) for records, tokens in self.writer.collect(fmt_msg, token) if records]
+        for records, tokens in ready:
+            self._order.add(self.writer.shards_of(records), (records, tokens))
+        self._start()
+        return ready or None
+
+    def _start(self):
+        loop = asyncio.get_event_loop()
+        while len(self._in_flight) < self.max_in_flight:
+            taken = self._order.take()
+            if taken is None:
+                break
+            shards, (records, tokens) = taken
+            future = loop.run_in_executor(self._executor, self.writer.send, records, tokens)
+            self._in_flight.add(future)
+            future.add_done_callback(partial(self._sent, shards))
+
+    def _sent(self, shards, future):
+        self._in_flight.discard(future)
+        self._order.done(shards)
+        if not future.cancelled() and future.exception() is not None:
+            if self.error is None:
+                logger.error('Send failed, stopping the engine: %s' % future.exception())
+                self.error = future.exception()
+            return
+        self._start()
+
+    async def room(self):
+        """
+        Waits until no send is waiting for a turn.
+        """
+        while len(self._order) and self.error is None:
+            await asyncio.wait(list(self._in_flight), return_when=asyncio.FIRST_COMPLETED)
+        if self.error is not None:
+            raise self.error
+
+    async def drain(self):
+        """
+        Waits for every send to complete.
+        """
+        while self._in_flight and self.error is None:
+            await asyncio.wait(list(self._in_flight))
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self._executor.shutdown()
+
+
+class ReplicationEngine(object):
+    """
+    Reads the slot of reader into consume, calling consume.tick at least every
+    tick_interval seconds, until stop is called or a send fails.
+    """
+
+    def __init__(self, reader, consume, writer, tick_interval=1, yield_every=64):
+        """
+        :param writer: the AsyncWriter consume publishes to.
+        :param yield_every: messages read in a row before letting completed
+            sends run their callbacks.
+        """
+        self.reader = reader
+        self.consume = consume
+        self.writer = writer
+        self.tick_interval = tick_interval
+        self.yield_every = yield_every
+        self._stopped = False
+
+    def stop(self):
+        """
+        Stops reading. run returns once the sends under way are delivered
+        and acknowledged. Partial aggregates are left to be read again.
+        """
+        self._stopped = True
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        cursor = self.reader.start_replication()
+        readable = asyncio.Event()
+        loop.add_reader(cursor.fileno(), readable.set)
+
+        try:
+            read = 0
+            next_tick = time.time() + self.tick_interval
+            while not self._stopped:
+                await self.writer.room()
+
+                readable.clear()
+                msg = cursor.read_message()
+                if msg:
+                    self.consume(msg)
+                    read += 1
+                    if not read % self.yield_every:
+                        await asyncio.sleep(0)
+                else:
+                    try:
+                        await asyncio.wait_for(readable.wait(), max(0, next_tick - time.time()))
+                    except asyncio.TimeoutError:
+                        pass
+
+                if time.time() >= next_tick:
+                    self.consume.tick(cursor)
+                    next_tick = time.time() + self.tick_interval
+
+            self.consume.close()
+            await self.writer.drain()
+            self.consume.tick(cursor)
+        finally:
+            loop.remove_reader(cursor.fileno())
+
+
+def run(reader, consume, writer, tick_interval=1):
+    """
+    Blocks running a ReplicationEngine on an event loop of its own, so it
+    can be called from any thread.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(ReplicationEngine(reader, consume, writer, tick_interval).run())
+    finally:
+        writer.close()
+        loop.close()
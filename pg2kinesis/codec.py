@@ -0,0 +1,151 @@
+"""
+JSON encoding and decoding for the formatters.
+
+Every codec reads bytes or text and writes what json.dumps writes by
+default, so which backend is installed never changes what lands on the
+stream. The faster backends only parse: they format floats and integers
+past 64 bits their own way, so writing is left to the standard library,
+whose C encoder is fast enough for single changes.
+"""
+from __future__ import unicode_literals
+from collections import OrderedDict
+import decimal
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import rapidjson
+except ImportError:
+    rapidjson = None
+
+
+class JsonCodec(object):
+    """
+    The standard library's json, always available.
+    """
+    name = 'json'
+
+    def loads(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+    def dumps(self, obj):
+        """
+        :return: obj as JSON text, as json.dumps writes it.
+        """
+        return json.dumps(obj)
+
+    def dumps_bytes(self, obj):
+        """
+        :return: obj as UTF-8 encoded JSON.
+        """
+        return self.dumps(obj).encode('utf-8')
+
+
+class DecimalJsonCodec(JsonCodec):
+    """
+    The standard library's json reading numbers with a fraction or exponent
+    as Decimals, so numeric values keep every digit. Not in CODECS, as no
+    faster backend can; the binary formatters pick it themselves.
+    """
+    name = 'json-decimal'
+
+    def loads(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data, parse_float=decimal.Decimal)
+
+
+# Maps the digits to 0 and every other byte to a space, far quicker than a regex.
+_DIGITS = bytes(bytearray(48 if 48 <= b <= 57 else 32 for b in range(256)))
+# 19 digits may already be past the range of a signed 64 bit integer.
+_LONG_NUMBER = b'0' * 19
+
+
+def _has_long_number(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return _LONG_NUMBER in data.translate(_DIGITS)
+
+
+class _ParsingCodec(JsonCodec):
+    """
+    Parses with a faster backend, falling back to the standard library for
+    what the backend reads differently or not at all: integers that may not
+    fit in 64 bits, which it turns into floats or refuses, and NaN or
+    Infinity, which it refuses.
+    """
+
+    def _loads(self, data):
+        raise NotImplementedError
+
+    def loads(self, data):
+        if not _has_long_number(data):
+            try:
+                return self._loads(data)
+            except ValueError:
+                pass
+        return super(_ParsingCodec, self).loads(data)
+
+
+class OrjsonCodec(_ParsingCodec):
+    name = 'orjson'
+
+    def _loads(self, data):
+        return orjson.loads(data)
+
+
+class UjsonCodec(_ParsingCodec):
+    name = 'ujson'
+
+    def _loads(self, data):
+        return ujson.loads(data)
+
+
+class RapidjsonCodec(_ParsingCodec):
+    name = 'rapidjson'
+
+    def _loads(self, data):
+        return rapidjson.loads(data)
+
+
+# Fastest first.
+CODECS = OrderedDict([
+    ('orjson', (lambda: orjson, OrjsonCodec)),
+    ('ujson', (lambda: ujson, UjsonCodec)),
+    ('rapidjson', (lambda: rapidjson, RapidjsonCodec)),
+    ('json', (lambda: json, JsonCodec)),
+])
+
+
+def available_codecs():
+    """
+    :return: the names of the codecs whose backend is installed, fastest first.
+    """
+    return [name for name, (module, _) in CODECS.items() if module() is not None]
+
+
+def get_codec(name=None):
+    """
+    :param name: a key of CODECS, None picks the fastest one installed.
+    :return: a codec instance.
+    """
+    if name is None:
+        name = available_codecs()[0]
+    elif name not in CODECS:
+        raise ValueError('Unknown JSON codec "{}", choose from {}'.format(name, ', '.join(CODECS)))
+
+    module, codec_f = CODECS[name]
+    if module() is None:
+        raise ImportError('JSON codec "{}" is not installed'.format(name))
+    return codec_f()
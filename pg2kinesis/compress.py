@@ -0,0 +1,132 @@
+"""
+Compression of the records written to Kinesis.
+
+A compressed record starts with HEADER_MAGIC and the id of its codec,
+followed by the compressed record. Records that would not get smaller are
+written as they are, so consumers tell them apart by the first byte, which
+is never HEADER_MAGIC for a text or binary record.
+"""
+from __future__ import unicode_literals
+from collections import OrderedDict
+import struct
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+HEADER = struct.Struct(str('>BB'))
+HEADER_MAGIC = 0xc3
+
+
+class GzipCompressor(object):
+    """
+    zlib's DEFLATE in a gzip container, always available.
+    """
+    name = 'gzip'
+    codec_id = 1
+    default_level = 6
+
+    def __init__(self, level=None):
+        self.level = self.default_level if level is None else level
+
+    def compress(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def decompress(data):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    def __call__(self, data):
+        """
+        :param data: a formatted record, text or bytes.
+        :return: the record compressed behind a header, or as it was if that
+            is no smaller.
+        """
+        raw = data.encode('utf-8') if not isinstance(data, bytes) else data
+        compressed = self.compress(raw)
+        if len(compressed) + HEADER.size >= len(raw):
+            return data
+        return HEADER.pack(HEADER_MAGIC, self.codec_id) + compressed
+
+
+class ZstdCompressor(GzipCompressor):
+    name = 'zstd'
+    codec_id = 2
+    default_level = 3
+
+    def __init__(self, level=None):
+        super(ZstdCompressor, self).__init__(level)
+        # A ZstdCompressor is not thread safe, senders each get their own.
+        self._local = threading.local()
+
+    def compress(self, data):
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=self.level)
+        return compressor.compress(data)
+
+    @staticmethod
+    def decompress(data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+class Lz4Compressor(GzipCompressor):
+    name = 'lz4'
+    codec_id = 3
+    default_level = 0
+
+    def compress(self, data):
+        return lz4.frame.compress(data, compression_level=self.level)
+
+    @staticmethod
+    def decompress(data):
+        return lz4.frame.decompress(data)
+
+
+COMPRESSORS = OrderedDict([
+    ('gzip', (lambda: zlib, GzipCompressor)),
+    ('zstd', (lambda: zstandard, ZstdCompressor)),
+    ('lz4', (lambda: lz4, Lz4Compressor)),
+])
+
+
+def get_compressor(name, level=None):
+    """
+    :param name: a key of COMPRESSORS, or 'none' or None for no compression.
+    :param level: the codec's compression level, its default if None.
+    :return: a compressor, a function of a formatted record, or None.
+    """
+    if name is None or name == 'none':
+        return None
+    if name not in COMPRESSORS:
+        raise ValueError('Unknown compression "{}", choose from {}'.format(name, ', '.join(COMPRESSORS)))
+
+    module, compressor_f = COMPRESSORS[name]
+    if module() is None:
+        raise ImportError('{} compression is not installed, try: pip install pg2kinesis[{}]'.format(name, name))
+    return compressor_f(level)
+
+
+def decompress(data):
+    """
+    What consumers do with a record: undo the compression if it has a header.
+
+    :return: the record as it was formatted, as bytes if it was compressed.
+    """
+    if not data or bytearray(data[:1])[0] != HEADER_MAGIC:
+        return data
+
+    _, codec_id = HEADER.unpack_from(data)
+    for module, compressor_f in COMPRESSORS.values():
+        if compressor_f.codec_id == codec_id:
+            return compressor_f.decompress(data[HEADER.size:])
+    raise ValueError('Unknown compression codec {}'.format(codec_id))
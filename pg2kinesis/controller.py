@@ -0,0 +1,146 @@
+"""
+Tunes batching to the load while running.
+
+A long send window and full aggregates make the most of every put when the
+slot is behind, and hold changes back for nothing when it is not. The
+BatchController listens to the LagMonitor and, after every poll, moves the
+send window and the size aggregates are filled to between a latency and a
+throughput end, and with the asyncio engine the sends in flight too, from
+the lag of the slot and what the writers saw of Kinesis since the last poll.
+"""
+from __future__ import division
+import threading
+import weakref
+
+import aws_kinesis_agg
+
+from .log import logger
+from .metrics import ADAPTIVE_ADJUSTMENTS, ADAPTIVE_AGGREGATE_BYTES, ADAPTIVE_IN_FLIGHT, ADAPTIVE_SEND_WINDOW
+
+
+class BatchController(object):
+    """
+    At every poll of the lag monitor:
+
+    * throttled, more than max_throttle_rate of the put attempts refused:
+      halve the sends in flight, double the send window and aggregate size
+      so fewer, fuller records go out.
+    * busy, the slot busy_bytes or more behind: double the send window and
+      aggregate size, and add a send in flight while puts take less than
+      latency_target seconds.
+    * idle otherwise: halve the send window and aggregate size so changes
+      go out promptly.
+
+    Everything starts at its maximum, the writer's settings without the
+    controller. StreamWriters given the controller attach themselves to it
+    and report their puts and throttles. async_writer, if set, is the
+    AsyncWriter whose max_in_flight is tuned. The settings are exported as
+    metrics labeled with pipeline.
+    """
+
+    def __init__(self, max_send_window=13, max_in_flight=4, busy_bytes=64 * 1024 ** 2, min_send_window=.25,
+                 min_agg_bytes=64 * 1024, max_agg_bytes=aws_kinesis_agg.MAX_BYTES_PER_RECORD, latency_target=1.0,
+                 max_throttle_rate=.05, pipeline='pg2kinesis'):
+        self.max_send_window = max_send_window
+        self.min_send_window = min(min_send_window, max_send_window)
+        self.max_agg_bytes = max_agg_bytes
+        self.min_agg_bytes = min(min_agg_bytes, max_agg_bytes)
+        self.max_in_flight = max_in_flight
+        self.busy_bytes = busy_bytes
+        self.latency_target = latency_target
+        self.max_throttle_rate = max_throttle_rate
+        self.pipeline = pipeline
+
+        self.send_window = max_send_window
+        self.agg_bytes = max_agg_bytes
+        self.in_flight = max_in_flight
+        self.mode = None
+        self.async_writer = None
+
+        # What the writers reported since the last poll.
+        self._puts = 0
+        self._put_seconds = 0.0
+        self._throttles = 0
+        self._lock = threading.Lock()
+        # Weak, as the spool drainer replaces its writer after a failure.
+        self._writers = weakref.WeakSet()
+
+        self._export()
+
+    def attach(self, writer):
+        """
+        Has the StreamWriter writer follow the controller from now on.
+        """
+        self._writers.add(writer)
+        writer.tune(self.send_window, self.agg_bytes)
+
+    def sent(self, seconds):
+        """
+        Called by the writers with how long each put took, retries included.
+        """
+        with self._lock:
+            self._puts += 1
+            self._put_seconds += seconds
+
+    def throttled(self):
+        """
+        Called by the writers for every put attempt Kinesis throttled.
+        """
+        with self._lock:
+            self._throttles += 1
+
+    def __call__(self, lag_monitor):
+        with self._lock:
+            puts, put_seconds, throttles = self._puts, self._put_seconds, self._throttles
+            self._puts, self._put_seconds, self._throttles = 0, 0.0, 0
+        self.adjust(lag_monitor.byte_lag, puts, put_seconds, throttles)
+
+    def adjust(self, byte_lag, puts, put_seconds, throttles):
+        """
+        :param byte_lag: how far behind the slot is.
+        :param puts: puts delivered since the last adjustment.
+        :param put_seconds: the time those puts took.
+        :param throttles: throttled put attempts since the last adjustment.
+        :return: the mode the controller is in, 'throttled', 'busy' or 'idle'.
+        """
+        throttle_rate = throttles / (puts + throttles) if puts + throttles else 0
+        latency = put_seconds / puts if puts else 0
+
+        send_window, agg_bytes, in_flight = self.send_window, self.agg_bytes, self.in_flight
+        if throttle_rate > self.max_throttle_rate:
+            mode = 'throttled'
+            send_window, agg_bytes = send_window * 2, agg_bytes * 2
+            in_flight = in_flight // 2
+        elif byte_lag >= self.busy_bytes:
+            mode = 'busy'
+            send_window, agg_bytes = send_window * 2, agg_bytes * 2
+            if latency < self.latency_target:
+                in_flight += 1
+        else:
+            mode = 'idle'
+            send_window, agg_bytes = send_window / 2, agg_bytes // 2
+
+        send_window = min(max(send_window, self.min_send_window), self.max_send_window)
+        agg_bytes = min(max(agg_bytes, self.min_agg_bytes), self.max_agg_bytes)
+        in_flight = min(max(in_flight, 1), self.max_in_flight)
+
+        changed = (send_window, agg_bytes, in_flight) != (self.send_window, self.agg_bytes, self.in_flight)
+        if changed or mode != self.mode:
+            ADAPTIVE_ADJUSTMENTS.labels(pipeline=self.pipeline, mode=mode).inc()
+            logger.info('Batching for a %s slot: send window %.2fs, aggregates of %s bytes, %s sends in flight. '
+                        'Lag %s bytes, %s puts averaging %.3fs, %.1f%% throttled.' %
+                        (mode, send_window, agg_bytes, in_flight, byte_lag, puts, latency, throttle_rate * 100))
+
+        self.mode = mode
+        self.send_window, self.agg_bytes, self.in_flight = send_window, agg_bytes, in_flight
+        for writer in list(self._writers):
+            writer.tune(send_window, agg_bytes)
+        if self.async_writer is not None:
+            self.async_writer.max_in_flight = in_flight
+        self._export()
+        return mode
+
+    def _export(self):
+        ADAPTIVE_SEND_WINDOW.labels(pipeline=self.pipeline).set(self.send_window)
+        ADAPTIVE_AGGREGATE_BYTES.labels(pipeline=self.pipeline).set(self.agg_bytes)
+        ADAPTIVE_IN_FLIGHT.labels(pipeline=self.pipeline).set(self.in_flight)
@@ -1,10 +1,21 @@
 from __future__ import unicode_literals
 
-import json
+from decimal import Decimal
 import re
+import struct
 import sys
+import time
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .codec import DecimalJsonCodec, get_codec
 from .log import logger
+from .metrics import CHANGES_FORMATTED, DECODE_SECONDS, FORMAT_SECONDS
+from .schema import SchemaCache, pack_header, ENVELOPE_KIND, HEADER, HEADER_MAGIC, RECORD_KIND, SCHEMA_KIND
+from .tables import tables_re
 
 from collections import namedtuple
 
@@ -12,73 +23,531 @@ from collections import namedtuple
 Change = namedtuple('Change', 'xid, table, operation, pkey')
 FullChange = namedtuple('FullChange', 'xid, change')
 
-# Final product of Formatter, a Change and the Change formatted.
-Message = namedtuple('Message', 'change, fmt_msg')
+# Final product of Formatter, a Change and the Change formatted. schema is
+# the schema record a binary record can only be read with, None otherwise.
+Message = namedtuple('Message', 'change, fmt_msg, schema')
+Message.__new__.__defaults__ = (None,)
 
-COL_TYPE_VALUE_TEMPLATE_PAT = r"{col_name}\[{col_type}\]:'?([\w\-]+)'?"
 MISSING_TABLE_ERR = 'Unable to locate table: "{}"'
 MISSING_PK_ERR = 'Unable to locate primary key for table "{}"'
+PARSE_ERR = 'Unable to parse change: "{}"'
+
+# Types test_decoding prints unquoted and wal2json emits as JSON numbers.
+INTEGER_TYPES = {'smallint', 'integer', 'bigint', 'oid', 'int2', 'int4', 'int8'}
+FLOAT_TYPES = {'real', 'double precision', 'float4', 'float8'}
+NUMERIC_TYPES = {'numeric', 'decimal'}
+BOOLEAN_TYPES = {'boolean', 'bool'}
+UNCHANGED_TOAST = 'unchanged-toast-datum'
+
+# Room left in a Kinesis record, at most 1MiB, for the partition key and
+# the framing of the aggregate around a transaction envelope.
+ENVELOPE_MAX_BYTES = 1000 * 1024
+
+
+def _read_identifier(text, pos, stops):
+    """
+    Reads a, possibly double quoted, identifier starting at pos.
+
+    :return: the identifier and the position just after it.
+    """
+    if text[pos] == '"':
+        end = text.index('"', pos + 1)
+        while text.startswith('"', end + 1):
+            end = text.index('"', end + 2)
+        return text[pos + 1:end].replace('""', '"'), end + 1
+
+    end = pos
+    while text[end] not in stops:
+        end += 1
+    return text[pos:end], end
+
+
+def parse_test_decoding_tuple(text, pos=0):
+    """
+    Splits the tuple part of a test_decoding change in one pass. e.g.:
+        id[integer]:1 name[text]:'O''Brien' note[text]:null
+
+    UPDATEs that change the replica identity print an "old-key:" tuple and a
+    "new-tuple:" one, DELETEs without a replica identity "(no-tuple-data)".
+
+    :param text: the change
+    :param pos: where the tuple starts in text
+    :return: the new tuple and the old key as lists of (name, type, value),
+        old key is None if there was none. Values are the text test_decoding
+        printed, or None for NULL.
+    """
+    new_tuple = columns = []
+    old_key = None
+    end = len(text)
+
+    while pos < end:
+        if text[pos] == ' ':
+            pos += 1
+        elif text.startswith('old-key:', pos):
+            old_key = columns = []
+            pos += 8
+        elif text.startswith('new-tuple:', pos):
+            columns = new_tuple
+            pos += 10
+        elif text.startswith('(no-tuple-data)', pos):
+            pos += 15
+        else:
+            name, pos = _read_identifier(text, pos, '[')
+            type_end = text.index(']:', pos)
+            col_type = text[pos + 1:type_end]
+            pos = type_end + 2
+
+            if text.startswith("'", pos):
+                quote = text.index("'", pos + 1)
+                while text.startswith("'", quote + 1):
+                    quote = text.index("'", quote + 2)
+                value = text[pos + 1:quote].replace("''", "'")
+                pos = quote + 1
+            else:
+                value_end = text.find(' ', pos)
+                if value_end == -1:
+                    value_end = end
+                value = text[pos:value_end]
+                if value == 'null':
+                    value = None
+                pos = value_end
+
+            columns.append((name, col_type, value))
+
+    return new_tuple, old_key
+
+
+def _typed_value(col_type, value, exact_numeric=False):
+    """
+    Converts the text of a test_decoding value to what wal2json would emit.
+
+    :param exact_numeric: keep numeric values as text rather than turning
+        them into floats that may lose digits.
+    """
+    if value is None:
+        return value
+    if col_type in BOOLEAN_TYPES:
+        # test_decoding prints true and false, pgoutput t and f.
+        return value in ('true', 't')
+    if exact_numeric and col_type.split('(', 1)[0] in NUMERIC_TYPES:
+        return value
+    try:
+        if col_type in INTEGER_TYPES:
+            return int(value)
+        if col_type in FLOAT_TYPES or col_type in NUMERIC_TYPES:
+            return int(value) if value.lstrip('-').isdigit() else float(value)
+    except ValueError:
+        pass
+    return value
+
+
+# Relation metadata pgoutput sends ahead of the first change to a table.
+# columns is a list of (is_key, name, type).
+Relation = namedtuple('Relation', 'relid, schema, table, columns')
+
+# A decoded pgoutput message. columns and old_key are lists of (name, type, value)
+# like parse_test_decoding_tuple returns; a DELETE's key is in columns.
+PgOutputMessage = namedtuple('PgOutputMessage', 'action, xid, relation, columns, old_key')
+
+# Names of the built in types, others are named by the Type messages pgoutput sends.
+PG_TYPES = {
+    16: 'boolean', 17: 'bytea', 18: '"char"', 19: 'name', 20: 'bigint', 21: 'smallint', 23: 'integer',
+    25: 'text', 26: 'oid', 114: 'json', 700: 'real', 701: 'double precision', 1000: 'boolean[]',
+    1005: 'smallint[]', 1007: 'integer[]', 1009: 'text[]', 1015: 'character varying[]', 1016: 'bigint[]',
+    1042: 'character', 1043: 'character varying', 1082: 'date', 1083: 'time without time zone',
+    1114: 'timestamp without time zone', 1184: 'timestamp with time zone', 1700: 'numeric', 2950: 'uuid',
+    2951: 'uuid[]', 3802: 'jsonb',
+}
+# Oids below this belong to the types built in.
+FIRST_NORMAL_OID = 16384
+
+
+class PgOutputDecoder(object):
+    """
+    Decodes the binary messages of pgoutput, protocol version 1, keeping the
+    relation and type metadata it has been sent so changes can be named.
+    """
+    BEGIN = struct.Struct(str('>qqI'))
+    INT16 = struct.Struct(str('>h'))
+    INT32 = struct.Struct(str('>i'))
+    OID = struct.Struct(str('>I'))
+    COLUMN = struct.Struct(str('>Ii'))
+
+    def __init__(self):
+        self.relations = {}
+        self.types = {}
+
+    @staticmethod
+    def _string(data, pos):
+        end = data.index(b'\x00', pos)
+        return data[pos:end].decode('utf-8'), end + 1
+
+    def type_name(self, oid):
+        return self.types.get(oid) or PG_TYPES.get(oid) or str(oid)
+
+    def _relation(self, data, pos):
+        return self.relations[self.OID.unpack_from(data, pos)[0]], pos + 4
+
+    def _tuple(self, data, pos, relation, key_only=False):
+        """
+        :return: the (name, type, value) of each column and the position after
+            the tuple. Unchanged TOASTed values are left out, as are non key
+            columns when key_only.
+        """
+        count = self.INT16.unpack_from(data, pos)[0]
+        pos += 2
+        columns = []
+        for is_key, name, col_type in relation.columns[:count]:
+            kind = data[pos:pos + 1]
+            pos += 1
+            if kind == b't':
+                length = self.INT32.unpack_from(data, pos)[0]
+                value = data[pos + 4:pos + 4 + length].decode('utf-8')
+                pos += 4 + length
+            elif kind == b'n':
+                value = None
+            elif kind == b'u':
+                continue
+            else:
+                raise ValueError('Unknown tuple data kind {!r}'.format(kind))
+            if is_key or not key_only:
+                columns.append((name, col_type, value))
+        return columns, pos
+
+    def _old_tuple(self, data, pos, relation):
+        """
+        Reads the K (replica identity) or O (whole old row) tuple of an UPDATE
+        or DELETE, if there is one.
+        """
+        kind = data[pos:pos + 1]
+        if kind in (b'K', b'O'):
+            return self._tuple(data, pos + 1, relation, key_only=kind == b'K')
+        return None, pos
+
+    def decode(self, data):
+        """
+        :param data: a pgoutput message as bytes.
+        :return: a PgOutputMessage.
+        """
+        action = data[:1].decode('ascii')
+        xid = relation = columns = old_key = None
+
+        if action == 'B':
+            xid = self.BEGIN.unpack_from(data, 1)[2]
+        elif action == 'R':
+            relid = self.OID.unpack_from(data, 1)[0]
+            schema, pos = self._string(data, 5)
+            table, pos = self._string(data, pos)
+            count = self.INT16.unpack_from(data, pos + 1)[0]
+            pos += 3
+            rel_columns = []
+            for _ in range(count):
+                flags = bytearray(data[pos:pos + 1])[0]
+                name, pos = self._string(data, pos + 1)
+                oid, _ = self.COLUMN.unpack_from(data, pos)
+                pos += self.COLUMN.size
+                rel_columns.append((bool(flags & 1), name, self.type_name(oid)))
+            relation = self.relations[relid] = Relation(relid, schema, table, rel_columns)
+        elif action == 'Y':
+            oid = self.OID.unpack_from(data, 1)[0]
+            _, pos = self._string(data, 5)
+            self.types[oid] = self._string(data, pos)[0]
+        elif action == 'I':
+            relation, pos = self._relation(data, 1)
+            columns, _ = self._tuple(data, pos + 1, relation)
+        elif action == 'U':
+            relation, pos = self._relation(data, 1)
+            old_key, pos = self._old_tuple(data, pos, relation)
+            columns, _ = self._tuple(data, pos + 1, relation)
+        elif action == 'D':
+            relation, pos = self._relation(data, 1)
+            columns, _ = self._old_tuple(data, pos, relation)
+        elif action == 'T':
+            count = self.INT32.unpack_from(data, 1)[0]
+            relation = [self.relations[self.OID.unpack_from(data, 6 + 4 * i)[0]] for i in range(count)]
+        elif action not in ('C', 'O', 'M'):
+            raise ValueError('Unknown pgoutput message {!r}'.format(action))
+
+        return PgOutputMessage(action, xid, relation, columns, old_key)
+
 
 class Formatter(object):
     VERSION = 0
     TYPE = 'CDC'
     IGNORED_CHANGES = {'COMMIT'}
+    WAL2JSON_V2_KINDS = {'I': 'insert', 'U': 'update', 'D': 'delete'}
+    PGOUTPUT_OPERATIONS = {'I': 'INSERT', 'U': 'UPDATE', 'D': 'DELETE'}
+    # Whether numeric values are read exactly rather than as floats.
+    EXACT_NUMERIC = False
 
     def __init__(self, primary_key_map, output_plugin='test_decoding',
-                 full_change=False, table_pat=None):
+                 full_change=False, table_pat=None, wal2json_format_version=1,
+                 wal2json_write_in_chunks=False, json_codec=None, tables=None, exclude_tables=None,
+                 transaction_envelopes=False, envelope_max_bytes=ENVELOPE_MAX_BYTES):
 
-        self._primary_key_patterns = {}
         self.output_plugin = output_plugin
+        self.wal2json_format_version = wal2json_format_version
+        self.wal2json_write_in_chunks = wal2json_write_in_chunks
+        self.codec = get_codec(json_codec)
+        self.pgoutput = PgOutputDecoder()
         self.primary_key_map = primary_key_map
         self.full_change = full_change
         self.table_pat = table_pat if table_pat is not None else r'[\w_\.]+'
         self.table_re = re.compile(self.table_pat)
+        self.tables_re = tables_re(tables)
+        self.exclude_tables_re = tables_re(exclude_tables)
         self.cur_xact = ''
 
-        for k, v in getattr(primary_key_map, 'iteritems', primary_key_map.items)():
-            # ":" added to make later look up not need to trim trailing ":".
-            self._primary_key_patterns[k + ":"] = re.compile(
-                COL_TYPE_VALUE_TEMPLATE_PAT.format(col_name=v.col_name, col_type=v.col_type)
-            )
+        self.transaction_envelopes = transaction_envelopes
+        self.envelope_max_bytes = envelope_max_bytes
+        # Set by _preprocess at the end of each transaction.
+        self._committed = False
+        self._txn = []
+        self._txn_bytes = 0
+        self._txn_part = 0
+        # The schema records already in the envelope under way.
+        self._txn_schemas = set()
+
+    @property
+    def parallel_safe(self):
+        """
+        Whether payloads can be formatted independently of each other, by
+        separate formatters. wal2json format 1 sends a whole transaction, with
+        its xid, at a time. Everything else relies on earlier messages: BEGIN
+        for the xid, chunks for the rest of the transaction or pgoutput's
+        relations for the columns.
+        """
+        return (self.output_plugin == 'wal2json' and self.wal2json_format_version == 1 and
+                not self.wal2json_write_in_chunks)
+
+    def _table_wanted(self, table_name, full_table):
+        """
+        Filters out the changes the server could not. The wal2json and pgoutput
+        plugins are told about tables and exclude_tables, this is what remains
+        for test_decoding, and for --table-pat which has no server side equal.
+
+        :param table_name: the name table_pat is searched in.
+        :param full_table: the schema qualified name of the table.
+        """
+        if not self.table_re.search(table_name):
+            return False
+        if self.tables_re is not None and not self.tables_re.match(full_table):
+            return False
+        return self.exclude_tables_re is None or not self.exclude_tables_re.match(full_table)
+
+    def table_wanted(self, schema, table):
+        """
+        Whether changes to schema.table are published, for those reading
+        tables outside of the slot.
+        """
+        full_table = '{}.{}'.format(schema, table)
+        return self._table_wanted(table if self.output_plugin == 'wal2json' else full_table, full_table)
+
+    def column_type(self, oid, typname, name, name_with_typmod):
+        """
+        Names the type of a column the way the output plugin does, for those
+        reading tables outside of the slot.
+
+        :param oid: the oid of the type.
+        :param typname: its name in pg_type.
+        :param name: what format_type makes of it without a type modifier.
+        :param name_with_typmod: what format_type makes of it with the
+            column's type modifier, e.g. numeric(10,2).
+        """
+        if self.output_plugin == 'wal2json':
+            return name_with_typmod
+        if self.output_plugin == 'pgoutput':
+            # pgoutput names the types that are not built in by Type messages.
+            return typname if oid >= FIRST_NORMAL_OID else self.pgoutput.type_name(oid)
+        return name
+
+    def format_row(self, schema, table, columns, xid=0):
+        """
+        Formats a row read outside of the slot, e.g. by a Backfill, as an
+        insert of the output plugin.
+
+        :param columns: the (name, type, value) of each column, the values as
+            Postgres prints them, None for NULL.
+        :return: A list of type Message
+        """
+        operation = 'insert' if self.output_plugin == 'wal2json' else 'INSERT'
+        if self.full_change:
+            changes = [FullChange(xid=xid, change=self._tuple_row(schema, table, operation, columns, None))]
+        else:
+            full_table = '{}.{}'.format(schema, table)
+            try:
+                primary_key = self.primary_key_map[full_table]
+            except KeyError:
+                self._log_and_raise(MISSING_TABLE_ERR.format(full_table))
+            # _tuple_change reads cur_xact, which belongs to the slot.
+            changes = [change._replace(xid=xid)
+                       for change in self._tuple_change(full_table, operation, columns, primary_key.col_names)]
+
+        messages = self._format(changes)
+        CHANGES_FORMATTED.inc(len(messages))
+        return messages
 
     def _preprocess_test_decoding_change(self, change):
         """
         Takes a message payload from the test_decoding plugin and distills it
-        into a Change tuple currently only looking for primary key.
+        into a Change tuple holding the primary key or, when full_change is
+        set, a FullChange holding the row in the same shape wal2json uses.
 
         They look like this:
-            "table table_test: UPDATE: uuid[uuid]:'00079f3e-0479-4475-acff-4f225cc5188a' another_col[text]'bling'"
+            "table public.table_test: UPDATE: uuid[uuid]:'00079f3e-0479-4475-acff-4f225cc5188a' another_col[text]:'bling'"
 
         :param change: a message payload from postgres' test_decoding plugin.
-        :return: A list of type Change
+        :return: A list of type Change or FullChange
         """
 
-        rec = change.split(' ', 3)
-
-        if rec[0] == 'BEGIN':
-            self.cur_xact = rec[1]
-        elif rec[0] in self.IGNORED_CHANGES:
-            pass
-        elif rec[0] == 'table':
-            table_name = rec[1][:-1]
-
-            if self.table_re.search(table_name):
-                try:
-                    mat = self._primary_key_patterns[rec[1]].search(rec[3])
-                except KeyError:
-                    self._log_and_raise(MISSING_TABLE_ERR.format(rec[1]))
+        if change.startswith('table '):
+            try:
+                schema, pos = _read_identifier(change, 6, '.:')
+                if change[pos] == '.':
+                    table, pos = _read_identifier(change, pos + 1, ':')
+                    table_name = '{}.{}'.format(schema, table)
                 else:
-                    if mat:
-                        pkey = mat.groups()[0]
-                        return [Change(xid=self.cur_xact, table=table_name,
-                                       operation=rec[2][:-1], pkey=pkey)]
-                    else:
-                        self._log_and_raise(MISSING_PK_ERR.format(table_name))
+                    schema, table = None, schema
+                    table_name = table
+                op_end = change.index(':', pos + 2)
+                operation = change[pos + 2:op_end]
+                if operation == 'TRUNCATE':
+                    columns, old_key = [], None
+                else:
+                    columns, old_key = parse_test_decoding_tuple(change, op_end + 1)
+            except (ValueError, IndexError):
+                self._log_and_raise(PARSE_ERR.format(change))
+                return []
+
+            if not self._table_wanted(table_name, table_name):
+                return []
+
+            if operation == 'TRUNCATE':
+                logger.warning('Skipping TRUNCATE of {}'.format(table_name))
+                return []
+
+            if self.full_change:
+                return [FullChange(xid=self.cur_xact,
+                                   change=self._tuple_row(schema, table, operation, columns, old_key))]
+
+            try:
+                primary_key = self.primary_key_map[table_name]
+            except KeyError:
+                self._log_and_raise(MISSING_TABLE_ERR.format(table_name))
+            else:
+                return self._tuple_change(table_name, operation, columns, primary_key.col_names)
         else:
-            self._log_and_raise('Unknown change: "{}"'.format(change))
+            rec = change.split(' ', 2)
+
+            if rec[0] == 'BEGIN':
+                self.cur_xact = rec[1]
+            elif rec[0] == 'COMMIT':
+                self._committed = True
+            elif rec[0] in self.IGNORED_CHANGES:
+                pass
+            else:
+                self._log_and_raise('Unknown change: "{}"'.format(change))
 
         return []
 
+    def _tuple_change(self, table_name, operation, columns, col_names):
+        """
+        :param columns: the (name, type, value) of each column of the row.
+        :param col_names: the names of its primary key columns.
+        :return: A list holding the Change of the row.
+        """
+        values = dict((name, value) for name, _, value in columns)
+        pkey = self._joined_key(table_name, values, col_names)
+        if pkey is None:
+            return []
+        return [Change(xid=self.cur_xact, table=table_name, operation=operation, pkey=pkey)]
+
+    def _tuple_row(self, schema, table, operation, columns, old_key):
+        """
+        Builds a full change from the columns of a test_decoding or pgoutput change.
+
+        :return: the row as a dictionary shaped like a wal2json change.
+        """
+        row = {'kind': operation.lower(), 'schema': schema, 'table': table}
+
+        # A DELETE only prints the replica identity, which wal2json calls oldkeys.
+        if operation == 'DELETE':
+            old_key, columns = columns, []
+
+        if columns:
+            columns = [c for c in columns if c[2] != UNCHANGED_TOAST]
+            row['columnnames'] = [name for name, _, _ in columns]
+            row['columntypes'] = [col_type for _, col_type, _ in columns]
+            row['columnvalues'] = [_typed_value(col_type, value, self.EXACT_NUMERIC)
+                                   for _, col_type, value in columns]
+
+        if old_key:
+            row['oldkeys'] = {
+                'keynames': [name for name, _, _ in old_key],
+                'keytypes': [col_type for _, col_type, _ in old_key],
+                'keyvalues': [_typed_value(col_type, value, self.EXACT_NUMERIC) for _, col_type, value in old_key],
+            }
+
+        return row
+
+    def _preprocess_pgoutput_change(self, change):
+        """
+        Takes a binary message from the pgoutput plugin and distills it into a
+        list of Change or FullChange tuples. Relation messages are remembered
+        so the changes that follow can be named.
+
+        Tables missing from the primary key map are keyed on their replica
+        identity, which pgoutput marks in the relation.
+
+        :param change: a message payload from postgres pgoutput plugin.
+        :return: A list of type Change or FullChange
+        """
+        try:
+            message = self.pgoutput.decode(change)
+        except (ValueError, KeyError, IndexError, struct.error):
+            self._log_and_raise(PARSE_ERR.format(repr(change)))
+            return []
+
+        if message.action == 'B':
+            self.cur_xact = message.xid
+            return []
+        if message.action == 'C':
+            self._committed = True
+            return []
+        if message.action == 'T':
+            for relation in message.relation:
+                logger.warning('Skipping TRUNCATE of {}.{}'.format(relation.schema, relation.table))
+            return []
+        if message.action == 'R':
+            # pgoutput sends a table's relation again after it changed, its
+            # primary key may have too.
+            if hasattr(self.primary_key_map, 'invalidate'):
+                self.primary_key_map.invalidate('{}.{}'.format(message.relation.schema, message.relation.table))
+            return []
+        if message.action not in self.PGOUTPUT_OPERATIONS:
+            return []
+
+        relation = message.relation
+        table_name = '{}.{}'.format(relation.schema, relation.table)
+        if not self._table_wanted(table_name, table_name):
+            return []
+
+        operation = self.PGOUTPUT_OPERATIONS[message.action]
+        if self.full_change:
+            return [FullChange(xid=self.cur_xact,
+                               change=self._tuple_row(relation.schema, relation.table, operation,
+                                                      message.columns, message.old_key))]
+
+        primary_key = self.primary_key_map.get(table_name)
+        if primary_key is not None:
+            col_names = primary_key.col_names
+        else:
+            col_names = [name for is_key, name, _ in relation.columns if is_key]
+            if not col_names:
+                self._log_and_raise(MISSING_TABLE_ERR.format(table_name))
+                return []
+        return self._tuple_change(table_name, operation, message.columns, col_names)
+
     def _preprocess_wal2json_change(self, change):
         """
         Takes a message payload from the wal2json plugin and distills it into a
@@ -102,66 +571,627 @@ class Formatter(object):
         :return: A list of type Change or FullChange
         """
 
-        change_dictionary = json.loads(change)
+        change_dictionary = self.codec.loads(change)
         if not change_dictionary:
-            return None
+            return []
 
         self.cur_xact = change_dictionary['xid']
         changes = []
 
         for change in change_dictionary['change']:
-            table_name = change['table']
-            schema = change['schema']
-            if self.table_re.search(table_name):
-                if self.full_change:
-                    changes.append(FullChange(xid=self.cur_xact, change=change))
-                else:
-                    try:
-                        full_table = '{}.{}'.format(schema, table_name)
-                        primary_key = self.primary_key_map[full_table]
-                    except KeyError:
-                        self._log_and_raise(MISSING_TABLE_ERR.format(full_table))
-                    else:
-                        value_index = change['columnnames'].index(primary_key.col_name)
-                        pkey = str(change['columnvalues'][value_index])
-                        changes.append(Change(xid=self.cur_xact,
-                                              table=full_table,
-                                              operation=change['kind'].lower(),
-                                              pkey=pkey))
+            changes.extend(self._wal2json_row_change(change))
+        self._committed = True
         return changes
 
+    def _preprocess_wal2json_chunk(self, chunk):
+        """
+        Takes one piece of a wal2json format 1 transaction written with
+        write-in-chunks, so a transaction never has to be held, or parsed, in
+        one piece. The transaction is split like this:
+            {"xid":1234567890,"change":[
+            {"kind":"insert","schema":"public","table":"some_table",...}
+            ,{"kind":"delete","schema":"public","table":"some_table",...}
+            ]}
+
+        :param chunk: a message payload from postgres wal2json plugin.
+        :return: A list of type Change or FullChange
+        """
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode('utf-8')
+        chunk = chunk.strip()
+        if chunk.startswith(','):
+            chunk = chunk[1:].lstrip()
+
+        if chunk.endswith('['):
+            # The head of a transaction, close it to read the xid.
+            self.cur_xact = self.codec.loads(chunk + ']}')['xid']
+            return []
+        if chunk == ']}':
+            self._committed = True
+            return []
+
+        change = self.codec.loads(chunk)
+        if 'change' in change:
+            # A transaction small enough to fit in a single chunk.
+            self.cur_xact = change['xid']
+            self._committed = True
+            return [c for row in change['change'] for c in self._wal2json_row_change(row)]
+
+        return self._wal2json_row_change(change)
+
+    def _preprocess_wal2json_v2_change(self, change):
+        """
+        Takes a message payload from the wal2json plugin using format-version 2,
+        where every row change is a message of its own, and distills it into a
+        list of Change or FullChange tuples.
+
+        They look like this:
+            {"action":"B","xid":1234567890}
+            {"action":"I","schema":"public","table":"some_table",
+             "columns":[{"name":"id","type":"integer","value":42}]}
+            {"action":"C","xid":1234567890}
+
+        Rows are converted to the format 1 shape so full changes look the same
+        whichever format the slot uses.
+
+        :param change: a message payload from postgres wal2json plugin.
+        :return: A list of type Change or FullChange
+        """
+        message = self.codec.loads(change)
+        action = message['action']
+
+        if action == 'B':
+            self.cur_xact = message['xid']
+            return []
+        if action == 'C':
+            self._committed = True
+            return []
+        if action not in self.WAL2JSON_V2_KINDS:
+            # COMMIT, TRUNCATE and logical decoding messages.
+            if action == 'T':
+                logger.warning('Skipping TRUNCATE of {}.{}'.format(message['schema'], message['table']))
+            return []
+
+        row = {'kind': self.WAL2JSON_V2_KINDS[action],
+               'schema': message['schema'],
+               'table': message['table']}
+        if 'columns' in message:
+            row['columnnames'] = [c['name'] for c in message['columns']]
+            row['columntypes'] = [c['type'] for c in message['columns']]
+            row['columnvalues'] = [c.get('value') for c in message['columns']]
+        if 'identity' in message:
+            row['oldkeys'] = {'keynames': [c['name'] for c in message['identity']],
+                              'keytypes': [c['type'] for c in message['identity']],
+                              'keyvalues': [c.get('value') for c in message['identity']]}
+
+        return self._wal2json_row_change(row)
+
+    def _wal2json_row_change(self, change):
+        """
+        Distills a single wal2json format 1 row change.
+
+        :param change: the row as a dictionary.
+        :return: A list of type Change or FullChange
+        """
+        table_name = change['table']
+        schema = change['schema']
+        if not self._table_wanted(table_name, '{}.{}'.format(schema, table_name)):
+            return []
+
+        if self.full_change:
+            return [FullChange(xid=self.cur_xact, change=change)]
+
+        try:
+            full_table = '{}.{}'.format(schema, table_name)
+            primary_key = self.primary_key_map[full_table]
+        except KeyError:
+            self._log_and_raise(MISSING_TABLE_ERR.format(full_table))
+        else:
+            # A DELETE only carries the replica identity.
+            if 'columnnames' in change:
+                names, values = change['columnnames'], change['columnvalues']
+            else:
+                names, values = change['oldkeys']['keynames'], change['oldkeys']['keyvalues']
+            pkey = self._joined_key(full_table, dict(zip(names, (str(value) for value in values))),
+                                    primary_key.col_names)
+            if pkey is not None:
+                return [Change(xid=self.cur_xact,
+                               table=full_table,
+                               operation=change['kind'].lower(),
+                               pkey=pkey)]
+        return []
+
+    def _joined_key(self, table_name, values, col_names):
+        """
+        Joins the values of the primary key columns. When one is missing the
+        cached key may predate an ALTER TABLE, so it is looked up once more.
+
+        :param values: the text of each column of the row by name.
+        :param col_names: the names of the primary key columns.
+        :return: the primary key, None if it could not be found.
+        """
+        try:
+            return ','.join(values[col_name] for col_name in col_names)
+        except (KeyError, TypeError):
+            pass
+
+        primary_key = self.primary_key_map.refresh(table_name) if hasattr(self.primary_key_map, 'refresh') else None
+        try:
+            return ','.join(values[col_name] for col_name in primary_key.col_names)
+        except (AttributeError, KeyError, TypeError):
+            self._log_and_raise(MISSING_PK_ERR.format(table_name))
+
     @staticmethod
     def _log_and_raise(msg):
         logger.error(msg)
         raise Exception(msg)
 
-    def __call__(self, change):
+    def _preprocess(self, change):
         if self.output_plugin == 'test_decoding':
-            pp_changes = self._preprocess_test_decoding_change(change)
+            return self._preprocess_test_decoding_change(change)
         elif self.output_plugin == 'wal2json':
-            pp_changes = self._preprocess_wal2json_change(change)
+            if self.wal2json_format_version == 2:
+                return self._preprocess_wal2json_v2_change(change)
+            elif self.wal2json_write_in_chunks:
+                return self._preprocess_wal2json_chunk(change)
+            else:
+                return self._preprocess_wal2json_change(change)
+        elif self.output_plugin == 'pgoutput':
+            return self._preprocess_pgoutput_change(change)
+
+    def __call__(self, change):
+        started = time.time()
+        pp_changes = self._preprocess(change)
+        decoded = time.time()
+        messages = self._format(pp_changes)
+        if self.transaction_envelopes:
+            messages = self._envelopes(messages)
+
+        DECODE_SECONDS.observe(decoded - started)
+        FORMAT_SECONDS.observe(time.time() - decoded)
+        CHANGES_FORMATTED.inc(len(messages))
+        return messages
+
+    def _format(self, pp_changes):
         return [self.produce_formatted_message(pp_change) for pp_change in pp_changes]
 
+    def _envelopes(self, messages):
+        """
+        Holds on to the messages of a transaction until it commits and wraps
+        them in envelopes, starting another one whenever the next message
+        would take an envelope past envelope_max_bytes. Envelopes are measured
+        in encoded bytes, their framing and schema records included. A message
+        too large for any envelope goes in one of its own.
+
+        :return: the envelopes completed by messages.
+        """
+        envelopes = []
+        for message in messages:
+            size = self._envelope_entry_bytes(message)
+            if self._txn and self._txn_bytes + size > self.envelope_max_bytes:
+                envelopes.append(self._seal(final=False))
+                size = self._envelope_entry_bytes(message)
+            if not self._txn:
+                self._txn_bytes = self._envelope_frame_bytes(message.change.xid)
+                if self._txn_bytes + size > self.envelope_max_bytes:
+                    logger.warning('A change of transaction {} takes {} bytes, more than an envelope holds, it '
+                                   'gets one of its own'.format(message.change.xid, size))
+            self._txn.append(message)
+            self._txn_bytes += size
+            if message.schema is not None:
+                self._txn_schemas.add(message.schema)
+
+        if self._committed:
+            self._committed = False
+            if self._txn:
+                envelopes.append(self._seal(final=True))
+            self._txn_part = 0
+        return envelopes
+
+    def _envelope_entry_bytes(self, message):
+        """
+        :return: the bytes message adds to the envelope under way.
+        """
+        size = self._envelope_record_bytes(message.fmt_msg)
+        if message.schema is not None and message.schema not in self._txn_schemas:
+            size += self._envelope_record_bytes(message.schema)
+        return size
+
+    def _envelope_frame_bytes(self, xid):
+        """
+        :return: the bytes of an envelope of xid before any record goes in.
+        """
+        return _byte_len(self.produce_envelope(xid, self._txn_part, False, []))
+
+    def _envelope_record_bytes(self, record):
+        """
+        :return: the bytes a formatted record takes in an envelope.
+        """
+        # A JSON string and the ", " after it, which the last record goes without.
+        return _byte_len(self.codec.dumps(record)) + 2
+
+    def _seal(self, final):
+        messages, self._txn, self._txn_bytes = self._txn, [], 0
+        self._txn_schemas = set()
+        # Partitioned like the first change in it.
+        change = messages[0].change
+        envelope = Message(change=change, fmt_msg=self.produce_envelope(change.xid, self._txn_part, final, messages))
+        self._txn_part += 1
+        return envelope
+
     def produce_formatted_message(self, change):
         return change
 
+    def produce_envelope(self, xid, part, final, messages):
+        """
+        The formatted messages of the transaction in a json object:
+            {"xid": ..., "part": 0, "final": true, "records": ["...", ...]}
+
+        :param xid: the transaction.
+        :param part: counts the envelopes of a transaction too large for one.
+        :param final: whether this is the transaction's last envelope.
+        :param messages: the formatted messages it holds.
+        :return: the formatted envelope.
+        """
+        return self.codec.dumps({'xid': xid, 'part': part, 'final': final, 'records': [m.fmt_msg for m in messages]})
+
 
 class CSVFormatter(Formatter):
     VERSION = 0
+    ENVELOPE_TYPE = 'TXN'
     def produce_formatted_message(self, change):
         fmt_msg = '{},{},{},{},{},{}'.format(CSVFormatter.VERSION,
                                              CSVFormatter.TYPE, *change)
         return Message(change=change, fmt_msg=fmt_msg)
 
+    def produce_envelope(self, xid, part, final, messages):
+        """
+        The CSV lines of the transaction in a json object:
+            0,TXN,{"xid": ..., "part": 0, "final": true, "records": ["0,CDC,...", ...]}
+        """
+        return '{},{},{}'.format(CSVFormatter.VERSION, CSVFormatter.ENVELOPE_TYPE,
+                                 super(CSVFormatter, self).produce_envelope(xid, part, final, messages))
+
 
 class CSVPayloadFormatter(Formatter):
     VERSION = 0
     def produce_formatted_message(self, change):
         fmt_msg = '{},{},{}'.format(CSVFormatter.VERSION, CSVFormatter.TYPE,
-                                    json.dumps(change._asdict()))
+                                    self.codec.dumps(change._asdict()))
         return Message(change=change, fmt_msg=fmt_msg)
 
+    def produce_envelope(self, xid, part, final, messages):
+        """
+        The json objects of the transaction's changes in a list:
+            0,TXN,{"xid":...,"part":0,"final":true,"changes":[{...},...]}
+        """
+        # The changes are json already, only the prefix needs cutting off.
+        prefix = len('{},{},'.format(CSVFormatter.VERSION, CSVFormatter.TYPE))
+        return '{},{},{{"xid":{},"part":{},"final":{},"changes":[{}]}}'.format(
+            CSVFormatter.VERSION, CSVFormatter.ENVELOPE_TYPE, self.codec.dumps(xid), part,
+            'true' if final else 'false', ','.join(m.fmt_msg[prefix:] for m in messages))
+
+    def _envelope_record_bytes(self, record):
+        # Without the prefix, with a comma, which the last change goes without.
+        return _byte_len(record) - len('{},{},'.format(CSVFormatter.VERSION, CSVFormatter.TYPE)) + 1
+
+
+def _byte_len(data):
+    """
+    :return: the length of data, text or bytes, in UTF-8 encoded bytes.
+    """
+    return len(data.encode('utf-8')) if isinstance(data, type('')) else len(data)
+
+
+def _value_kind(col_type):
+    """
+    :return: how a binary formatter writes values of col_type, one of
+        long, double, boolean or string.
+    """
+    if col_type.endswith(']'):
+        return 'string'
+    base_type = col_type.split('(', 1)[0]
+    if base_type in INTEGER_TYPES:
+        return 'long'
+    if base_type in FLOAT_TYPES:
+        return 'double'
+    # Written as text, as a double would lose digits.
+    if base_type in NUMERIC_TYPES:
+        return 'string'
+    if base_type in BOOLEAN_TYPES:
+        return 'boolean'
+    return 'string'
+
+
+def _varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+
+def _avro_name(name):
+    name = re.sub(r'[^A-Za-z0-9_]', '_', name)
+    return name if re.match(r'[A-Za-z_]', name) else '_' + name
+
+
+class BinaryFormatter(Formatter):
+    """
+    Base of the formatters that write compact binary records.
+
+    Every record starts with a pg2kinesis.schema.HEADER naming the formatter
+    and the schema of the record. Each Message carries the schema record of
+    its row too, which the StreamWriter puts in every aggregate ahead of the
+    first row of that schema, and envelopes ahead of their records, so any
+    Kinesis record can be read without the ones before it, on any shard.
+
+    A record holds the xid, the operation and either the primary key or, for
+    full changes, the column values and old key values in schema order.
+    """
+    FORMATTER_ID = None
+    EXACT_NUMERIC = True
+
+    def __init__(self, *args, **kwargs):
+        super(BinaryFormatter, self).__init__(*args, **kwargs)
+        if self.output_plugin == 'wal2json':
+            # wal2json writes numeric values as JSON numbers, which only
+            # Decimals hold without losing digits.
+            self.codec = DecimalJsonCodec()
+        self.schemas = SchemaCache()
+        # The schema record of each TableSchema, by schema id.
+        self._schema_records = {}
+
+    def produce_formatted_message(self, change):
+        table_schema = self._schema_of(change)
+        fmt_msg = pack_header(self.FORMATTER_ID, RECORD_KIND, table_schema) + self.encode(table_schema,
+                                                                                         *self._fields(change))
+        return Message(change=change, fmt_msg=fmt_msg, schema=self._schema_records[table_schema.schema_id])
+
+    def produce_envelope(self, xid, part, final, messages):
+        """
+        A header of kind ENVELOPE_KIND followed by the varints xid, part, final
+        and the number of records, then each record prefixed with its length
+        as a varint. The schema record of every schema in the envelope comes
+        ahead of the first record of that schema.
+        """
+        records = []
+        schemas = set()
+        for message in messages:
+            if message.schema is not None and message.schema not in schemas:
+                schemas.add(message.schema)
+                records.append(message.schema)
+            records.append(message.fmt_msg)
+
+        envelope = bytearray(HEADER.pack(HEADER_MAGIC, self.FORMATTER_ID, ENVELOPE_KIND, 0))
+        envelope += _varint(int(xid or 0)) + _varint(part) + _varint(int(final)) + _varint(len(records))
+        for record in records:
+            envelope += _varint(len(record))
+            envelope += record
+        return bytes(envelope)
+
+    def _envelope_frame_bytes(self, xid):
+        # The record count, a varint, takes up to 2 more bytes below 2 million records.
+        return super(BinaryFormatter, self)._envelope_frame_bytes(xid) + 2
+
+    def _envelope_record_bytes(self, record):
+        return len(_varint(len(record))) + len(record)
+
+    def _schema_of(self, change):
+        """
+        :return: the TableSchema of change, its schema record built the
+            first time the schema is seen.
+        """
+        table_schema, is_new = self._row_schema(change)
+        if is_new:
+            self._schema_records[table_schema.schema_id] = (
+                pack_header(self.FORMATTER_ID, SCHEMA_KIND, table_schema) + self.encode_schema(table_schema))
+        return table_schema
+
+    def _row_schema(self, change):
+        if isinstance(change, FullChange):
+            row = change.change
+            oldkeys = row.get('oldkeys', {})
+            return self.schemas.get('{}.{}'.format(row['schema'], row['table']),
+                                    tuple(zip(row.get('columnnames', ()), row.get('columntypes', ()))),
+                                    tuple(zip(oldkeys.get('keynames', ()), oldkeys.get('keytypes', ()))))
+
+        primary_key = self.primary_key_map.get(change.table)
+        key_columns = tuple(zip(primary_key.col_names, primary_key.col_types)) if primary_key else ()
+        return self.schemas.get(change.table, (), key_columns)
+
+    @staticmethod
+    def _fields(change):
+        """
+        :return: xid, operation, primary key, column values and old key values.
+        """
+        xid = int(change.xid or 0)
+        if isinstance(change, FullChange):
+            row = change.change
+            return xid, row['kind'], None, row.get('columnvalues'), row.get('oldkeys', {}).get('keyvalues')
+        return xid, change.operation, change.pkey, None, None
+
+    def _typed(self, kind, value):
+        if kind == 'long':
+            return int(value)
+        if kind == 'double':
+            return float(value)
+        if kind == 'boolean':
+            return bool(value)
+        if isinstance(value, Decimal):
+            return '{}'.format(value)
+        return value if isinstance(value, type('')) else self.codec.dumps(value)
+
+    def encode_schema(self, table_schema):
+        return self.codec.dumps_bytes({'id': table_schema.schema_id,
+                                       'table': table_schema.table,
+                                       'columns': [list(col) for col in table_schema.columns],
+                                       'key_columns': [list(col) for col in table_schema.key_columns]})
+
+    def _row(self, columns, row):
+        if row is None:
+            return None
+        return [None if value is None else self._typed(_value_kind(col_type), value)
+                for (_, col_type), value in zip(columns, row)]
+
+    def encode(self, table_schema, xid, operation, pkey, values, old_values):
+        """
+        :return: the record, by default a JSON array of
+            [xid, operation, pkey, column values, old key values].
+        """
+        return self.codec.dumps_bytes([xid, operation, pkey, self._row(table_schema.columns, values),
+                                       self._row(table_schema.key_columns, old_values)])
+
+
+class MsgPackFormatter(BinaryFormatter):
+    """
+    Records are a MessagePack array of
+        [xid, operation, pkey, column values, old key values]
+    with the values in the order of the schema's columns and key columns,
+    each a long, double, boolean or string like in the other binary formats.
+    """
+    FORMATTER_ID = 1
+
+    def __init__(self, *args, **kwargs):
+        if msgpack is None:
+            raise ImportError('The MsgPack formatter needs the msgpack package')
+        super(MsgPackFormatter, self).__init__(*args, **kwargs)
+
+    def encode(self, table_schema, xid, operation, pkey, values, old_values):
+        return msgpack.packb([xid, operation, pkey, self._row(table_schema.columns, values),
+                              self._row(table_schema.key_columns, old_values)], use_bin_type=True)
+
+
+class ProtobufFormatter(BinaryFormatter):
+    """
+    Records are encoded as this protocol buffers message, values are in the
+    order of the schema's columns and key columns:
+
+        message Value {
+            oneof value {           // None set for NULL
+                sint64 long = 1;
+                double double = 2;
+                bool boolean = 3;
+                string string = 4;
+            }
+        }
+
+        message Change {
+            uint64 xid = 1;
+            string operation = 2;
+            repeated Value columns = 3;
+            repeated Value old_keys = 4;
+            string pkey = 5;
+        }
+    """
+    FORMATTER_ID = 2
+
+    def _value(self, kind, value):
+        if value is None:
+            return b''
+        value = self._typed(kind, value)
+        if kind == 'long':
+            return b'\x08' + _varint(_zigzag(value))
+        if kind == 'double':
+            return b'\x11' + struct.pack(str('<d'), value)
+        if kind == 'boolean':
+            return b'\x18\x01' if value else b'\x18\x00'
+        return self._bytes_field(b'\x22', value.encode('utf-8'))
+
+    @staticmethod
+    def _bytes_field(tag, data):
+        return tag + _varint(len(data)) + data
+
+    def encode(self, table_schema, xid, operation, pkey, values, old_values):
+        out = bytearray()
+        if xid:
+            out += b'\x08' + _varint(xid)
+        out += self._bytes_field(b'\x12', operation.encode('utf-8'))
+        for tag, columns, row in ((b'\x1a', table_schema.columns, values),
+                                  (b'\x22', table_schema.key_columns, old_values)):
+            for (_, col_type), value in zip(columns, row or ()):
+                out += self._bytes_field(tag, self._value(_value_kind(col_type), value))
+        if pkey is not None:
+            out += self._bytes_field(b'\x2a', pkey.encode('utf-8'))
+        return bytes(out)
+
+
+class AvroFormatter(BinaryFormatter):
+    """
+    Records are Avro binary encoded, schema records hold the Avro schema
+    of each table as JSON. Every column is a nullable field named after the
+    column, with the original name and type in pg_name and pg_type.
+    """
+    FORMATTER_ID = 3
+    AVRO_TYPES = {'long': 'long', 'double': 'double', 'boolean': 'boolean', 'string': 'string'}
+
+    def avro_schema(self, table_schema):
+        name = _avro_name(table_schema.table)
+        return {
+            'type': 'record',
+            'name': name,
+            'namespace': 'pg2kinesis',
+            'pg2kinesis_schema_id': table_schema.schema_id,
+            'fields': [
+                {'name': 'xid', 'type': 'long'},
+                {'name': 'operation', 'type': 'string'},
+                {'name': 'pkey', 'type': ['null', 'string']},
+                {'name': 'columns', 'type': ['null', self._avro_row(name + '_columns', table_schema.columns)]},
+                {'name': 'oldkeys', 'type': ['null', self._avro_row(name + '_oldkeys', table_schema.key_columns)]},
+            ],
+        }
+
+    def _avro_row(self, name, columns):
+        fields = []
+        seen = set()
+        for i, (col_name, col_type) in enumerate(columns):
+            field = _avro_name(col_name)
+            if field in seen:
+                field = '{}_{}'.format(field, i)
+            seen.add(field)
+            fields.append({'name': field, 'type': ['null', self.AVRO_TYPES[_value_kind(col_type)]],
+                           'pg_name': col_name, 'pg_type': col_type})
+        return {'type': 'record', 'name': name, 'fields': fields}
+
+    def encode_schema(self, table_schema):
+        return self.codec.dumps_bytes(self.avro_schema(table_schema))
+
+    def _string(self, value):
+        data = value.encode('utf-8')
+        return _varint(len(data) << 1) + data
+
+    def _value(self, kind, value):
+        # Nullable values are a union of null, index 0, and the value, index 1.
+        if value is None:
+            return b'\x00'
+        value = self._typed(kind, value)
+        if kind == 'long':
+            return b'\x02' + _varint(_zigzag(value))
+        if kind == 'double':
+            return b'\x02' + struct.pack(str('<d'), value)
+        if kind == 'boolean':
+            return b'\x02\x01' if value else b'\x02\x00'
+        return b'\x02' + self._string(value)
+
+    def encode(self, table_schema, xid, operation, pkey, values, old_values):
+        out = bytearray(_varint(_zigzag(xid)))
+        out += self._string(operation)
+        out += self._value('string', pkey)
+        for columns, row in ((table_schema.columns, values), (table_schema.key_columns, old_values)):
+            if row is None:
+                out += b'\x00'
+            else:
+                out += b'\x02'
+                for (_, col_type), value in zip(columns, row):
+                    out += self._value(_value_kind(col_type), value)
+        return bytes(out)
+
 
-def get_formatter(name, primary_key_map, output_plugin, full_change, table_pat):
+def get_formatter(name, primary_key_map, output_plugin, full_change, table_pat, **kwargs):
     formatter_f = getattr(sys.modules[__name__], '%sFormatter' % name)
-    return formatter_f(primary_key_map, output_plugin, full_change, table_pat)
+    return formatter_f(primary_key_map, output_plugin, full_change, table_pat, **kwargs)
@@ -0,0 +1,62 @@
+from collections import deque
+import itertools
+import threading
+
+
+class LsnLedger(object):
+    """
+    Keeps every change from the moment it is read until all the messages it
+    produced have been delivered to Kinesis, so that the LSN we acknowledge
+    never runs ahead of undelivered data.
+
+    Changes are tracked in replication order and each one gets a token. The
+    writer hands the tokens of the messages inside an aggregate back to
+    delivered once that aggregate is sent. flushed_lsn is the LSN of the last
+    change that, along with every change before it, has been fully delivered.
+    This holds no matter how many aggregates or batches are in flight or in
+    what order they complete.
+    """
+
+    def __init__(self):
+        self.flushed_lsn = 0
+        self._order = deque()
+        self._outstanding = {}
+        self._tokens = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._order)
+
+    def track(self, lsn, msg_count):
+        """
+        :param lsn: the LSN of the change
+        :param msg_count: the number of messages produced from the change.
+        :return: the token to pass along with each of those messages.
+        """
+        with self._lock:
+            token = next(self._tokens)
+            self._order.append((token, lsn))
+            self._outstanding[token] = msg_count
+            self._advance()
+
+        return token
+
+    def delivered(self, tokens):
+        """
+        :param tokens: the token of every message that was delivered, one
+            entry per message.
+        :return: the flushed LSN after accounting for the delivery.
+        """
+        with self._lock:
+            for token in tokens:
+                if token is not None:
+                    self._outstanding[token] -= 1
+            self._advance()
+
+            return self.flushed_lsn
+
+    def _advance(self):
+        while self._order and not self._outstanding[self._order[0][0]]:
+            token, lsn = self._order.popleft()
+            del self._outstanding[token]
+            self.flushed_lsn = max(self.flushed_lsn, lsn)
@@ -0,0 +1,387 @@
+"""
+Counters, gauges and histograms describing replication and publishing,
+exposed in the Prometheus text format over HTTP and/or pushed to StatsD.
+
+The metrics pg2kinesis keeps are defined at the bottom of this module and
+updated from where the work happens. Values that already live elsewhere,
+like the depth of the send queue, are gauges read when metrics are collected.
+"""
+from __future__ import division
+from bisect import bisect_left
+from contextlib import contextmanager
+import socket
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from .log import logger
+
+# Seconds, for the stage latency histograms.
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    TYPE = None
+
+    def __init__(self, name, help_text, labelnames=(), labels=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._labels = labels
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        """
+        :return: the child of this metric with the given label values.
+        """
+        key = tuple((name, labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._child(key))
+        return child
+
+    def _child(self, labels):
+        return type(self)(self.name, self.help, labels=labels, **self._child_kwargs())
+
+    def _child_kwargs(self):
+        return {}
+
+    def _metrics(self):
+        return list(self._children.values()) if self.labelnames else [self]
+
+    def samples(self):
+        """
+        :return: (name suffix, labels, value) of every sample of the metric.
+        """
+        return [sample for metric in self._metrics() for sample in metric._samples()]
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name, help_text, labelnames=(), labels=()):
+        super(Counter, self).__init__(name, help_text, labelnames, labels)
+        self.value = 0
+        self._function = None
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set_function(self, function):
+        """
+        Reads the count from function when collected, for counts kept elsewhere.
+        """
+        self._function = function
+
+    def get(self):
+        return self._function() if self._function is not None else self.value
+
+    def take(self):
+        """
+        Starts the count over, for counts kept in another process and added
+        to the one metrics are collected in.
+
+        :return: the count since the last take.
+        """
+        with self._lock:
+            value, self.value = self.value, 0
+        return value
+
+    def _samples(self):
+        return [('', self._labels, self.get())]
+
+
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, labelnames, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0
+        self.count = 0
+
+    def _child_kwargs(self):
+        return {'buckets': self.buckets[:-1]}
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def take(self):
+        """
+        Starts the histogram over, see Counter.take.
+
+        :return: (bucket counts, sum, count) since the last take, for merge.
+        """
+        with self._lock:
+            taken = (self.counts, self.sum, self.count)
+            self.counts, self.sum, self.count = [0] * len(self.buckets), 0, 0
+        return taken
+
+    def merge(self, taken):
+        """
+        Adds what take returned in another process.
+        """
+        counts, total, count = taken
+        with self._lock:
+            self.counts = [mine + theirs for mine, theirs in zip(self.counts, counts)]
+            self.sum += total
+            self.count += count
+
+    @contextmanager
+    def time(self):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started)
+
+    def _samples(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append(('_bucket', self._labels + (('le', _format_value(bound)),), cumulative))
+        samples.append(('_sum', self._labels, total))
+        samples.append(('_count', self._labels, count))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets=buckets))
+
+    def __iter__(self):
+        return iter(self._metrics)
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.TYPE))
+            for suffix, labels, value in metric.samples():
+                lines.append('{}{}{} {}'.format(metric.name, suffix, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class PrometheusServer(object):
+    """
+    Serves registry.render() to GET /metrics from a daemon thread.
+    """
+
+    def __init__(self, registry, port, host=''):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = HTTPServer((host, port), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='pg2kinesis-metrics')
+        self._thread.daemon = True
+
+    def start(self):
+        logger.info('Serving metrics on port %s' % self.port)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class StatsdReporter(object):
+    """
+    Pushes the registry to StatsD over UDP every interval seconds. Counters,
+    and the counts and sums of histograms, are sent as the change since the
+    last push, gauges as their value.
+    """
+
+    def __init__(self, registry, host, port=8125, prefix='pg2kinesis', interval=10):
+        self.registry = registry
+        self.address = (host, port)
+        self.prefix = prefix
+        self.interval = interval
+        self._last = {}
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='pg2kinesis-statsd')
+        self._thread.daemon = True
+
+    def start(self):
+        logger.info('Pushing metrics to StatsD at %s:%s' % self.address)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.push()
+            except Exception as e:
+                logger.warning('Unable to push metrics to StatsD: %s' % e)
+
+    def _name(self, metric, suffix, labels):
+        # pg2kinesis_stage_seconds{stage="put"} _count -> <prefix>.stage_seconds.put.count
+        name = metric.name[len('pg2kinesis_'):] if metric.name.startswith('pg2kinesis_') else metric.name
+        parts = [self.prefix, name] + [str(value) for _, value in labels]
+        if suffix:
+            parts.append(suffix.lstrip('_'))
+        return '.'.join(parts)
+
+    def lines(self):
+        """
+        :return: the StatsD lines for the current values, remembering what was
+            sent so counters go out as deltas.
+        """
+        lines = []
+        for metric in self.registry:
+            for suffix, labels, value in metric.samples():
+                if suffix == '_bucket':
+                    continue
+                name = self._name(metric, suffix, labels)
+                if metric.TYPE == 'gauge':
+                    lines.append('{}:{}|g'.format(name, _format_value(value)))
+                else:
+                    delta = value - self._last.get(name, 0)
+                    self._last[name] = value
+                    if delta:
+                        lines.append('{}:{}|c'.format(name, _format_value(delta)))
+        return lines
+
+    def push(self):
+        lines = self.lines()
+        # Keep datagrams under a typical MTU.
+        packet = []
+        for line in lines + [None]:
+            if line is None or sum(len(l) + 1 for l in packet) + len(line) > 1400:
+                if packet:
+                    self._socket.sendto('\n'.join(packet).encode('utf-8'), self.address)
+                packet = []
+            if line is not None:
+                packet.append(line)
+
+
+REGISTRY = Registry()
+
+MESSAGES_CONSUMED = REGISTRY.counter('pg2kinesis_messages_consumed_total',
+                                     'Replication messages read from the slot.')
+BYTES_CONSUMED = REGISTRY.counter('pg2kinesis_bytes_consumed_total',
+                                  'Bytes of replication messages read from the slot.')
+CHANGES_FORMATTED = REGISTRY.counter('pg2kinesis_changes_formatted_total',
+                                     'Records the formatter produced.')
+STAGE_SECONDS = REGISTRY.histogram('pg2kinesis_stage_seconds',
+                                   'Seconds spent in each stage: decode, format, aggregate and put.',
+                                   labelnames=('stage',))
+DECODE_SECONDS = STAGE_SECONDS.labels(stage='decode')
+FORMAT_SECONDS = STAGE_SECONDS.labels(stage='format')
+AGGREGATE_SECONDS = STAGE_SECONDS.labels(stage='aggregate')
+PUT_SECONDS = STAGE_SECONDS.labels(stage='put')
+RECORDS_PER_AGGREGATE = REGISTRY.histogram('pg2kinesis_records_per_aggregate',
+                                           'Records in each aggregated Kinesis record sent.',
+                                           buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000))
+AGGREGATES_SENT = REGISTRY.counter('pg2kinesis_aggregates_sent_total', 'Aggregated Kinesis records delivered.')
+RECORDS_SENT = REGISTRY.counter('pg2kinesis_records_sent_total', 'Records delivered inside aggregates.')
+BYTES_SENT = REGISTRY.counter('pg2kinesis_bytes_sent_total', 'Bytes of aggregated records delivered.')
+COMPRESSION_BYTES = REGISTRY.counter('pg2kinesis_compression_bytes_total',
+                                     'Bytes of records before (in) and after (out) compression.',
+                                     labelnames=('stage',))
+COMPRESSION_IN = COMPRESSION_BYTES.labels(stage='in')
+COMPRESSION_OUT = COMPRESSION_BYTES.labels(stage='out')
+PUT_RETRIES = REGISTRY.counter('pg2kinesis_put_retries_total', 'Put attempts that had to be retried.')
+THROTTLES = REGISTRY.counter('pg2kinesis_throttles_total',
+                             'Puts Kinesis refused with ProvisionedThroughputExceededException.')
+RATE_LIMITER_WAITED = REGISTRY.counter('pg2kinesis_rate_limiter_waited_seconds_total',
+                                       'Seconds the rate limiter held sends back.')
+# Per pipeline, labeled with the name of the pipeline, its slot unless --config names it.
+QUEUE_DEPTH = REGISTRY.gauge('pg2kinesis_send_queue_depth', 'Changes waiting for the sender threads.',
+                             labelnames=('pipeline',))
+QUEUE_BYTES = REGISTRY.gauge('pg2kinesis_send_queue_bytes', 'Bytes of changes waiting for the sender threads.',
+                             labelnames=('pipeline',))
+SPOOL_BYTES = REGISTRY.gauge('pg2kinesis_spool_bytes', 'Bytes of the spool segments on disk.',
+                             labelnames=('pipeline',))
+SPOOL_UNDRAINED_BYTES = REGISTRY.gauge('pg2kinesis_spool_undrained_bytes',
+                                       'Bytes written to the spool and not yet delivered to Kinesis.',
+                                       labelnames=('pipeline',))
+PENDING_CHANGES = REGISTRY.gauge('pg2kinesis_pending_changes', 'Changes read but not yet fully delivered.',
+                                 labelnames=('pipeline',))
+FLUSHED_LSN = REGISTRY.gauge('pg2kinesis_flushed_lsn', 'The last LSN acknowledged to Postgres.',
+                             labelnames=('pipeline',))
+SLOT_LAG_BYTES = REGISTRY.gauge('pg2kinesis_slot_lag_bytes', 'WAL written since the LSN the slot confirmed.',
+                                labelnames=('pipeline',))
+SLOT_LAG_SECONDS = REGISTRY.gauge('pg2kinesis_slot_lag_seconds', 'How long ago the server wrote the confirmed LSN.',
+                                  labelnames=('pipeline',))
+SLOT_RETAINED_BYTES = REGISTRY.gauge('pg2kinesis_slot_retained_bytes', 'WAL the server keeps for the slot.',
+                                     labelnames=('pipeline',))
+ADAPTIVE_SEND_WINDOW = REGISTRY.gauge('pg2kinesis_adaptive_send_window_seconds',
+                                      'The send window the adaptive controller chose.',
+                                      labelnames=('pipeline',))
+ADAPTIVE_AGGREGATE_BYTES = REGISTRY.gauge('pg2kinesis_adaptive_aggregate_bytes',
+                                          'The size the adaptive controller has aggregates filled to.',
+                                          labelnames=('pipeline',))
+ADAPTIVE_IN_FLIGHT = REGISTRY.gauge('pg2kinesis_adaptive_in_flight',
+                                    'The sends the adaptive controller lets the asyncio engine run at once.',
+                                    labelnames=('pipeline',))
+ADAPTIVE_ADJUSTMENTS = REGISTRY.counter('pg2kinesis_adaptive_adjustments_total',
+                                        'Changes of the adaptive controller, by the mode it changed to.',
+                                        labelnames=('pipeline', 'mode'))
@@ -0,0 +1,189 @@
+from collections import deque
+import multiprocessing
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from .formatter import get_formatter
+from .log import logger
+from .metrics import CHANGES_FORMATTED, DECODE_SECONDS, FORMAT_SECONDS
+from .slot import PrimaryKeyResolver
+
+# The formatter of a worker process, built by _init_worker.
+_formatter = None
+
+
+def _init_worker(make_formatter):
+    global _formatter
+    _formatter = make_formatter()
+    # Forked with whatever the parent had counted.
+    _take_metrics()
+
+
+def _take_metrics():
+    return DECODE_SECONDS.take(), FORMAT_SECONDS.take(), CHANGES_FORMATTED.take()
+
+
+def _format(payload):
+    # Rows read outside of the slot come as the arguments of format_row.
+    if isinstance(payload, tuple):
+        return _formatter.format_row(*payload)
+    return _formatter(payload)
+
+
+def _format_batch(payloads):
+    """
+    :return: the formatted messages of every payload and what formatting
+        them added to the metrics of the worker, for the parent to record.
+    """
+    return [_format(payload) for payload in payloads], _take_metrics()
+
+
+def _record_metrics(taken):
+    decode_seconds, format_seconds, changes_formatted = taken
+    DECODE_SECONDS.merge(decode_seconds)
+    FORMAT_SECONDS.merge(format_seconds)
+    CHANGES_FORMATTED.inc(changes_formatted)
+
+
+class FormatterFactory(object):
+    """
+    Builds a formatter in a worker process. Takes the arguments of
+    get_formatter, except that the primary keys come from their own
+    connection to db_config unless a primary_key_map is given.
+    """
+
+    def __init__(self, name, output_plugin, full_change, table_pat, db_config=None, primary_key_map=None,
+                 **kwargs):
+        self.name = name
+        self.output_plugin = output_plugin
+        self.full_change = full_change
+        self.table_pat = table_pat
+        self.db_config = db_config
+        self.primary_key_map = primary_key_map
+        self.kwargs = kwargs
+
+    def __call__(self):
+        primary_key_map = self.primary_key_map
+        if primary_key_map is None:
+            conn = psycopg2.connect(**self.db_config)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+            def execute_and_fetch(sql, *params):
+                with conn.cursor() as cur:
+                    cur.execute(sql, params or None)
+                    return cur.fetchall()
+
+            primary_key_map = PrimaryKeyResolver(execute_and_fetch)
+
+        return get_formatter(self.name, primary_key_map, self.output_plugin, self.full_change, self.table_pat,
+                             **self.kwargs)
+
+
+class FormatterPool(object):
+    """
+    Formats payloads in worker processes, to get past the GIL, and hands the
+    results back in the order the payloads were submitted, so in LSN order.
+
+    Every worker has a formatter of its own, so only formatters that keep no
+    state from one payload to the next can be spread over them: see
+    Formatter.parallel_safe. The binary formatters build each schema record
+    once per worker rather than once, which is harmless as schema ids are
+    stable.
+
+    Payloads go to the workers in batches of about batch_bytes, as a task
+    and its results cost a round trip through pickle and the pool's queues
+    that outweighs formatting a small payload. A batch is sent early once it
+    is batch_wait seconds old, or when dispatch is called. The decode and format
+    metrics the workers keep come back with the results.
+    """
+
+    def __init__(self, make_formatter, workers, max_pending=None, batch_bytes=256 * 1024, batch_wait=.05):
+        """
+        :param make_formatter: a picklable callable returning a formatter.
+        :param workers: the number of worker processes.
+        :param max_pending: the payloads formatted ahead of the oldest one
+            before completed waits on it. Defaults to 1024 per worker.
+        """
+        logger.info('Starting %s formatter processes' % workers)
+        self.batch_bytes = batch_bytes
+        self.batch_wait = batch_wait
+        self.max_pending = max_pending or workers * 1024
+        self._pool = multiprocessing.Pool(workers, _init_worker, (make_formatter,))
+        # (item, payload) of the batch being filled.
+        self._batch = []
+        self._batch_size = 0
+        self._batch_started = 0
+        # (items, AsyncResult) of the batches sent to the workers.
+        self._pending = deque()
+        self._pending_payloads = 0
+
+    def __len__(self):
+        return self._pending_payloads + len(self._batch)
+
+    def submit(self, item, payload):
+        """
+        Formats payload in a worker. item comes back with the result.
+        """
+        self._add(item, payload, len(payload))
+
+    def submit_row(self, item, schema, table, columns):
+        """
+        Formats a row read outside of the slot in a worker, see
+        Formatter.format_row. item comes back with the result.
+        """
+        self._add(item, (schema, table, columns), sum(len(value) for _, _, value in columns if value is not None))
+
+    def _add(self, item, payload, size):
+        if not self._batch:
+            self._batch_started = time.time()
+        self._batch.append((item, payload))
+        self._batch_size += size
+        if self._batch_size >= self.batch_bytes or time.time() - self._batch_started >= self.batch_wait:
+            self.dispatch()
+
+    def dispatch(self):
+        """
+        Sends the batch being filled to the workers, for when no more
+        payloads are coming for a while.
+        """
+        if not self._batch:
+            return
+        items, payloads = zip(*self._batch)
+        self._pending.append((items, self._pool.apply_async(_format_batch, (payloads,))))
+        self._pending_payloads += len(items)
+        self._batch = []
+        self._batch_size = 0
+
+    def completed(self, keep=None):
+        """
+        Yields (item, formatted messages) in submission order for as long as
+        the oldest payload is done, first waiting on it while more than keep
+        are pending.
+
+        :param keep: how many may stay pending, max_pending by default, 0 to
+            wait for everything.
+        """
+        keep = self.max_pending if keep is None else keep
+        if len(self) > keep:
+            self.dispatch()
+        while self._pending:
+            items, result = self._pending[0]
+            if len(self) <= keep and not result.ready():
+                break
+            self._pending.popleft()
+            self._pending_payloads -= len(items)
+            # Raises what the worker raised.
+            results, taken = result.get()
+            _record_metrics(taken)
+            for item, fmt_msgs in zip(items, results):
+                yield item, fmt_msgs
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
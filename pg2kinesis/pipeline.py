@@ -0,0 +1,234 @@
+from collections import deque
+import threading
+
+from .log import logger
+
+
+class QueueClosed(Exception):
+    pass
+
+
+class ByteQueue(object):
+    """
+    A FIFO bounded by the combined size of its items rather than their count.
+
+    put blocks while the queue holds max_bytes or more. An item larger than
+    max_bytes is still accepted once the queue is empty so it can never wedge.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = deque()
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item, size):
+        with self._cond:
+            while self._items and self.bytes + size > self.max_bytes and not self._closed:
+                self._cond.wait()
+
+            if self._closed:
+                raise QueueClosed()
+
+            self._items.append((item, size))
+            self.bytes += size
+            self._cond.notify_all()
+
+    def get(self):
+        """
+        :return: the oldest item or None once the queue is closed and drained.
+        """
+        with self._cond:
+            while not self._items and not self._closed:
+                self._cond.wait()
+
+            if not self._items:
+                return None
+
+            item, size = self._items.popleft()
+            self.bytes -= size
+            self._cond.notify_all()
+            return item
+
+    def close(self, drop=False):
+        with self._cond:
+            self._closed = True
+            if drop:
+                self._items.clear()
+                self.bytes = 0
+            self._cond.notify_all()
+
+
+class SendOrder(object):
+    """
+    The sends of a writer waiting for their turn, in the order they were
+    collected. A send may start once no earlier send to any of its shards is
+    waiting or under way, so sends to different shards overlap while each
+    shard still gets its records in order.
+
+    Shards are what StreamWriter.shards_of says. Not thread safe.
+    """
+
+    def __init__(self):
+        self._waiting = deque()
+        self._busy = set()
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def add(self, shards, send):
+        self._waiting.append((shards, send))
+
+    def take(self):
+        """
+        :return: (shards, send) of the oldest send that may start or None.
+            Its shards are busy until done is called with them.
+        """
+        blocked = set(self._busy)
+        for i, (shards, send) in enumerate(self._waiting):
+            if blocked.isdisjoint(shards):
+                del self._waiting[i]
+                self._busy.update(shards)
+                return shards, send
+            blocked.update(shards)
+        return None
+
+    def done(self, shards):
+        self._busy.difference_update(shards)
+
+
+class SenderPool(object):
+    """
+    Background threads that drain formatted messages into a StreamWriter so
+    the replication reader never blocks on Kinesis for longer than it takes
+    to hand a message to the queue.
+
+    One thread aggregates the messages in the order they were read and the
+    senders send what it collects, in parallel only across shards, see
+    SendOrder. Deliveries are reported by the writer to its LsnLedger, so the
+    reader can acknowledge whatever the ledger says was delivered.
+    """
+
+    def __init__(self, writer, max_bytes, senders=1):
+        """
+        :param senders: the sends under way at once, which need a shard each.
+        """
+        self.writer = writer
+        self.queue = ByteQueue(max_bytes)
+        self.error = None
+
+        if senders > 1:
+            writer.load_shards()
+        # Collected sends waiting for a sender before the collector waits too.
+        self._max_waiting = 2 * senders
+        self._order = SendOrder()
+        self._collected = False
+        self._stopped = False
+        self._cond = threading.Condition()
+
+        self._threads = []
+        for name, target in [('collector', self._collect)] + [('sender-%s' % i, self._send) for i in range(senders)]:
+            thread = threading.Thread(target=target, name='pg2kinesis-%s' % name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, token, fmt_msgs, size):
+        if self.error is not None:
+            raise self.error
+
+        try:
+            self.queue.put((token, fmt_msgs), size)
+        except QueueClosed:
+            if self.error is not None:
+                raise self.error
+            raise
+
+    def close(self):
+        """
+        Lets the senders drain what is queued and waits for them to exit.
+        """
+        self.queue.close()
+        for thread in self._threads:
+            thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def terminate(self):
+        """
+        Drops what is queued, lets the sends under way finish and waits for
+        the threads to exit. What was dropped is still in the ledger, so it
+        was never acknowledged.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self.queue.close(drop=True)
+        for thread in self._threads:
+            thread.join()
+
+    def _fail(self, e):
+        with self._cond:
+            if self.error is None:
+                logger.exception('Sender failed, stopping the pipeline')
+                self.error = e
+            self._cond.notify_all()
+        self.queue.close(drop=True)
+
+    def _collect(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+
+                token, fmt_msgs = item
+                for fmt_msg in fmt_msgs:
+                    for records, tokens in self.writer.collect(fmt_msg, token):
+                        if records:
+                            self._add(records, tokens)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            with self._cond:
+                self._collected = True
+                self._cond.notify_all()
+
+    def _add(self, records, tokens):
+        shards = self.writer.shards_of(records)
+        with self._cond:
+            while len(self._order) >= self._max_waiting and self.error is None and not self._stopped:
+                self._cond.wait()
+            if self.error is not None:
+                raise self.error
+            if self._stopped:
+                return
+            self._order.add(shards, (records, tokens))
+            self._cond.notify_all()
+
+    def _send(self):
+        while True:
+            with self._cond:
+                taken = None
+                while self.error is None and not self._stopped:
+                    taken = self._order.take()
+                    if taken is not None or (self._collected and not len(self._order)):
+                        break
+                    self._cond.wait()
+            if taken is None:
+                return
+
+            shards, (records, tokens) = taken
+            try:
+                self.writer.send(records, tokens)
+            except Exception as e:
+                self._fail(e)
+                return
+            with self._cond:
+                self._order.done(shards)
+                self._cond.notify_all()
@@ -0,0 +1,171 @@
+from __future__ import division
+import threading
+import time
+
+from .log import logger
+
+# Write limits of a single Kinesis shard.
+SHARD_BYTES_PER_SEC = 1024 * 1024
+SHARD_RECORDS_PER_SEC = 1000
+
+
+class TokenBucket(object):
+    """
+    A token bucket that may go into debt: reserve always takes the tokens
+    and returns how long the caller has to wait before it is paid back.
+    """
+
+    def __init__(self, rate, burst=1.0, clock=time.time):
+        self._clock = clock
+        self._last = clock()
+        self.rate = rate
+        self.capacity = rate * burst
+        self.tokens = self.capacity
+        self._burst = burst
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self, amount):
+        self._refill()
+        self.tokens -= amount
+        return max(0, -self.tokens / self.rate)
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = rate
+        self.capacity = rate * self._burst
+        self.tokens = min(self.tokens, self.capacity)
+
+
+class ShardRateLimiter(object):
+    """
+    Paces writes to each shard so they stay under its byte and record limits
+    instead of waiting for Kinesis to throttle us.
+
+    Each shard starts at fraction of its limits. A throttle halves the
+    shard's rate, down to floor, and every successful write wins back
+    recovery of it, up to fraction. That way the limiter settles just below
+    whatever the shard actually sustains, e.g. when other producers share it.
+    """
+
+    def __init__(self, bytes_per_sec=SHARD_BYTES_PER_SEC, records_per_sec=SHARD_RECORDS_PER_SEC,
+                 fraction=1.0, floor=.05, recovery=.01, report_interval=60, clock=time.time, sleep=time.sleep):
+        self.bytes_per_sec = bytes_per_sec
+        self.records_per_sec = records_per_sec
+        self.fraction = fraction
+        self.floor = floor
+        self.recovery = recovery
+
+        self.throttles = 0
+        self.waited = 0.0
+        self.report_interval = report_interval
+        self._last_report = clock()
+
+        self._clock = clock
+        self._sleep = sleep
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    def _shard(self, shard_id):
+        shard = self._shards.get(shard_id)
+        if shard is None:
+            shard = self._shards[shard_id] = [
+                self.fraction,
+                TokenBucket(self.bytes_per_sec * self.fraction, clock=self._clock),
+                TokenBucket(self.records_per_sec * self.fraction, clock=self._clock),
+            ]
+        return shard
+
+    def _scale(self, shard, scale):
+        shard[0] = scale
+        shard[1].set_rate(self.bytes_per_sec * scale)
+        shard[2].set_rate(self.records_per_sec * scale)
+
+    def acquire(self, shard_id, nbytes, nrecords=1):
+        """
+        Blocks until shard_id has room for nbytes in nrecords records.
+
+        :return: the seconds spent waiting.
+        """
+        with self._lock:
+            _, byte_bucket, record_bucket = self._shard(shard_id)
+            wait = max(byte_bucket.reserve(nbytes), record_bucket.reserve(nrecords))
+            self.waited += wait
+
+            now = self._clock()
+            report = now - self._last_report >= self.report_interval
+            if report:
+                self._last_report = now
+
+        if report:
+            self.report()
+
+        if wait:
+            logger.debug('Pacing shard %s: sleeping %.3fs' % (shard_id, wait))
+            self._sleep(wait)
+
+        return wait
+
+    def throttled(self, shard_id):
+        with self._lock:
+            shard = self._shard(shard_id)
+            self._scale(shard, max(self.floor, shard[0] / 2))
+            self.throttles += 1
+
+        logger.warning('Shard %s throttled, slowing down to %.0f bytes/s' % (shard_id, shard[1].rate))
+
+    def succeeded(self, shard_id):
+        with self._lock:
+            shard = self._shard(shard_id)
+            if shard[0] < self.fraction:
+                self._scale(shard, min(self.fraction, shard[0] + self.recovery))
+
+    def for_stream(self, stream_name):
+        """
+        :return: a view of this limiter for the writers of stream_name. Shard
+            ids repeat from stream to stream, so the view keys its shards by
+            stream as well, letting writers of several streams share the limiter.
+        """
+        return StreamRateLimiter(self, stream_name)
+
+    def report(self):
+        rates = self.rates()
+        slowest = min(rate[0] for rate in rates.values()) if rates else self.bytes_per_sec * self.fraction
+        logger.info('Rate limiter: shards: %s slowest: %.0f bytes/s throttles: %s waited: %.1fs' %
+                    (len(rates), slowest, self.throttles, self.waited))
+
+    def rates(self):
+        """
+        :return: {shard_id: (bytes/s, records/s)} as currently paced.
+        """
+        with self._lock:
+            return {shard_id: (shard[1].rate, shard[2].rate) for shard_id, shard in self._shards.items()}
+
+
+class StreamRateLimiter(object):
+    """
+    The shards of one stream of a ShardRateLimiter, see for_stream.
+    """
+
+    def __init__(self, limiter, stream_name):
+        self.limiter = limiter
+        self.stream_name = stream_name
+
+    def _key(self, shard_id):
+        return '{}/{}'.format(self.stream_name, shard_id)
+
+    @property
+    def waited(self):
+        return self.limiter.waited
+
+    def acquire(self, shard_id, nbytes, nrecords=1):
+        return self.limiter.acquire(self._key(shard_id), nbytes, nrecords)
+
+    def throttled(self, shard_id):
+        self.limiter.throttled(self._key(shard_id))
+
+    def succeeded(self, shard_id):
+        self.limiter.succeeded(self._key(shard_id))
@@ -0,0 +1,69 @@
+from __future__ import unicode_literals
+from collections import namedtuple
+import struct
+import zlib
+
+# The shape of the rows of a table as a binary formatter writes them.
+# columns and key_columns are tuples of (name, type).
+TableSchema = namedtuple('TableSchema', 'schema_id, table, columns, key_columns')
+
+# Prefixes every binary record: magic, formatter, record kind and schema id.
+HEADER = struct.Struct(str('>BBBI'))
+HEADER_MAGIC = 0xb7
+RECORD_KIND = 0
+SCHEMA_KIND = 1
+# A transaction's records, see BinaryFormatter.produce_envelope. Its schema id is 0.
+ENVELOPE_KIND = 2
+
+
+def schema_id(table, columns, key_columns):
+    """
+    An id that only depends on the shape of the rows, so it is the same
+    across restarts and across pg2kinesis instances.
+    """
+    text = '{}|{}|{}'.format(table, ','.join('{}:{}'.format(*col) for col in columns),
+                             ','.join('{}:{}'.format(*col) for col in key_columns))
+    return zlib.crc32(text.encode('utf-8')) & 0xffffffff
+
+
+def pack_header(formatter_id, kind, table_schema):
+    return HEADER.pack(HEADER_MAGIC, formatter_id, kind, table_schema.schema_id)
+
+
+def unpack_header(data):
+    """
+    :return: formatter id, record kind, schema id and the payload that follows.
+    """
+    magic, formatter_id, kind, sid = HEADER.unpack_from(data)
+    if magic != HEADER_MAGIC:
+        raise ValueError('Not a pg2kinesis binary record')
+    return formatter_id, kind, sid, data[HEADER.size:]
+
+
+class SchemaCache(object):
+    """
+    Remembers the schema of every row shape seen, so a schema, and its
+    schema record, is built only the first time a shape shows up. A table
+    gets a new schema when its columns change.
+    """
+
+    def __init__(self):
+        self._schemas = {}
+
+    def __len__(self):
+        return len(self._schemas)
+
+    def get(self, table, columns, key_columns):
+        """
+        :param table: the schema qualified table name
+        :param columns: tuple of (name, type) of the row's columns
+        :param key_columns: tuple of (name, type) of its key
+        :return: the TableSchema and whether it was new.
+        """
+        key = (table, columns, key_columns)
+        try:
+            return self._schemas[key], False
+        except KeyError:
+            table_schema = TableSchema(schema_id(table, columns, key_columns), table, columns, key_columns)
+            self._schemas[key] = table_schema
+            return table_schema, True
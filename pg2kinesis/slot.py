@@ -1,5 +1,7 @@
-from collections import namedtuple
+from collections import deque, namedtuple
+import select
 import threading
+import time
 
 import psycopg2
 import psycopg2.extras
@@ -7,33 +9,281 @@ import psycopg2.extensions
 import psycopg2.errorcodes
 
 from .log import logger
+from .metrics import SLOT_LAG_BYTES, SLOT_LAG_SECONDS, SLOT_RETAINED_BYTES
+from .tables import tables_re, wal2json_tables
 
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE, None)
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY, None)
 
-PrimaryKeyMapItem = namedtuple('PrimaryKeyMapItem', 'table_name, col_name, col_type, col_ord_pos')
 
+class PrimaryKeyMapItem(namedtuple('PrimaryKeyMapItem', 'table_name, col_name, col_type, col_ord_pos')):
+    """
+    The primary key of a table. For a composite key col_name, col_type and
+    col_ord_pos are tuples with an entry per key column, in key order.
+    """
+    __slots__ = ()
 
-class SlotReader(object):
+    @property
+    def col_names(self):
+        return self.col_name if isinstance(self.col_name, tuple) else (self.col_name,)
+
+    @property
+    def col_types(self):
+        return self.col_type if isinstance(self.col_type, tuple) else (self.col_type,)
+
+
+def _merge_key_columns(rows):
+    """
+    Folds the rows of a primary key query, one per key column in key order,
+    into a PrimaryKeyMapItem per table.
+    """
+    pk_map = {}
+    for rec in map(PrimaryKeyMapItem._make, rows):
+        prev = pk_map.get(rec.table_name)
+        if prev is not None and prev.col_name is not None:
+            # Another column of a composite key.
+            rec = PrimaryKeyMapItem(rec.table_name,
+                                    *(p + (r,) if isinstance(p, tuple) else (p, r)
+                                      for p, r in zip(prev[1:], rec[1:])))
+        pk_map[rec.table_name] = rec
+    return pk_map
+
+
+def _quote_ident(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+class PrimaryKeyResolver(object):
+    """
+    Looks up the primary key of a table in pg_catalog the first time a change
+    to it is seen and caches it, so tables created after start up are found
+    too. It is used like the dictionary primary_key_map used to be: tables
+    that do not exist raise KeyError, ones without a primary key map to an
+    item whose columns are None.
+    """
     PK_SQL = """
-    SELECT CONCAT(table_schema, '.', table_name), column_name, data_type, ordinal_position
-    FROM information_schema.tables
-    LEFT JOIN (
-        SELECT CONCAT(table_schema, '.', table_name), column_name, data_type, c.ordinal_position,
-                    table_catalog, table_schema, table_name
-        FROM information_schema.table_constraints
-        JOIN information_schema.key_column_usage AS kcu
-            USING (constraint_catalog, constraint_schema, constraint_name,
-                        table_catalog, table_schema, table_name)
-        JOIN information_schema.columns AS c
-            USING (table_catalog, table_schema, table_name, column_name)
-        WHERE constraint_type = 'PRIMARY KEY'
-    ) as q using (table_catalog, table_schema, table_name)
-    ORDER BY ordinal_position;
+    SELECT %s, a.attname, format_type(a.atttypid, NULL), a.attnum
+    FROM pg_catalog.pg_class AS c
+    LEFT JOIN pg_catalog.pg_index AS i ON i.indrelid = c.oid AND i.indisprimary
+    LEFT JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, ord) ON true
+    LEFT JOIN pg_catalog.pg_attribute AS a ON a.attrelid = c.oid AND a.attnum = k.attnum
+    WHERE c.oid = to_regclass(%s)
+    ORDER BY k.ord;
+    """
+
+    def __init__(self, execute_and_fetch):
+        self._execute_and_fetch = execute_and_fetch
+        self._cache = {}
+        # Sender threads look keys up to partition on them.
+        self._lock = threading.Lock()
+        self.lookups = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, table_name):
+        return self.get(table_name) is not None
+
+    def __getitem__(self, table_name):
+        try:
+            return self._cache[table_name]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if table_name not in self._cache:
+                item = self._lookup(table_name)
+                if item is None:
+                    raise KeyError(table_name)
+                self._cache[table_name] = item
+            return self._cache[table_name]
+
+    def get(self, table_name, default=None):
+        try:
+            return self[table_name]
+        except KeyError:
+            return default
+
+    def invalidate(self, table_name=None):
+        """
+        Forgets the key of table_name, or of every table, so it is looked up again.
+        """
+        with self._lock:
+            if table_name is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(table_name, None)
+
+    def refresh(self, table_name):
+        """
+        Looks the key of table_name up again, for a change that did not match
+        the cached one, e.g. after an ALTER TABLE.
+
+        :return: the new item, None if the table is gone.
+        """
+        self.invalidate(table_name)
+        return self.get(table_name)
+
+    def _lookup(self, table_name):
+        schema, _, table = table_name.partition('.')
+        regclass = '{}.{}'.format(_quote_ident(schema), _quote_ident(table)) if table else _quote_ident(schema)
+
+        logger.info('Getting primary key of {}'.format(table_name))
+        self.lookups += 1
+        return _merge_key_columns(self._execute_and_fetch(self.PK_SQL, table_name, regclass)).get(table_name)
+
+
+class LagMonitor(object):
+    """
+    Polls how far the slot is behind the server from a background thread.
+
+    byte_lag is the WAL written since the LSN the slot last confirmed and
+    retained_bytes the WAL the server keeps for the slot from its restart LSN.
+    seconds_lag is how long ago the server was writing the confirmed LSN, as
+    far as the polls tell, so it is only as fine as interval.
+
+    Listeners are called with the monitor after every poll. With pipeline
+    the lag is exported as metrics labeled with it.
+    """
+    LAG_SQL = """
+    SELECT {diff}({current}(), '0/0')::bigint,
+           {diff}({flushed}, '0/0')::bigint,
+           {diff}(restart_lsn, '0/0')::bigint
+    FROM pg_catalog.pg_replication_slots
+    WHERE slot_name = %s;
+    """
+    MAX_SAMPLES = 10000
+
+    def __init__(self, execute_and_fetch, slot_name, server_version, interval=10, warn_bytes=1024 ** 3,
+                 clock=time.time, pipeline=None):
+        self._execute_and_fetch = execute_and_fetch
+        self.slot_name = slot_name
+        self.pipeline = pipeline
+        self.interval = interval
+        self.warn_bytes = warn_bytes
+        self.listeners = []
+
+        if server_version >= 100000:
+            self.sql = self.LAG_SQL.format(diff='pg_wal_lsn_diff', current='pg_current_wal_lsn',
+                                           flushed='confirmed_flush_lsn')
+        else:
+            # 9.4 and 9.5 have no confirmed_flush_lsn.
+            self.sql = self.LAG_SQL.format(diff='pg_xlog_location_diff', current='pg_current_xlog_location',
+                                           flushed='confirmed_flush_lsn' if server_version >= 90600
+                                           else 'restart_lsn')
+
+        self.current_lsn = None
+        self.flushed_lsn = None
+        self.byte_lag = 0
+        self.retained_bytes = 0
+        self.seconds_lag = 0.0
+
+        # (time, server LSN) of the polls the slot has not caught up with yet.
+        self._samples = deque(maxlen=self.MAX_SAMPLES)
+        self._clock = clock
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='pg2kinesis-lag')
+        self._thread.daemon = True
+
+    def start(self):
+        logger.info('Polling the lag of slot %s every %ss' % (self.slot_name, self.interval))
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logger.warning('Unable to poll the lag of slot %s: %s' % (self.slot_name, e))
+
+    def poll(self):
+        rows = self._execute_and_fetch(self.sql, self.slot_name)
+        if not rows:
+            logger.warning('Slot %s was not found.' % self.slot_name)
+            return
+
+        current, flushed, restart = rows[0]
+        if flushed is None:
+            flushed = restart
+        now = self._clock()
+
+        self._samples.append((now, current))
+        while self._samples and self._samples[0][1] <= flushed:
+            self._samples.popleft()
+
+        self.current_lsn = current
+        self.flushed_lsn = flushed
+        self.byte_lag = max(0, current - flushed)
+        self.retained_bytes = max(0, current - restart) if restart is not None else self.byte_lag
+        self.seconds_lag = now - self._samples[0][0] if self._samples else 0.0
+
+        if self.pipeline is not None:
+            SLOT_LAG_BYTES.labels(pipeline=self.pipeline).set(self.byte_lag)
+            SLOT_LAG_SECONDS.labels(pipeline=self.pipeline).set(self.seconds_lag)
+            SLOT_RETAINED_BYTES.labels(pipeline=self.pipeline).set(self.retained_bytes)
+
+        lag_msg = 'Slot %s lag: %s bytes, %.0fs. Retaining %s bytes of WAL.' % (
+            self.slot_name, self.byte_lag, self.seconds_lag, self.retained_bytes)
+        if self.byte_lag >= self.warn_bytes:
+            logger.warning(lag_msg)
+        else:
+            logger.info(lag_msg)
+
+        for listener in self.listeners:
+            listener(self)
+
+
+def parse_lsn(lsn):
+    """
+    :param lsn: an LSN as Postgres prints it, e.g. '16/B374D848'.
+    :return: the LSN as a number, as psycopg2 gives it.
+    """
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def format_lsn(lsn):
+    return '{:X}/{:X}'.format(lsn >> 32, lsn & 0xffffffff)
+
+
+# What SlotReader.catch_up gives consume, shaped like a streamed message.
+PeekedMessage = namedtuple('PeekedMessage', 'payload, data_start, data_size, cursor')
+
+
+class PeekCursor(object):
+    """
+    Stands in for the replication cursor while catching up: notes the LSN
+    consume acknowledges, for the slot to be advanced to.
     """
 
+    def __init__(self):
+        self.flush_lsn = 0
+
+    def send_feedback(self, flush_lsn=0, **kwargs):
+        self.flush_lsn = max(self.flush_lsn, flush_lsn)
+
+
+class SlotReader(object):
+    PUBLICATION_EXISTS_SQL = "SELECT 1 FROM pg_catalog.pg_publication WHERE pubname = %s;"
+    TABLES_SQL = """
+    SELECT n.nspname, c.relname
+    FROM pg_catalog.pg_class AS c
+    JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+    WHERE c.relkind IN ('r', 'p') AND n.nspname NOT IN ('pg_catalog', 'information_schema');
+    """
+    # Decoding stops at the first commit after upto_nchanges rows, so batches hold whole transactions.
+    PEEK_SQL = "SELECT * FROM pg_logical_slot_peek_binary_changes(%s, NULL, %s, VARIADIC %s::text[]);"
+    CONSUME_SQL = "SELECT count(*) FROM pg_logical_slot_get_binary_changes(%s, %s::pg_lsn, NULL, VARIADIC %s::text[]);"
+    ADVANCE_SQL = "SELECT * FROM pg_replication_slot_advance(%s, %s::pg_lsn);"
+
     def __init__(self, database, host, port, user, sslmode, slot_name,
-                 output_plugin='test_decoding'):
+                 output_plugin='test_decoding', wal2json_format_version=1,
+                 wal2json_write_in_chunks=False, publication_names='pg2kinesis', tables=None,
+                 exclude_tables=None):
         # Cool fact: using connections as context manager doesn't close them on
         # success after leaving with block
         self._db_confg = dict(database=database, host=host, port=port, user=user, sslmode=sslmode)
@@ -42,6 +292,13 @@ class SlotReader(object):
         self._normal_conn = None
         self.slot_name = slot_name
         self.output_plugin = output_plugin
+        self.wal2json_format_version = wal2json_format_version
+        self.wal2json_write_in_chunks = wal2json_write_in_chunks
+        self.publication_names = publication_names
+        self.tables = tables
+        self.exclude_tables = exclude_tables
+        self._primary_key_map = None
+        self.lag_monitor = None
         self.cur_lag = 0
 
     def __enter__(self):
@@ -56,6 +313,8 @@ class SlotReader(object):
         """
         Be a good citizen and try to clean up on the way out.
         """
+        if self.lag_monitor is not None:
+            self.lag_monitor.stop()
 
         try:
             self._repl_cursor.close()
@@ -76,6 +335,10 @@ class SlotReader(object):
         return psycopg2.connect(connection_factory=connection_factory,
                                 cursor_factory=cursor_factory, **self._db_confg)
 
+    def _execute(self, sql, *params):
+        with self._normal_conn.cursor() as cur:
+            cur.execute(sql, params or None)
+
     def _execute_and_fetch(self, sql, *params):
         with self._normal_conn.cursor() as cur:
             if params:
@@ -85,16 +348,57 @@ class SlotReader(object):
 
             return cur.fetchall()
 
+    @property
+    def db_config(self):
+        """
+        What to connect to, for others opening connections of their own.
+        """
+        return dict(self._db_confg)
+
     @property
     def primary_key_map(self):
-        logger.info('Getting primary key map')
-        result = map(PrimaryKeyMapItem._make, self._execute_and_fetch(SlotReader.PK_SQL))
-        pk_map = {rec.table_name: rec for rec in result}
+        """
+        Primary keys are looked up, and cached, as tables are first seen.
+        """
+        if self._primary_key_map is None:
+            self._primary_key_map = PrimaryKeyResolver(self._execute_and_fetch)
+        return self._primary_key_map
+
+    def start_lag_monitor(self, interval=10, warn_bytes=1024 ** 3, pipeline=None):
+        """
+        Starts polling the lag of the slot on the normal connection. cur_lag
+        follows the byte lag.
+
+        :param pipeline: the label of the lag metrics, the slot name by default.
+        :return: the LagMonitor, for others to read the lag from or listen to.
+        """
+        self.lag_monitor = LagMonitor(self._execute_and_fetch, self.slot_name, self._normal_conn.server_version,
+                                      interval, warn_bytes, pipeline=pipeline or self.slot_name)
+        self.lag_monitor.listeners.append(self._set_lag)
+        return self.lag_monitor.start()
 
-        return pk_map
+    def _set_lag(self, lag_monitor):
+        self.cur_lag = lag_monitor.byte_lag
 
-    def create_slot(self):
+    def create_slot(self, export_snapshot=False):
+        """
+        :param export_snapshot: also export the snapshot the slot starts from,
+            for Backfill. The slot must not exist yet. The snapshot lasts until
+            the replication connection is next used, e.g. to start replication.
+        :return: the name of the snapshot when exporting it.
+        """
         logger.info('Creating slot %s' % self.slot_name)
+        if export_snapshot:
+            # psycopg2's create_replication_slot drops the result, which names the snapshot.
+            # It is exported without asking before Postgres 10.
+            export = ' EXPORT_SNAPSHOT' if self._repl_conn.server_version >= 100000 else ''
+            self._repl_cursor.execute('CREATE_REPLICATION_SLOT {} LOGICAL {}{}'.format(
+                _quote_ident(self.slot_name), self.output_plugin, export))
+            _, consistent_point, snapshot_name, _ = self._repl_cursor.fetchone()
+            logger.info('Slot %s starts at %s, exported snapshot %s' %
+                        (self.slot_name, consistent_point, snapshot_name))
+            return snapshot_name
+
         try:
             self._repl_cursor.create_replication_slot(self.slot_name,
                                                       slot_type=psycopg2.extras.REPLICATION_LOGICAL,
@@ -107,6 +411,44 @@ class SlotReader(object):
             else:
                 logger.info('Slot %s is already present.' % self.slot_name)
 
+    def create_publication(self):
+        """
+        Creates each of the comma separated publication_names pgoutput
+        streams that does not exist, for the tables matching tables and
+        exclude_tables as they are now, or for all tables. Tables created
+        later have to be added to them by hand.
+        """
+        target = None
+        for name in (name.strip() for name in self.publication_names.split(',')):
+            if not name:
+                continue
+            if self._execute_and_fetch(self.PUBLICATION_EXISTS_SQL, name):
+                logger.info('Publication %s is already present.' % name)
+                continue
+
+            if target is None:
+                target = self._publication_target()
+            logger.info('Creating publication %s%s' % (name, target))
+            self._execute('CREATE PUBLICATION {}{}'.format(_quote_ident(name), target))
+
+    def _publication_target(self):
+        """
+        :return: what a new publication is FOR.
+        """
+        if not (self.tables or self.exclude_tables):
+            return ' FOR ALL TABLES'
+
+        include = tables_re(self.tables or [('*', '*')])
+        exclude = tables_re(self.exclude_tables)
+        names = []
+        for schema, table in self._execute_and_fetch(self.TABLES_SQL):
+            full_table = '{}.{}'.format(schema, table)
+            if include.match(full_table) and not (exclude and exclude.match(full_table)):
+                names.append('{}.{}'.format(_quote_ident(schema), _quote_ident(table)))
+        if not names:
+            logger.warning('No tables match, the publication will be empty.')
+        return ' FOR TABLE ' + ', '.join(names) if names else ''
+
     def delete_slot(self):
         logger.info('Deleting slot %s' % self.slot_name)
         try:
@@ -119,11 +461,124 @@ class SlotReader(object):
             else:
                 logger.info('Slot %s was not found.' % self.slot_name)
 
-    def process_replication_stream(self, consume):
-        logger.info('Starting the consumption of slot "%s"!' % self.slot_name)
+    def process_replication_stream(self, consume, tick=None, tick_interval=1):
+        """
+        Blocks reading the slot and calling consume with each message.
+
+        Unlike cursor.consume_stream this waits on the socket itself so that
+        tick, if given, is called with the replication cursor at least every
+        tick_interval seconds, whether or not anything arrives.
+        """
+        cursor = self.start_replication()
+
+        next_tick = time.time() + tick_interval
+        while True:
+            msg = cursor.read_message()
+            if msg:
+                consume(msg)
+            else:
+                select.select([cursor], [], [], max(0, next_tick - time.time()))
+
+            if time.time() >= next_tick:
+                if tick is not None:
+                    tick(cursor)
+                next_tick = time.time() + tick_interval
+
+    def _plugin_options(self):
+        """
+        :return: the options of the output plugin, or None.
+        """
         if self.output_plugin == 'wal2json':
             options = {'include-xids': 1}
+            if self.wal2json_format_version == 2:
+                options['format-version'] = 2
+            elif self.wal2json_write_in_chunks:
+                options['write-in-chunks'] = 1
+            # Leave the changes of other tables on the server.
+            if self.tables:
+                options['add-tables'] = wal2json_tables(self.tables)
+            if self.exclude_tables:
+                options['filter-tables'] = wal2json_tables(self.exclude_tables)
+            return options
+        elif self.output_plugin == 'pgoutput':
+            # Publications pick the tables on the server.
+            return {'proto_version': '1', 'publication_names': self.publication_names}
+        return None
+
+    def start_replication(self):
+        """
+        Starts streaming the slot, to be read with read_message.
+
+        wal2json format 2, or format 1 with write-in-chunks, sends a large
+        transaction a row at a time instead of as one message.
+
+        :return: the replication cursor.
+        """
+        logger.info('Starting the consumption of slot "%s"!' % self.slot_name)
+        cursor = self._repl_cursor
+        # Only test_decoding is parsed as text. wal2json payloads go to the JSON
+        # codec as they arrive and pgoutput's are binary.
+        cursor.start_replication(self.slot_name, options=self._plugin_options(),
+                                 decode=self.output_plugin == 'test_decoding')
+        return cursor
+
+    def catch_up(self, consume, max_lag, batch_changes=10000):
+        """
+        Reads the slot over SQL, in batches of about batch_changes changes,
+        for as long as it is max_lag bytes or more behind the server. Peeked
+        changes go to consume, like streamed ones, with a cursor that only
+        notes what consume acknowledges. After every batch consume.flush
+        publishes what is left and the slot is advanced to what was
+        acknowledged, so a crash mid batch peeks it again.
+
+        Streaming pays a round trip and a callback per message, this a query
+        per batch, which is what it takes to get through hours of lag.
+
+        :return: the changes read.
+        """
+        if self.output_plugin == 'pgoutput':
+            logger.warning('pgoutput cannot be read over SQL, streaming instead of catching up')
+            return 0
+
+        lag_monitor = self.lag_monitor or LagMonitor(self._execute_and_fetch, self.slot_name,
+                                                     self._normal_conn.server_version)
+        options = [str(value) for item in sorted((self._plugin_options() or {}).items()) for value in item]
+        cursor = PeekCursor()
+        changes = 0
+
+        while True:
+            lag_monitor.poll()
+            if lag_monitor.byte_lag < max_lag:
+                break
+            logger.info('Slot %s is %s bytes behind, peeking %s changes' %
+                        (self.slot_name, lag_monitor.byte_lag, batch_changes))
+
+            rows = self._execute_and_fetch(self.PEEK_SQL, self.slot_name, batch_changes, options)
+            if not rows:
+                # What is left is WAL of other databases.
+                break
+            for lsn, _, data in rows:
+                payload = bytes(data)
+                if self.output_plugin == 'test_decoding':
+                    payload = payload.decode('utf-8')
+                consume(PeekedMessage(payload, parse_lsn(lsn), len(data), cursor))
+            changes += len(rows)
+
+            consume.flush(cursor)
+            if cursor.flush_lsn:
+                self.advance_slot(cursor.flush_lsn)
+
+        logger.info('Slot %s caught up on %s changes' % (self.slot_name, changes))
+        return changes
+
+    def advance_slot(self, lsn):
+        """
+        Confirms the slot up to lsn, which must end a transaction, without
+        streaming it. Before Postgres 11 that means decoding the changes again
+        and throwing them away.
+        """
+        if self._normal_conn.server_version >= 110000:
+            self._execute_and_fetch(self.ADVANCE_SQL, self.slot_name, format_lsn(lsn))
         else:
-            options = None
-        self._repl_cursor.start_replication(self.slot_name, options=options)
-        self._repl_cursor.consume_stream(consume)
+            options = [str(value) for item in sorted((self._plugin_options() or {}).items()) for value in item]
+            self._execute_and_fetch(self.CONSUME_SQL, self.slot_name, format_lsn(lsn), options)
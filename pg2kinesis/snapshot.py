@@ -0,0 +1,304 @@
+"""
+Backfills the rows that are already in the database when a slot is created.
+
+The slot is created with an exported snapshot, the state of the database
+exactly as of the slot's start point. Workers each open a connection on that
+snapshot and COPY the tables out a range of primary keys at a time. The rows
+are published as inserts through the formatter and writer before streaming
+from the slot starts, so the backfill and the stream line up with neither a
+gap nor an overlap.
+"""
+from __future__ import division
+from collections import namedtuple
+import re
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import psycopg2
+
+from .formatter import INTEGER_TYPES
+from .log import logger
+from .slot import SlotReader, _quote_ident
+
+# A range of a table to COPY. columns is a list of (name, type).
+Chunk = namedtuple('Chunk', 'schema, table, columns, copy_sql')
+
+COLUMNS_SQL = """
+SELECT a.attname, a.atttypid, t.typname, format_type(a.atttypid, NULL), format_type(a.atttypid, a.atttypmod)
+FROM pg_catalog.pg_attribute AS a
+JOIN pg_catalog.pg_type AS t ON t.oid = a.atttypid
+WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+ORDER BY a.attnum;
+"""
+
+# The first key of every chunk_rows keys, in one scan of the primary key index.
+CHUNK_STARTS_SQL = """
+SELECT {key} FROM (
+    SELECT {key}, row_number() OVER (ORDER BY {key}) AS n FROM {relation}
+) AS keys
+WHERE n %% %s = 1
+ORDER BY {key};
+"""
+
+_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+_ESCAPE_RE = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)')
+
+
+def _unescape_match(match):
+    code = match.group(1)
+    if code[0] == 'x' and len(code) > 1:
+        return chr(int(code[1:], 16))
+    if code[0] in '01234567':
+        return chr(int(code, 8))
+    return _ESCAPES.get(code, code)
+
+
+def parse_copy_line(line):
+    """
+    :param line: a row as COPY TO writes it in text format, without the newline.
+    :return: the value of every column, None for NULL.
+    """
+    values = line.split('\t')
+    for i, value in enumerate(values):
+        if value == '\\N':
+            values[i] = None
+        elif '\\' in value:
+            values[i] = _ESCAPE_RE.sub(_unescape_match, value)
+    return values
+
+
+class _CopyRows(object):
+    """
+    The file copy_expert writes a chunk to: cuts what it gets into lines and
+    hands every row to put.
+    """
+
+    def __init__(self, chunk, put):
+        self.chunk = chunk
+        self.put = put
+        self.rows = 0
+        self._partial = b''
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            values = parse_copy_line(line.decode('utf-8'))
+            self.put((self.chunk, [(name, col_type, value)
+                                   for (name, col_type), value in zip(self.chunk.columns, values)]))
+            self.rows += 1
+
+
+class _Stopped(Exception):
+    """
+    Raised in a worker once the backfill stopped taking rows.
+    """
+
+
+class Backfill(object):
+    """
+    Publishes every row of the wanted tables as of snapshot_name.
+
+    Tables with a single integer primary key are split into chunks of
+    chunk_rows rows, between keys read from the table so gaps in the keys
+    make no empty chunks, the others are copied whole. workers connections copy
+    chunks in parallel, each parsing what it reads, while the calling thread
+    formats and writes the rows, or hands them to a FormatterPool. Rows carry
+    xid 0.
+    """
+    # Seconds a worker waits on a full queue before checking it should stop.
+    PUT_WAIT = .1
+    # Seconds a worker is given to stop.
+    JOIN_TIMEOUT = 10
+
+    def __init__(self, db_config, snapshot_name, workers=4, chunk_rows=100000, max_pending=10000,
+                 connect=psycopg2.connect):
+        """
+        :param db_config: the keyword arguments of connect.
+        :param max_pending: rows read ahead of the writer before the workers wait.
+        """
+        self.db_config = db_config
+        self.snapshot_name = snapshot_name
+        self.workers = workers
+        self.chunk_rows = chunk_rows
+        self.max_pending = max_pending
+        self._connect = connect
+
+    def _snapshot_connection(self):
+        conn = self._connect(**self.db_config)
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        with conn.cursor() as cur:
+            # The first statement of the transaction.
+            cur.execute('SET TRANSACTION SNAPSHOT %s', (self.snapshot_name,))
+        return conn
+
+    @staticmethod
+    def _fetch(conn, sql, *params):
+        with conn.cursor() as cur:
+            cur.execute(sql, params or None)
+            return cur.fetchall()
+
+    def chunks(self, conn, formatter):
+        """
+        :param conn: a connection on the snapshot.
+        :return: the Chunks of every table formatter wants, in table order.
+        """
+        chunks = []
+        for schema, table in sorted(self._fetch(conn, SlotReader.TABLES_SQL)):
+            if not formatter.table_wanted(schema, table):
+                continue
+
+            full_table = '{}.{}'.format(schema, table)
+            relation = '{}.{}'.format(_quote_ident(schema), _quote_ident(table))
+            # Typed as the stream types them.
+            columns = [(row[0], formatter.column_type(*row[1:])) for row in self._fetch(conn, COLUMNS_SQL, relation)]
+            select = 'SELECT {} FROM {}'.format(', '.join(_quote_ident(name) for name, _ in columns), relation)
+
+            primary_key = formatter.primary_key_map.get(full_table)
+            if primary_key is None and not formatter.full_change:
+                logger.warning('Skipping %s, it has no primary key' % full_table)
+                continue
+
+            ranges = []
+            if primary_key is not None and len(primary_key.col_names) == 1 and \
+                    primary_key.col_types[0] in INTEGER_TYPES:
+                key = _quote_ident(primary_key.col_names[0])
+                starts = [row[0] for row in self._fetch(conn, CHUNK_STARTS_SQL.format(key=key, relation=relation),
+                                                        self.chunk_rows)]
+                if not starts:
+                    continue
+                for start, end in zip(starts, starts[1:]):
+                    ranges.append('{} WHERE {} >= {} AND {} < {}'.format(select, key, start, key, end))
+                # The snapshot cannot gain rows, so the last chunk is open ended.
+                ranges.append('{} WHERE {} >= {}'.format(select, key, starts[-1]))
+            else:
+                ranges.append(select)
+
+            logger.info('Backfilling %s in %s chunks' % (full_table, len(ranges)))
+            chunks += [Chunk(schema, table, columns, 'COPY ({}) TO STDOUT'.format(sql)) for sql in ranges]
+        return chunks
+
+    def run(self, formatter, writer, format_pool=None):
+        """
+        Blocks until every row is written to writer, which is flushed. If
+        formatting or writing fails the workers are stopped and the error
+        raised.
+
+        :param format_pool: a FormatterPool to format the rows in, rather
+            than formatter on the calling thread.
+        :return: the number of rows.
+        """
+        conn = self._snapshot_connection()
+        try:
+            chunks = self.chunks(conn, formatter)
+        finally:
+            conn.close()
+
+        todo = queue.Queue()
+        for chunk in chunks:
+            todo.put(chunk)
+        rows = queue.Queue(self.max_pending)
+        errors = []
+        stop = threading.Event()
+
+        threads = []
+        for i in range(min(self.workers, len(chunks))):
+            thread = threading.Thread(target=self._work, args=(todo, rows, errors, stop),
+                                      name='pg2kinesis-backfill-%s' % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        started = time.time()
+        try:
+            count = self._publish(formatter, writer, format_pool, rows, len(threads), started)
+        finally:
+            # Unblocks the workers still copying if publishing failed.
+            stop.set()
+            for thread in threads:
+                thread.join(self.JOIN_TIMEOUT)
+                if thread.is_alive():
+                    logger.warning('Backfill worker %s did not stop' % thread.name)
+
+        if errors:
+            raise errors[0]
+        writer.flush()
+        logger.info('Backfilled %s rows of %s chunks in %.0fs' % (count, len(chunks), time.time() - started))
+        return count
+
+    @staticmethod
+    def _publish(formatter, writer, format_pool, rows, workers, started):
+        """
+        Formats and writes rows until every one of workers is done.
+
+        :return: the number of rows.
+        """
+        count = 0
+        finished = 0
+        while finished < workers:
+            try:
+                item = rows.get_nowait()
+            except queue.Empty:
+                if format_pool is not None:
+                    # Nothing more to add to the batch for now.
+                    format_pool.dispatch()
+                item = rows.get()
+            if item is None:
+                finished += 1
+                continue
+            chunk, columns = item
+            if format_pool is None:
+                for fmt_msg in formatter.format_row(chunk.schema, chunk.table, columns):
+                    writer.put_message(fmt_msg)
+            else:
+                format_pool.submit_row(None, chunk.schema, chunk.table, columns)
+                for _, fmt_msgs in format_pool.completed():
+                    for fmt_msg in fmt_msgs:
+                        writer.put_message(fmt_msg)
+            count += 1
+            if not count % 100000:
+                logger.info('Backfilled %s rows, %.0f rows/s' % (count, count / (time.time() - started)))
+
+        if format_pool is not None:
+            for _, fmt_msgs in format_pool.completed(keep=0):
+                for fmt_msg in fmt_msgs:
+                    writer.put_message(fmt_msg)
+        return count
+
+    def _work(self, todo, rows, errors, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    return rows.put(item, timeout=self.PUT_WAIT)
+                except queue.Full:
+                    pass
+            raise _Stopped()
+
+        try:
+            conn = self._snapshot_connection()
+            try:
+                while not errors:
+                    try:
+                        chunk = todo.get_nowait()
+                    except queue.Empty:
+                        break
+                    with conn.cursor() as cur:
+                        cur.copy_expert(chunk.copy_sql, _CopyRows(chunk, put))
+            finally:
+                conn.close()
+        except _Stopped:
+            return
+        except Exception as e:
+            logger.exception('Backfill worker failed')
+            errors.append(e)
+        try:
+            put(None)
+        except _Stopped:
+            pass
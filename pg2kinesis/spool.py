@@ -0,0 +1,371 @@
+"""
+A local disk buffer between formatting and Kinesis.
+
+With a spool the LSN of a change is acknowledged once its messages are on
+local disk rather than once they are in Kinesis, so an outage or throttling
+on the Kinesis side fills the spool instead of the primary's WAL. A drainer
+thread ships the spool to Kinesis in the order it was written.
+"""
+from bisect import bisect_right
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+from .ledger import LsnLedger
+from .log import logger
+
+# Every record is framed by its length and the CRC32 of its payload.
+FRAME = struct.Struct(str('>II'))
+SEGMENT_SUFFIX = '.seg'
+CHECKPOINT = 'checkpoint'
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+class SpoolCorrupt(Exception):
+    pass
+
+
+class SpoolClosed(Exception):
+    pass
+
+
+def _fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Spool(object):
+    """
+    Formatted messages in append-only segment files of framed, pickled
+    Message tuples. Frames are written back to back and never rewritten, so
+    a segment can be read while the next one is written.
+
+    Positions are byte offsets into the spool as a whole, each segment being
+    named after the position it starts at. A record is known by the position
+    it ends at. Readers only see records up to durable_pos, which fsync
+    moves: after every append with 'always', at most every fsync_interval
+    seconds with 'interval', or with 'never' as soon as they are handed to
+    the OS, which survives us crashing but not the host.
+
+    append blocks while the segments on disk take max_bytes or more, until
+    drained lets segments be deleted or the spool is closed.
+    """
+
+    def __init__(self, directory, max_bytes=1024 ** 3, segment_bytes=64 * 1024 ** 2, fsync='interval',
+                 fsync_interval=1.0, clock=time.time):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy "{}", choose from {}'.format(fsync, ', '.join(FSYNC_POLICIES)))
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._closed = False
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.drained_pos = self._read_checkpoint()
+        self._bases = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                             if name.endswith(SEGMENT_SUFFIX))
+        if self._bases:
+            self.write_pos = self._recover(self._bases[-1])
+            self.drained_pos = max(self.drained_pos, self._bases[0])
+        else:
+            self.write_pos = self.drained_pos
+            self._bases.append(self.write_pos)
+
+        self._file = open(self._segment_path(self._bases[-1]), 'ab')
+        self.durable_pos = self.write_pos
+        self._last_sync = clock()
+        logger.info('Spool %s holds %s bytes from position %s' % (directory, self.bytes, self.drained_pos))
+
+    @property
+    def bytes(self):
+        """
+        The bytes of the segments on disk.
+        """
+        return self.write_pos - self._bases[0]
+
+    def _segment_path(self, base):
+        return os.path.join(self.directory, '{:020d}{}'.format(base, SEGMENT_SUFFIX))
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT)) as f:
+                return int(f.read().strip() or 0)
+        except (IOError, OSError):
+            return 0
+
+    def _recover(self, base):
+        """
+        Cuts a torn or corrupt record, from a crash mid write, off the end of
+        the last segment.
+
+        :return: the position the segment ends at.
+        """
+        path = self._segment_path(base)
+        offset = 0
+        with open(path, 'rb') as f:
+            while True:
+                frame = f.read(FRAME.size)
+                if len(frame) < FRAME.size:
+                    break
+                length, crc = FRAME.unpack(frame)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    break
+                offset += FRAME.size + length
+
+        if offset != os.path.getsize(path):
+            logger.warning('Truncating spool segment %s from %s to %s bytes' %
+                           (path, os.path.getsize(path), offset))
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        return base + offset
+
+    def append(self, message):
+        """
+        Writes message to the end of the spool, waiting while it is full.
+
+        :return: the position of the record.
+        :raises SpoolClosed: if the spool is, or was while waiting, closed.
+        """
+        payload = pickle.dumps(message, 2)
+        frame = FRAME.pack(len(payload), zlib.crc32(payload) & 0xffffffff)
+
+        with self._cond:
+            if self.bytes >= self.max_bytes:
+                logger.warning('Spool is full, waiting for it to drain')
+            while self.bytes >= self.max_bytes and not self._closed:
+                self._cond.wait(1)
+            if self._closed:
+                raise SpoolClosed('Spool {} is closed, the message was not written'.format(self.directory))
+
+            self._file.write(frame)
+            self._file.write(payload)
+            self.write_pos += len(frame) + len(payload)
+            position = self.write_pos
+
+            if position - self._bases[-1] >= self.segment_bytes:
+                self._roll()
+            elif self.fsync == 'always':
+                self._sync()
+
+        return position
+
+    def _roll(self):
+        self._sync()
+        self._file.close()
+        self._bases.append(self.write_pos)
+        self._file = open(self._segment_path(self.write_pos), 'ab')
+        if self.fsync != 'never':
+            _fsync_dir(self.directory)
+
+    def _sync(self):
+        self._file.flush()
+        if self.fsync != 'never':
+            os.fsync(self._file.fileno())
+        self._last_sync = self._clock()
+        if self.durable_pos != self.write_pos:
+            self.durable_pos = self.write_pos
+            self._cond.notify_all()
+
+    def sync(self, force=False):
+        """
+        Makes what was appended durable if the fsync policy says it is time.
+
+        :return: durable_pos
+        """
+        with self._cond:
+            if self.write_pos != self.durable_pos and (
+                    force or self.fsync != 'interval' or self._clock() - self._last_sync >= self.fsync_interval):
+                self._sync()
+            return self.durable_pos
+
+    def read(self, position, max_records=500, timeout=1.0):
+        """
+        Waits up to timeout seconds for durable records after position.
+
+        :return: a list of (position, message) of at most max_records of them,
+            in order.
+        """
+        with self._cond:
+            if self.durable_pos <= position and not self._closed:
+                self._cond.wait(timeout)
+            durable_pos = self.durable_pos
+            bases = list(self._bases)
+
+        records = []
+        while position < durable_pos and len(records) < max_records:
+            i = bisect_right(bases, position) - 1
+            if i < 0:
+                raise SpoolCorrupt('Position {} was deleted from the spool'.format(position))
+            base = bases[i]
+            end = min(bases[i + 1], durable_pos) if i + 1 < len(bases) else durable_pos
+
+            with open(self._segment_path(base), 'rb') as f:
+                f.seek(position - base)
+                while position < end and len(records) < max_records:
+                    length, crc = FRAME.unpack(f.read(FRAME.size))
+                    payload = f.read(length)
+                    if zlib.crc32(payload) & 0xffffffff != crc:
+                        raise SpoolCorrupt('Checksum mismatch in spool segment {} at {}'.format(base, position))
+                    position += FRAME.size + length
+                    records.append((position, pickle.loads(payload)))
+        return records
+
+    def drained(self, position):
+        """
+        Records that everything up to position has been delivered: saves the
+        position to start from after a restart and deletes the segments that
+        are wholly delivered.
+        """
+        with self._cond:
+            if position <= self.drained_pos:
+                return
+            self.drained_pos = position
+
+            path = os.path.join(self.directory, CHECKPOINT)
+            with open(path + '.tmp', 'w') as f:
+                f.write(str(position))
+                f.flush()
+                if self.fsync != 'never':
+                    os.fsync(f.fileno())
+            os.rename(path + '.tmp', path)
+
+            while len(self._bases) > 1 and self._bases[1] <= position:
+                os.remove(self._segment_path(self._bases.pop(0)))
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._sync()
+            self._file.close()
+            self._cond.notify_all()
+
+
+class SpoolWriter(object):
+    """
+    Takes the place of the StreamWriter given to Consume. Messages go to the
+    spool and their ledger tokens are handed back once the spool made them
+    durable, which lets the ledger acknowledge their LSNs.
+    """
+
+    def __init__(self, spool, ledger, drainer=None):
+        self.spool = spool
+        self.ledger = ledger
+        self.drainer = drainer
+        self._tokens = []
+        self._pending_pos = 0
+
+    def put_message(self, fmt_msg, token=None):
+        """
+        :param fmt_msg: a formatter Message, or None to only sync if due.
+        :return: the durable position if messages became durable, else None.
+        """
+        if self.drainer is not None and self.drainer.error is not None:
+            raise self.drainer.error
+
+        if fmt_msg:
+            self._pending_pos = self.spool.append(fmt_msg)
+            if token is not None:
+                self._tokens.append(token)
+
+        durable_pos = self.spool.sync()
+        if not self._tokens or durable_pos < self._pending_pos:
+            return None
+
+        tokens, self._tokens = self._tokens, []
+        self.ledger.delivered(tokens)
+        return durable_pos
+
+    def flush(self):
+        """
+        Makes what was appended durable now, whatever the fsync policy.
+        """
+        self.spool.sync(force=True)
+        self.put_message(None)
+
+
+class SpoolDrainer(object):
+    """
+    Ships the spool to Kinesis, in order, from a background thread.
+
+    make_writer is called with an LsnLedger to build the StreamWriter. The
+    spool's checkpoint follows what that ledger says was delivered. When the
+    writer gives up, e.g. during a long Kinesis outage, the drainer waits
+    retry_interval seconds and starts over from the last delivered record
+    with a new writer, so records can be delivered more than once.
+    """
+
+    def __init__(self, spool, make_writer, max_records=500, checkpoint_interval=1.0, retry_interval=5.0):
+        self.spool = spool
+        self.make_writer = make_writer
+        self.max_records = max_records
+        self.checkpoint_interval = checkpoint_interval
+        self.retry_interval = retry_interval
+        self.error = None
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='pg2kinesis-drainer')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.drain()
+            except SpoolCorrupt as e:
+                logger.exception('Spool is corrupt, stopping the drainer')
+                self.error = e
+                return
+            except Exception:
+                logger.exception('Unable to drain the spool, retrying in %ss' % self.retry_interval)
+                self._stopped.wait(self.retry_interval)
+
+    def drain(self):
+        """
+        Sends the spool until stopped or the writer raises.
+        """
+        ledger = LsnLedger()
+        ledger.flushed_lsn = position = self.spool.drained_pos
+        writer = self.make_writer(ledger)
+        last_checkpoint = time.time()
+
+        try:
+            while not self._stopped.is_set():
+                records = self.spool.read(position, self.max_records)
+                for position, message in records:
+                    writer.put_message(message, ledger.track(position, 1))
+                if not records:
+                    # Sends the partial aggregate once the send window lapses.
+                    writer.put_message(None)
+
+                if time.time() - last_checkpoint >= self.checkpoint_interval:
+                    self.spool.drained(ledger.flushed_lsn)
+                    last_checkpoint = time.time()
+        finally:
+            self.spool.drained(ledger.flushed_lsn)
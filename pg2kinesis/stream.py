@@ -1,23 +1,178 @@
+from bisect import bisect_right
+import hashlib
+import threading
 import time
+
 import aws_kinesis_agg.aggregator
 import boto3
 
 from botocore.exceptions import ClientError
 from .log import logger
+from .metrics import (AGGREGATE_SECONDS, AGGREGATES_SENT, BYTES_SENT, COMPRESSION_IN, COMPRESSION_OUT, PUT_RETRIES,
+                      PUT_SECONDS, RECORDS_PER_AGGREGATE, RECORDS_SENT, THROTTLES)
+
+# Service limits for a single PutRecords call.
+PUT_RECORDS_MAX_RECORDS = 500
+PUT_RECORDS_MAX_BYTES = 5 * 1024 * 1024
+MAX_PARTITION_KEY_LENGTH = 256
+
+RETRYABLE_ERRORS = {'ProvisionedThroughputExceededException', 'InternalFailure'}
+
+PARTITION_STRATEGIES = ('xid', 'table', 'pkey', 'table_pkey')
+
+
+def _table_of(change):
+    if hasattr(change, 'table'):
+        return change.table
+    return '{}.{}'.format(change.change['schema'], change.change['table'])
+
+
+def _pkey_of(change, primary_key_map):
+    """
+    The primary key of a Change, or for a FullChange the key columns of the
+    row, falling back to the table so a row without a known key is at least
+    kept in order with the rest of its table.
+    """
+    if hasattr(change, 'pkey'):
+        return change.pkey
+
+    row = change.change
+    if 'oldkeys' in row:
+        return ','.join(str(value) for value in row['oldkeys']['keyvalues'])
+
+    table = _table_of(change)
+    primary_key = primary_key_map.get(table) if primary_key_map is not None else None
+    columnnames = row.get('columnnames', ())
+    if primary_key is not None and all(name in columnnames for name in primary_key.col_names):
+        return ','.join(str(row['columnvalues'][columnnames.index(name)]) for name in primary_key.col_names)
+
+    return table
+
+
+def get_partitioner(name, primary_key_map=None):
+    """
+    :param name: one of PARTITION_STRATEGIES
+    :param primary_key_map: used to find the key of full changes.
+    :return: a function of a change that returns its Kinesis partition key.
+    """
+    if name == 'xid':
+        partition_key = lambda change: str(change.xid)
+    elif name == 'table':
+        partition_key = _table_of
+    elif name == 'pkey':
+        partition_key = lambda change: _pkey_of(change, primary_key_map)
+    elif name == 'table_pkey':
+        partition_key = lambda change: '{}:{}'.format(_table_of(change), _pkey_of(change, primary_key_map))
+    else:
+        raise ValueError('Unknown partition strategy: "{}"'.format(name))
+
+    def bounded(change):
+        key = partition_key(change)
+        if len(key) > MAX_PARTITION_KEY_LENGTH:
+            key = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return key
+
+    return bounded
+
+
+def hash_key_of(partition_key):
+    """
+    The 128 bit hash Kinesis maps partition_key to when choosing a shard.
+    """
+    return int(hashlib.md5(partition_key.encode('utf-8')).hexdigest(), 16)
+
+
+class ShardMap(object):
+    """
+    The open shards of a stream ordered by hash key range.
+    """
+
+    def __init__(self, shards):
+        shards = [s for s in shards if 'EndingSequenceNumber' not in s['SequenceNumberRange']]
+        shards.sort(key=lambda s: int(s['HashKeyRange']['StartingHashKey']))
+
+        self.shard_ids = [s['ShardId'] for s in shards]
+        self._starts = [int(s['HashKeyRange']['StartingHashKey']) for s in shards]
+
+    def __len__(self):
+        return len(self.shard_ids)
+
+    def lookup(self, hash_key):
+        return self.shard_ids[bisect_right(self._starts, hash_key) - 1]
+
+    @classmethod
+    def from_stream(cls, kinesis, stream_name):
+        shards = []
+        result = kinesis.list_shards(StreamName=stream_name)
+        while True:
+            shards.extend(result['Shards'])
+            if not result.get('NextToken'):
+                break
+            result = kinesis.list_shards(NextToken=result['NextToken'])
+
+        return cls(shards)
+
 
 class StreamWriter(object):
-    def __init__(self, stream_name, back_off_limit=60, send_window=13):
+    """
+    Aggregates formatted messages into Kinesis records and sends them.
+
+    By default every aggregate is keyed by the xid of its first message, so
+    the whole aggregate lands on one shard. Given a partition strategy, each
+    message gets its own partition key and the writer keeps an aggregator
+    per open shard, using explicit hash keys so every aggregate goes to the
+    shard whose hash key range holds all of its messages.
+
+    Given a ShardRateLimiter, sends are paced per shard and throttles slow
+    the shard down rather than backing off geometrically. back_off_limit
+    then bounds the seconds a send may spend being throttled.
+
+    Given a BatchController, the writer reports its puts and throttles to it
+    and the controller tunes the send window and aggregate size through tune.
+    """
+    def __init__(self, stream_name, back_off_limit=60, send_window=13, batch_size=1, ledger=None,
+                 partition_by=None, primary_key_map=None, shard_count=1, shard_refresh_interval=60,
+                 rate_limiter=None, compressor=None, kinesis=None, controller=None):
         self.stream_name = stream_name
+        self.ledger = ledger
+        self.rate_limiter = rate_limiter
+        self.controller = controller
+        self.compressor = compressor
         self.back_off_limit = back_off_limit
         self.last_send = 0
 
-        self._kinesis = boto3.client('kinesis')
+        # boto3 clients are thread safe, writers may share one.
+        self._kinesis = kinesis if kinesis is not None else boto3.client('kinesis')
         self._sequence_number_for_ordering = '0'
         self._record_agg = aws_kinesis_agg.aggregator.RecordAggregator()
         self._send_window = send_window
+        self._agg_max_bytes = aws_kinesis_agg.MAX_BYTES_PER_RECORD
+
+        # Aggregators, the ledger tokens of their messages and the schema
+        # records in them by shard. Without a partition strategy there is
+        # one, _record_agg, under None.
+        self._aggs = {None: self._record_agg}
+        self._agg_tokens = {None: []}
+        self._agg_schemas = {None: set()}
+        # Compressed schema records by schema record.
+        self._compressed_schemas = {}
+        self._partition_key = get_partitioner(partition_by, primary_key_map) if partition_by else None
+        self._shards = None
+        self._shard_refresh_interval = shard_refresh_interval
+        self._shards_refreshed = 0
+
+        # Completed aggregates waiting to be shipped in a single PutRecords call.
+        self._batch_size = min(batch_size, PUT_RECORDS_MAX_RECORDS)
+        self._batch = []
+        self._batch_tokens = []
+        self._batch_bytes = 0
+
+        # Guards the aggregator and batch so several sender threads can share
+        # one writer. Network calls happen outside of it.
+        self._lock = threading.Lock()
 
         try:
-            self._kinesis.create_stream(StreamName=stream_name, ShardCount=1)
+            self._kinesis.create_stream(StreamName=stream_name, ShardCount=shard_count)
         except ClientError as e:
             # ResourceInUseException is raised when the stream already exists
             if e.response['Error']['Code'] != 'ResourceInUseException':
@@ -29,46 +184,432 @@ class StreamWriter(object):
         # waits up to 180 seconds for stream to exist
         waiter.wait(StreamName=self.stream_name)
 
-    def put_message(self, fmt_msg):
-        agg_record = None
+        if self._partition_key is not None or self.rate_limiter is not None:
+            self._refresh_shards()
+
+        if self.controller is not None:
+            self.controller.attach(self)
 
+    def put_message(self, fmt_msg, token=None):
+        """
+        Adds fmt_msg to the aggregate of its shard and sends whatever
+        aggregation, batching or the send window says is ready. Safe to call
+        from several threads; only the sends themselves run concurrently.
+
+        :param fmt_msg: a formatter Message or None to only check the send window.
+        :param token: the LsnLedger token of the change fmt_msg came from.
+            Handed back to the ledger once fmt_msg is delivered.
+        :return: what was sent (truthy) or None if nothing was sent.
+        """
+        ready = self.collect(fmt_msg, token)
+        for records, tokens in ready:
+            self.send(records, tokens)
+
+        if self._batch_size > 1:
+            return [agg_record for batch, _ in ready for agg_record in batch] or None
+        return ready[-1][0] if ready else None
+
+    def collect(self, fmt_msg, token=None):
+        """
+        The first half of put_message: aggregates fmt_msg and takes what is
+        ready to send without sending it.
+
+        :return: a list of (records, tokens) to hand to send, records being
+            an aggregate, possibly None, or a batch of them when batching.
+        """
+        if fmt_msg and self.compressor is not None:
+            # Before aggregating, so the record size limits apply to what is sent.
+            fmt_msg = self._compress(fmt_msg)
+
+        started = time.time()
+        with self._lock:
+            if self._batch_size > 1:
+                ready = self._collect_batched(fmt_msg, token)
+            else:
+                ready = self._collect(fmt_msg, token)
         if fmt_msg:
-            agg_record = self._record_agg.add_user_record(str(fmt_msg.change.xid), fmt_msg.fmt_msg)
+            AGGREGATE_SECONDS.observe(time.time() - started)
+        return ready
 
-        # agg_record will be a complete record if aggregation is full.
-        if agg_record or (self._send_window and time.time() - self.last_send > self._send_window):
-            agg_record = agg_record if agg_record else self._record_agg.clear_and_get()
-            self._send_agg_record(agg_record)
+    def send(self, records, tokens):
+        """
+        The second half of put_message, safe to run concurrently: sends what
+        collect took and hands its tokens back to the ledger.
+        """
+        if not records:
+            return
+        if self._batch_size > 1:
+            self._send_agg_records(records)
+        else:
+            self._send_agg_record(records)
+        self._delivered(tokens)
+
+    def flush(self):
+        """
+        Sends every partial aggregate, and batch, now rather than when the
+        send window lapses.
+        """
+        with self._lock:
+            ready = self._clear_and_get_all()
+            if self._batch_size > 1:
+                batches = []
+                for agg_record, tokens in ready:
+                    batches += self._add_to_batch(agg_record, tokens)
+                if self._batch:
+                    batches.append(self._take_batch())
+                ready = batches
             self.last_send = time.time()
 
-        return agg_record
+        for records, tokens in ready:
+            self.send(records, tokens)
+
+    def load_shards(self):
+        """
+        Reads the open shards of the stream, if the writer has not yet, so
+        shards_of can tell the shards of its records apart.
+        """
+        with self._lock:
+            if self._shards is None:
+                self._refresh_shards()
+
+    def shards_of(self, records):
+        """
+        :param records: what collect returned to send.
+        :return: the ids of the shards records go to, a frozenset. {None}
+            when the writer does not know the shards, standing for all of them.
+        """
+        agg_records = records if self._batch_size > 1 else [records]
+        return frozenset(self._shard_of(agg_record.get_partition_key(), agg_record.get_explicit_hash_key())
+                         for agg_record in agg_records)
+
+    def tune(self, send_window, agg_max_bytes):
+        """
+        Changes the send window and the bytes aggregates are filled to. A new
+        size applies from the next aggregate of each shard.
+        """
+        with self._lock:
+            self._send_window = send_window
+            self._agg_max_bytes = agg_max_bytes
+            for agg in self._aggs.values():
+                agg.max_size = agg_max_bytes
+
+    def _compress(self, fmt_msg):
+        data = self.compressor(fmt_msg.fmt_msg)
+        COMPRESSION_IN.inc(len(fmt_msg.fmt_msg))
+        COMPRESSION_OUT.inc(len(data))
+        schema = fmt_msg.schema
+        if schema is not None:
+            if schema not in self._compressed_schemas:
+                self._compressed_schemas[schema] = self.compressor(schema)
+            schema = self._compressed_schemas[schema]
+        return fmt_msg._replace(fmt_msg=data, schema=schema)
+
+    def _delivered(self, tokens):
+        if self.ledger is not None and tokens:
+            self.ledger.delivered(tokens)
+
+    def _refresh_shards(self):
+        """
+        Re-reads the open shards of the stream.
+
+        :return: the partial aggregates, with their tokens, of shards that
+            are no longer open, e.g. after a reshard.
+        """
+        self._shards = ShardMap.from_stream(self._kinesis, self.stream_name)
+        self._shards_refreshed = time.time()
+        logger.info('Stream %s has %s open shards' % (self.stream_name, len(self._shards)))
+
+        closed = []
+        for shard_id in set(self._aggs) - set(self._shards.shard_ids) - {None}:
+            closed.append(self._clear_and_get(shard_id))
+            del self._aggs[shard_id]
+            del self._agg_tokens[shard_id]
+            del self._agg_schemas[shard_id]
+
+        return closed
+
+    def _aggregate(self, fmt_msg, token):
+        """
+        Adds fmt_msg to the aggregate of its shard, after the schema record
+        fmt_msg carries unless the aggregate holds it already, so every
+        aggregate can be read on its own.
+
+        :return: a list of the aggregates adding fmt_msg completed, each with
+            the tokens of the messages inside of it.
+        """
+        if self._partition_key is None:
+            shard_id, partition_key, hash_key = None, str(fmt_msg.change.xid), None
+        else:
+            partition_key = self._partition_key(fmt_msg.change)
+            hash_key = hash_key_of(partition_key)
+            shard_id = self._shards.lookup(hash_key)
+            if shard_id not in self._aggs:
+                self._aggs[shard_id] = aws_kinesis_agg.aggregator.RecordAggregator()
+                self._aggs[shard_id].max_size = self._agg_max_bytes
+                self._agg_tokens[shard_id] = []
+                self._agg_schemas[shard_id] = set()
+            hash_key = str(hash_key)
+
+        completed = []
+        schema = fmt_msg.schema
+        if schema is not None and schema not in self._agg_schemas[shard_id]:
+            completed += self._add_user_record(shard_id, partition_key, schema, hash_key)
+            self._agg_schemas[shard_id].add(schema)
+        agg_completed = self._add_user_record(shard_id, partition_key, fmt_msg.fmt_msg, hash_key)
+        if agg_completed and schema is not None and not completed:
+            # fmt_msg started the next aggregate, which needs the schema first.
+            # Should the two not fit together, the schema record goes in the
+            # aggregate right before fmt_msg on the same shard.
+            self._aggs[shard_id].clear_and_get()
+            completed += agg_completed
+            completed += self._add_user_record(shard_id, partition_key, schema, hash_key)
+            self._agg_schemas[shard_id].add(schema)
+            agg_completed = self._add_user_record(shard_id, partition_key, fmt_msg.fmt_msg, hash_key)
+        completed += agg_completed
+
+        if token is not None:
+            self._agg_tokens[shard_id].append(token)
+        return completed
+
+    def _add_user_record(self, shard_id, partition_key, data, hash_key):
+        """
+        :return: a list holding the completed aggregate, with its tokens, if
+            adding data completed one, else an empty list.
+        """
+        agg_record = self._aggs[shard_id].add_user_record(partition_key, data, hash_key)
+        # agg_record will be a complete record if aggregation is full. It holds
+        # everything but data, which starts the next aggregate.
+        if not agg_record:
+            return []
+        tokens, self._agg_tokens[shard_id] = self._agg_tokens[shard_id], []
+        self._agg_schemas[shard_id] = set()
+        return [(agg_record, tokens)]
+
+    def _clear_and_get(self, shard_id=None):
+        tokens, self._agg_tokens[shard_id] = self._agg_tokens[shard_id], []
+        self._agg_schemas[shard_id] = set()
+        return self._aggs[shard_id].clear_and_get(), tokens
+
+    def _clear_and_get_all(self):
+        return [self._clear_and_get(shard_id) for shard_id in list(self._aggs)]
+
+    def _collect(self, fmt_msg, token=None):
+        """
+        :return: a list of (agg_record, tokens) to send, agg_record may be None.
+        """
+        ready = []
+
+        if fmt_msg:
+            ready += self._aggregate(fmt_msg, token)
+
+        if self._shards is not None and time.time() - self._shards_refreshed > self._shard_refresh_interval:
+            ready += self._refresh_shards()
+
+        if ready or (self._send_window and time.time() - self.last_send > self._send_window):
+            if not ready:
+                ready = self._clear_and_get_all()
+            self.last_send = time.time()
+
+        return ready
+
+    def _collect_batched(self, fmt_msg, token=None):
+        """
+        Like _collect but holds on to completed aggregates until there are
+        enough of them to fill a PutRecords call or the send window lapses.
+
+        :return: a list of (batch, tokens) to send, each batch within the
+            PutRecords limits.
+        """
+        batches = []
+
+        if fmt_msg:
+            for agg_record, tokens in self._aggregate(fmt_msg, token):
+                batches += self._add_to_batch(agg_record, tokens)
+
+        if self._shards is not None and time.time() - self._shards_refreshed > self._shard_refresh_interval:
+            for agg_record, tokens in self._refresh_shards():
+                batches += self._add_to_batch(agg_record, tokens)
+
+        if self._send_window and time.time() - self.last_send > self._send_window:
+            for agg_record, tokens in self._clear_and_get_all():
+                batches += self._add_to_batch(agg_record, tokens)
+            if self._batch:
+                batches.append(self._take_batch())
+
+        return batches
+
+    def _add_to_batch(self, agg_record, tokens=None):
+        """
+        Queues agg_record for the next PutRecords call, taking the current
+        batch first if agg_record would push it past the service limits.
+
+        :return: a list of (batch, tokens) that are ready to send, possibly empty.
+        """
+        ready = []
+        if agg_record is None:
+            return ready
+
+        size = agg_record.get_size_bytes() + len(agg_record.get_partition_key())
+        if self._batch and self._batch_bytes + size > PUT_RECORDS_MAX_BYTES:
+            ready.append(self._take_batch())
+
+        self._batch.append(agg_record)
+        self._batch_tokens += tokens or []
+        self._batch_bytes += size
+
+        if len(self._batch) >= self._batch_size:
+            ready.append(self._take_batch())
+
+        return ready
+
+    def _take_batch(self):
+        batch, tokens = self._batch, self._batch_tokens
+        self._batch = []
+        self._batch_tokens = []
+        self._batch_bytes = 0
+        self.last_send = time.time()
+
+        return batch, tokens
+
+    def _shard_of(self, pk, ehk):
+        if self._shards is None:
+            return None
+        return self._shards.lookup(int(ehk) if ehk else hash_key_of(pk))
+
+    def _back_off(self, back_off, shard_ids, started, error_code='Provisioned throughput exceeded'):
+        """
+        Waits out a throttle on shard_ids.
+
+        :return: the new back off. Sending gives up once it reaches back_off_limit.
+        """
+        PUT_RETRIES.inc()
+        THROTTLES.inc(len(shard_ids))
+        if self.controller is not None and shard_ids:
+            self.controller.throttled()
+        if self.rate_limiter is None or not shard_ids:
+            back_off *= 2
+            logger.warning('%s: sleeping %ss' % (error_code, back_off))
+            time.sleep(back_off)
+            return back_off
+
+        # The limiter paces the retry, all we track is how long we've been at it.
+        for shard_id in set(shard_ids):
+            self.rate_limiter.throttled(shard_id)
+        return max(back_off, time.time() - started)
+
+    def _count_sent(self, agg_records, started):
+        PUT_SECONDS.observe(time.time() - started)
+        if self.controller is not None:
+            self.controller.sent(time.time() - started)
+        for agg_record in agg_records:
+            num_records = agg_record.get_num_user_records()
+            RECORDS_PER_AGGREGATE.observe(num_records)
+            RECORDS_SENT.inc(num_records)
+            BYTES_SENT.inc(agg_record.get_size_bytes())
+        AGGREGATES_SENT.inc(len(agg_records))
 
     def _send_agg_record(self, agg_record):
         if agg_record is None:
             return
 
-        pk, _, data = agg_record.get_contents()
+        pk, ehk, data = agg_record.get_contents()
         logger.info('Sending %s records. Size %s. PK: %s' %
                     (agg_record.get_num_user_records(), agg_record.get_size_bytes(), pk))
 
+        kwargs = {'ExplicitHashKey': ehk} if ehk else {}
+        shard_id = self._shard_of(pk, ehk)
+        started = time.time()
         back_off = .05
         while back_off < self.back_off_limit:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(shard_id, len(data) + len(pk))
             try:
                 result = self._kinesis.put_record(Data=data,
                                                   PartitionKey=pk,
                                                   SequenceNumberForOrdering=self._sequence_number_for_ordering,
-                                                  StreamName=self.stream_name)
+                                                  StreamName=self.stream_name,
+                                                  **kwargs)
 
             except ClientError as e:
                 if e.response['Error']["Code"] == 'ProvisionedThroughputExceededException':
-                    back_off *= 2
-                    logger.warning('Provisioned throughput exceeded: sleeping %ss' % back_off)
-                    time.sleep(back_off)
+                    back_off = self._back_off(back_off, [shard_id], started)
                 else:
                     logger.error(e)
                     raise
             else:
                 logger.debug('Sequence number: %s' % result['SequenceNumber'])
+                if self.rate_limiter is not None:
+                    self.rate_limiter.succeeded(shard_id)
+                self._count_sent([agg_record], started)
                 break
         else:
             raise Exception('ProvisionedThroughputExceededException caused a backed off too many times!')
+
+    def _send_agg_records(self, agg_records):
+        """
+        Sends agg_records in one PutRecords call. Entries Kinesis reports as
+        failed are retried with the same back off as _send_agg_record;
+        entries that succeeded are never resent.
+
+        Note: retried entries may land after later entries of the same batch,
+        so ordering within a batch is only guaranteed when nothing fails.
+        """
+        if not agg_records:
+            return
+
+        entries = []
+        for agg_record in agg_records:
+            pk, ehk, data = agg_record.get_contents()
+            entry = {'Data': data, 'PartitionKey': pk}
+            if ehk:
+                entry['ExplicitHashKey'] = ehk
+            entries.append((self._shard_of(pk, ehk), entry))
+
+        logger.info('Sending %s aggregated records holding %s records. Size %s.' %
+                    (len(agg_records), sum(r.get_num_user_records() for r in agg_records),
+                     sum(r.get_size_bytes() for r in agg_records)))
+
+        started = time.time()
+        back_off = .05
+        while back_off < self.back_off_limit:
+            if self.rate_limiter is not None:
+                for shard_id, entry in entries:
+                    self.rate_limiter.acquire(shard_id, len(entry['Data']) + len(entry['PartitionKey']))
+
+            try:
+                result = self._kinesis.put_records(Records=[entry for _, entry in entries],
+                                                   StreamName=self.stream_name)
+            except ClientError as e:
+                if e.response['Error']["Code"] != 'ProvisionedThroughputExceededException':
+                    logger.error(e)
+                    raise
+                error_code = 'ProvisionedThroughputExceededException'
+                throttled = [shard_id for shard_id, _ in entries]
+            else:
+                failed = []
+                throttled = []
+                for (shard_id, entry), entry_result in zip(entries, result['Records']):
+                    entry_error = entry_result.get('ErrorCode')
+                    if entry_error is None:
+                        if self.rate_limiter is not None:
+                            self.rate_limiter.succeeded(shard_id)
+                        continue
+                    if entry_error not in RETRYABLE_ERRORS:
+                        msg = 'PutRecords failed with %s: %s' % (entry_error, entry_result.get('ErrorMessage'))
+                        logger.error(msg)
+                        raise Exception(msg)
+                    error_code = entry_error
+                    failed.append((shard_id, entry))
+                    if entry_error == 'ProvisionedThroughputExceededException':
+                        throttled.append(shard_id)
+
+                if not failed:
+                    self._count_sent(agg_records, started)
+                    break
+
+                entries = failed
+                logger.warning('%s of the records failed to send' % len(entries))
+
+            back_off = self._back_off(back_off, throttled, started, error_code)
+        else:
+            raise Exception('ProvisionedThroughputExceededException caused a backed off too many times!')
@@ -0,0 +1,41 @@
+"""
+Lists of tables to replicate, as given to --tables and --exclude-tables.
+"""
+from __future__ import unicode_literals
+import re
+
+
+def parse_tables(tables):
+    """
+    Splits a comma separated list of schema.table names, either part of
+    which may be * to match any. A name without a schema matches any schema.
+
+    :return: a list of (schema, table)
+    """
+    result = []
+    for name in (tables or '').split(','):
+        name = name.strip()
+        if name:
+            schema, _, table = name.rpartition('.')
+            result.append((schema or '*', table))
+    return result
+
+
+def tables_re(tables):
+    """
+    :param tables: a list of (schema, table)
+    :return: a regex matching the schema qualified names of the tables, or None.
+    """
+    if not tables:
+        return None
+    return re.compile('|'.join(r'(?:{}\.{})$'.format(*('.*' if part == '*' else re.escape(part) for part in table))
+                               for table in tables))
+
+
+def wal2json_tables(tables):
+    """
+    :return: tables as the add-tables and filter-tables options of wal2json
+        expect them, with its special characters escaped.
+    """
+    return ','.join('.'.join(part if part == '*' else re.sub(r"([\\ ',.*])", r'\\\1', part) for part in table)
+                    for table in tables)
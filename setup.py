@@ -40,6 +40,14 @@ INSTALL_REQUIRES = [
     'protobuf>=3.0.0',
     'psycopg2>=2.7.4',
 ]
+EXTRAS_REQUIRE = {
+    'orjson': ['orjson>=2.0.0'],
+    'ujson': ['ujson>=2.0.0'],
+    'rapidjson': ['python-rapidjson>=0.9.0'],
+    'msgpack': ['msgpack>=0.6.0'],
+    'zstd': ['zstandard>=0.11.0'],
+    'lz4': ['lz4>=2.0.0'],
+}
 
 ###############################################################################
 
@@ -92,6 +100,7 @@ if __name__ == "__main__":
         zip_safe=True,
         classifiers=CLASSIFIERS,
         install_requires=INSTALL_REQUIRES,
+        extras_require=EXTRAS_REQUIRE,
         entry_points={
             'console_scripts': ['pg2kinesis=pg2kinesis.__main__:main'],
         }
@@ -0,0 +1,4 @@
+import sys
+
+# The asyncio engine and its tests need Python 3.5, older ones cannot even parse them.
+collect_ignore = ['test_aio.py'] if sys.version_info < (3, 5) else []
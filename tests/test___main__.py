@@ -1,8 +1,12 @@
 from __future__ import unicode_literals
 
+import click
 from mock import Mock, call, patch
+import pytest
 
-from pg2kinesis.__main__ import Consume
+from pg2kinesis import __main__, metrics
+from pg2kinesis.__main__ import Consume, PipelinedConsume, run_pipelines
+from pg2kinesis.ledger import LsnLedger
 
 def test_consume():
     mock_formatter = Mock(return_value='fmt_msg')
@@ -52,3 +56,299 @@ def test_consume():
     with patch('time.time', mock_time):
         consume(mock_change)
         assert consume.msg_window_size == 100, 'msg_window_size not reset if time is same as cur_window'
+
+
+def test_consume_with_ledger():
+    mock_formatter = Mock(return_value=['msg1', 'msg2'])
+    mock_formatter.cur_xact = 'TEST_TRANSACTION'
+    mock_writer = Mock()
+    ledger = LsnLedger()
+
+    consume = Consume(mock_formatter, mock_writer, ledger)
+
+    mock_change = Mock()
+    mock_change.data_start = 10
+    mock_change.data_size = 100
+    mock_change.payload = 'PAYLOAD'
+
+    consume(mock_change)
+    assert mock_writer.put_message.call_args_list == [call('msg1', 0), call('msg2', 0)]
+    assert not mock_change.cursor.send_feedback.called, 'Nothing delivered yet'
+
+    ledger.delivered([0, 0])
+    mock_formatter.return_value = []
+    mock_change.data_start = 20
+    consume(mock_change)
+    mock_change.cursor.send_feedback.assert_called_once_with(flush_lsn=20)
+    assert consume.flushed_lsn == 20
+
+    consume(mock_change)
+    assert mock_change.cursor.send_feedback.call_count == 1, 'No repeat feedback for the same LSN'
+
+
+def test_pipelined_consume():
+    mock_formatter = Mock(return_value=['fmt_msg'])
+    mock_formatter.cur_xact = 'TEST_TRANSACTION'
+    mock_writer = Mock()
+    ledger = LsnLedger()
+
+    with patch('pg2kinesis.__main__.SenderPool') as mock_pool_cls:
+        consume = PipelinedConsume(mock_formatter, mock_writer, ledger, 1000, 2)
+        mock_pool_cls.assert_called_with(mock_writer, 1000, 2)
+
+    pool = consume.pool
+
+    mock_change = Mock()
+    mock_change.data_start = 10
+    mock_change.data_size = 100
+    mock_change.payload = 'PAYLOAD'
+
+    consume(mock_change)
+    pool.submit.assert_called_with(0, ['fmt_msg'], 100)
+    assert not mock_writer.put_message.called, 'Publishing is left to the senders'
+    assert not mock_change.cursor.send_feedback.called, 'Nothing delivered yet'
+
+    ledger.delivered([0])
+    mock_change.data_start = 20
+    consume(mock_change)
+    mock_change.cursor.send_feedback.assert_called_once_with(flush_lsn=10)
+    assert consume.flushed_lsn == 10
+
+    pool.submit.reset_mock()
+    mock_formatter.return_value = []
+    consume(mock_change)
+    assert not pool.submit.called, 'Nothing to hand off'
+
+
+def test_consume_tick():
+    mock_formatter = Mock(return_value=[])
+    mock_formatter.cur_xact = 'TEST_TRANSACTION'
+    mock_writer = Mock()
+    ledger = LsnLedger()
+    consume = Consume(mock_formatter, mock_writer, ledger, keepalive_interval=10)
+
+    cursor = Mock(spec=['send_feedback', 'wal_end'])
+    cursor.wal_end = 0
+
+    with patch('time.time', return_value=100.0):
+        consume.tick(cursor)
+    mock_writer.put_message.assert_called_with(None)
+    cursor.send_feedback.assert_called_once_with(), 'Keepalive when there is nothing to acknowledge'
+    assert consume.last_feedback == 100.0
+
+    cursor.send_feedback.reset_mock()
+    with patch('time.time', return_value=105.0):
+        consume.tick(cursor)
+    assert not cursor.send_feedback.called, 'Keepalive not due yet'
+
+    token = ledger.track(50, 1)
+    cursor.wal_end = 80
+    with patch('time.time', return_value=106.0):
+        consume.tick(cursor)
+    assert not cursor.send_feedback.called, 'Cannot acknowledge the end of WAL with a change in flight'
+
+    ledger.delivered([token])
+    with patch('time.time', return_value=107.0):
+        consume.tick(cursor)
+    assert cursor.send_feedback.call_args_list == [call(flush_lsn=50), call(flush_lsn=80)], \
+        'Delivered change then the end of WAL once idle'
+    assert consume.flushed_lsn == 80
+
+
+def test_pipelined_consume_tick():
+    mock_formatter = Mock(return_value=[])
+    mock_formatter.cur_xact = 'TEST_TRANSACTION'
+
+    with patch('pg2kinesis.__main__.SenderPool'):
+        consume = PipelinedConsume(mock_formatter, Mock(), LsnLedger(), 1000)
+
+    consume.pool.queue.__len__ = Mock(return_value=0)
+    consume.tick(Mock(spec=['send_feedback']))
+    consume.pool.submit.assert_called_once_with(None, [None], 0), 'Senders are asked to check the send window'
+
+    consume.pool.submit.reset_mock()
+    consume.pool.queue.__len__ = Mock(return_value=3)
+    consume.tick(Mock(spec=['send_feedback']))
+    assert not consume.pool.submit.called, 'Senders are busy anyway'
+
+    consume.format_pool = InlineFormatterPool(mock_formatter)
+    consume.format_pool.submit(Mock(data_start=10, data_size=10), b'payload')
+    cursor = Mock(spec=['send_feedback', 'wal_end'])
+    cursor.wal_end = 100
+    consume.tick(cursor)
+    assert call(flush_lsn=100) not in cursor.send_feedback.call_args_list, \
+        'Cannot acknowledge the end of WAL while a payload is being formatted'
+
+
+class InlineFormatterPool(object):
+    """
+    A FormatterPool whose oldest payload is done only once the next is submitted.
+    """
+    def __init__(self, formatter):
+        self.formatter = formatter
+        self.pending = []
+        self.closed = False
+        self.dispatched = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, item, payload):
+        self.pending.append((item, self.formatter(payload)))
+
+    def dispatch(self):
+        self.dispatched += 1
+
+    def completed(self, keep=None):
+        keep = 1 if keep is None else keep
+        while len(self.pending) > keep:
+            yield self.pending.pop(0)
+
+    def close(self):
+        self.closed = True
+
+
+def test_consume_with_format_pool():
+    mock_formatter = Mock(side_effect=lambda payload: [Mock(change=Mock(xid=payload))])
+    mock_formatter.cur_xact = ''
+    mock_writer = Mock()
+    ledger = LsnLedger()
+    pool = InlineFormatterPool(mock_formatter)
+
+    consume = Consume(Mock(cur_xact=''), mock_writer, ledger, format_pool=pool)
+
+    changes = [Mock(data_start=lsn, data_size=10, payload=lsn) for lsn in (10, 20, 30)]
+    consume(changes[0])
+    assert not mock_writer.put_message.called, 'Still formatting'
+
+    consume(changes[1])
+    consume(changes[2])
+    assert [c[0][1] for c in mock_writer.put_message.call_args_list] == [0, 1], 'Published in LSN order'
+    assert consume.formatter.cur_xact == 20
+
+    ledger.delivered([0, 1])
+    cursor = Mock(spec=['send_feedback', 'wal_end'])
+    cursor.wal_end = 100
+    consume.tick(cursor)
+    assert pool.dispatched == 1, 'A quiet slot sends the batch being filled'
+    assert len(pool) == 1 and not len(ledger)
+    assert call(flush_lsn=100) not in cursor.send_feedback.call_args_list, \
+        'Cannot acknowledge the end of WAL while a payload is being formatted'
+
+    consume.close()
+    assert pool.closed
+    assert [c[0][1] for c in mock_writer.put_message.call_args_list if c[0][0]] == [0, 1, 2]
+
+
+@patch.object(__main__, 'boto3')
+@patch.object(__main__, 'run_pipeline')
+def test_run_pipelines(mock_run_pipeline, mock_boto3):
+    options = {'pg_dbname': 'default', 'pg_slot_name': 'pg2kinesis', 'stream_name': 'default',
+               'rate_limit': False, 'shard_bytes_per_sec': 1000, 'shard_records_per_sec': 10}
+    config = {'defaults': {'rate_limit': True},
+              'pipelines': [{'name': 'orders', 'pg_dbname': 'orders', 'stream_name': 'orders'},
+                            {'pg_dbname': 'users', 'pg_slot_name': 'users', 'rate_limit': False}]}
+
+    runs = []
+
+    def run_pipeline(kinesis, shared_rate_limiter, **options):
+        runs.append(options['pg_dbname'])
+        if options['pg_dbname'] == 'orders' and runs.count('orders') == 1:
+            raise RuntimeError('connection lost')
+
+    mock_run_pipeline.side_effect = run_pipeline
+    with patch.object(__main__.time, 'sleep') as mock_sleep:
+        run_pipelines(config, options)
+
+    assert sorted(runs) == ['orders', 'orders', 'users'], 'The failed pipeline was restarted, alone'
+    mock_sleep.assert_called_once_with(1)
+
+    kinesis = mock_boto3.client.return_value
+    assert mock_boto3.client.call_count == 1, 'One client for all the pipelines'
+    calls = {c[1]['pg_dbname']: c[1] for c in mock_run_pipeline.call_args_list}
+    orders, users = calls['orders'], calls['users']
+    assert orders['kinesis'] is users['kinesis'] is kinesis
+    assert orders['stream_name'] == 'orders'
+    assert orders['pg_slot_name'] == 'pg2kinesis', 'Pipelines default to the options'
+    assert orders['shard_bytes_per_sec'] == 1000
+    assert orders['shared_rate_limiter'].bytes_per_sec == 1000, 'Defaults apply to every pipeline'
+    assert users['stream_name'] == 'default'
+    assert users['shared_rate_limiter'] is None, 'Pipelines override the defaults'
+    assert (orders['pipeline'], users['pipeline']) == ('orders', 'users'), 'Named, or after their slot'
+    assert not orders['watch_metrics']
+
+    mock_run_pipeline.reset_mock()
+    mock_run_pipeline.side_effect = None
+    run_pipelines(config, options, watch_metrics=True)
+    assert all(c[1]['watch_metrics'] for c in mock_run_pipeline.call_args_list)
+
+
+@patch.object(__main__, 'run_pipeline')
+def test_run_pipelines_unknown_option(mock_run_pipeline):
+    with pytest.raises(click.UsageError):
+        run_pipelines({'pipelines': [{'name': 'orders', 'pg_dbnmae': 'orders'}]}, {'pg_dbname': None})
+    assert not mock_run_pipeline.called
+
+
+def test_consume_flush():
+    ledger = LsnLedger()
+    writer = Mock()
+    writer.flush.side_effect = lambda: ledger.delivered([0])
+    consume = Consume(Mock(return_value=['msg'], cur_xact=''), writer, ledger)
+    cursor = Mock()
+
+    consume(Mock(data_start=10, data_size=5, payload='payload', cursor=cursor))
+    assert not cursor.send_feedback.called
+    consume.flush(cursor)
+    cursor.send_feedback.assert_called_once_with(flush_lsn=10)
+
+
+def test_watch():
+    orders, users = Mock(spec=PipelinedConsume), Mock(spec=Consume)
+    orders.ledger, orders.flushed_lsn, orders.pool = [1, 2], 100, Mock(queue=[1, 2, 3])
+    users.ledger, users.flushed_lsn = [1], 200
+    spool = Mock(bytes=4096, write_pos=4096, drained_pos=1024)
+
+    __main__.watch(orders, spool=spool, pipeline='orders')
+    __main__.watch(users, pipeline='users')
+    assert metrics.PENDING_CHANGES.labels(pipeline='orders').get() == 2
+    assert metrics.PENDING_CHANGES.labels(pipeline='users').get() == 1
+    assert metrics.FLUSHED_LSN.labels(pipeline='orders').get() == 100
+    assert metrics.FLUSHED_LSN.labels(pipeline='users').get() == 200
+    assert metrics.QUEUE_DEPTH.labels(pipeline='orders').get() == 3
+    assert metrics.SPOOL_UNDRAINED_BYTES.labels(pipeline='orders').get() == 3072
+
+
+def test_partition_by_is_opt_in():
+    option = next(param for param in __main__.main.params if param.name == 'partition_by')
+    assert option.default is None, 'One aggregator and no ListShards unless asked for'
+
+
+def test_prepare_slot():
+    reader = Mock()
+    reader.create_slot.return_value = 'snap'
+    assert __main__._prepare_slot(reader, 'pgoutput', False, True, True) == 'snap'
+    # The publication exists before the slot decodes anything.
+    assert reader.mock_calls == [call.delete_slot(), call.create_publication(), call.create_slot(export_snapshot=True)]
+
+    reader = Mock()
+    assert __main__._prepare_slot(reader, 'wal2json', True, False, False) is None
+    assert reader.mock_calls == [call.create_slot()]
+
+    reader = Mock()
+    __main__._prepare_slot(reader, 'pgoutput', False, False, False)
+    assert not reader.mock_calls, 'Nothing to create'
+
+
+def test_shut_down():
+    consume = Mock(spec=PipelinedConsume)
+    consume.pool = Mock()
+    consume.pool.terminate.side_effect = RuntimeError('stuck')
+    format_pool, async_writer, drainer, spool = Mock(), Mock(), Mock(), Mock()
+
+    __main__._shut_down(consume, format_pool, async_writer, drainer, spool)
+    assert consume.pool.terminate.called
+    assert format_pool.terminate.called, 'One failure does not stop the rest'
+    assert async_writer.close.called and drainer.stop.called and spool.close.called
+
+    __main__._shut_down(None, None, None, None, None)
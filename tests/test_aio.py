@@ -0,0 +1,227 @@
+import asyncio
+from collections import namedtuple
+import socket
+import threading
+import time
+
+from mock import Mock
+import pytest
+
+from pg2kinesis.__main__ import Consume
+from pg2kinesis.aio import AsyncWriter, ReplicationEngine
+from pg2kinesis.formatter import get_formatter
+from pg2kinesis.ledger import LsnLedger
+from pg2kinesis.slot import PrimaryKeyMapItem
+from pg2kinesis.stream import StreamWriter
+
+FakeMessage = namedtuple('FakeMessage', 'payload, data_start, data_size, cursor')
+
+
+class FakeCursor(object):
+    """
+    A replication cursor handing out payloads, with a socket the loop can watch.
+    """
+
+    def __init__(self, payloads):
+        self.feedback = []
+        self._messages = [FakeMessage(p, lsn, len(p), self) for lsn, p in enumerate(payloads, 1)]
+        self._socket, self._peer = socket.socketpair()
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    @property
+    def exhausted(self):
+        return not self._messages
+
+    def read_message(self):
+        return self._messages.pop(0) if self._messages else None
+
+    def send_feedback(self, flush_lsn=0, **kwargs):
+        self.feedback.append(flush_lsn)
+
+
+class FakeKinesis(object):
+    """
+    Accepts every record after delay seconds, noting how many puts overlap.
+    """
+
+    def __init__(self, delay=0, shards=4):
+        self.delay = delay
+        self.records = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        bounds = [i * 2 ** 128 // shards for i in range(shards + 1)]
+        self._shards = [{'ShardId': 'shardId-%012d' % i,
+                         'HashKeyRange': {'StartingHashKey': str(bounds[i]), 'EndingHashKey': str(bounds[i + 1] - 1)},
+                         'SequenceNumberRange': {'StartingSequenceNumber': '1'}} for i in range(shards)]
+
+    def create_stream(self, **kwargs):
+        pass
+
+    def list_shards(self, **kwargs):
+        return {'Shards': self._shards}
+
+    def get_waiter(self, name):
+        return Mock()
+
+    def put_record(self, Data, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self._lock:
+            self.in_flight -= 1
+            self.records.append(Data)
+        return {'SequenceNumber': '1', 'ShardId': 'shardId-000000000000'}
+
+
+def run_until(engine, done, timeout=5):
+    loop = asyncio.new_event_loop()
+    started = time.time()
+
+    def check():
+        if done() or time.time() - started > timeout:
+            engine.stop()
+        else:
+            loop.call_later(.005, check)
+
+    try:
+        asyncio.set_event_loop(loop)
+        loop.call_soon(check)
+        loop.run_until_complete(engine.run())
+    finally:
+        loop.close()
+
+
+def test_async_writer():
+    sends = []
+    release = threading.Event()
+
+    def send(records, tokens):
+        sends.append(records)
+        release.wait(1)
+
+    writer = Mock(send=Mock(side_effect=send))
+    writer.collect.side_effect = lambda fmt_msg, token: [(fmt_msg, [token])] if fmt_msg else [(None, [])]
+    writer.shards_of.side_effect = lambda records: frozenset([records])
+    async_writer = AsyncWriter(writer, max_in_flight=2)
+    assert writer.load_shards.called
+
+    async def put():
+        for i in range(1, 6):
+            assert async_writer.put_message(i, i)
+        assert async_writer.put_message(None) is None, 'Nothing to send'
+        assert len(async_writer) == 5
+        assert len(async_writer._in_flight) == 2, 'The rest wait their turn'
+
+        release.set()
+        await async_writer.room()
+        await async_writer.drain()
+        assert not len(async_writer)
+
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(put())
+    finally:
+        loop.close()
+        async_writer.close()
+
+    assert sorted(sends) == [1, 2, 3, 4, 5]
+    assert sends[2:] == [3, 4, 5], 'Waiting sends start in order'
+
+
+def test_async_writer_shard_order():
+    sends = []
+    in_flight = set()
+    overlapped = []
+
+    def send(records, tokens):
+        shard = records[0]
+        assert shard not in in_flight, 'One send at a time per shard'
+        in_flight.add(shard)
+        overlapped.append(len(in_flight) > 1)
+        time.sleep(.002)
+        sends.append(records)
+        in_flight.discard(shard)
+
+    writer = Mock(send=Mock(side_effect=send))
+    writer.collect.side_effect = lambda fmt_msg, token: [(fmt_msg, [token])]
+    writer.shards_of.side_effect = lambda records: frozenset([records[0]])
+    async_writer = AsyncWriter(writer, max_in_flight=4)
+
+    async def put():
+        for i in range(10):
+            for shard in 'ab':
+                async_writer.put_message('{}{}'.format(shard, i), i)
+        await async_writer.drain()
+
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(put())
+    finally:
+        loop.close()
+        async_writer.close()
+
+    assert any(overlapped), 'Shards are sent to in parallel'
+    for shard in 'ab':
+        assert [records for records in sends if records[0] == shard] == ['{}{}'.format(shard, i) for i in range(10)]
+
+
+def test_async_writer_error():
+    writer = Mock(send=Mock(side_effect=RuntimeError('boom')))
+    writer.collect.return_value = [('record', [1])]
+    writer.shards_of.return_value = frozenset([None])
+    async_writer = AsyncWriter(writer, max_in_flight=1)
+
+    async def put():
+        async_writer.put_message('msg', 1)
+        async_writer.put_message('msg', 2)
+        with pytest.raises(RuntimeError):
+            await async_writer.room()
+        with pytest.raises(RuntimeError):
+            async_writer.put_message('msg', 3)
+
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(put())
+    finally:
+        loop.close()
+        async_writer.close()
+    assert writer.send.call_count == 1, 'Nothing more is sent after a failure'
+
+
+@pytest.mark.parametrize('max_in_flight', [1, 4])
+def test_replication_engine(max_in_flight):
+    payloads = []
+    for xid in range(1, 21):
+        payloads.append('BEGIN {}'.format(xid))
+        payloads += ["table public.blue: UPDATE: uuid[integer]:{}".format(xid * 10 + row) for row in range(5)]
+        payloads.append('COMMIT {}'.format(xid))
+
+    cursor = FakeCursor(payloads)
+    reader = Mock(start_replication=Mock(return_value=cursor))
+    kinesis = FakeKinesis(delay=.005)
+    ledger = LsnLedger()
+    formatter = get_formatter('CSV', {'public.blue': PrimaryKeyMapItem('public.blue', 'uuid', 'integer', 0)},
+                              'test_decoding', False, None)
+    # A short send window makes many small sends to overlap, on the shards of their transactions.
+    stream_writer = StreamWriter('blah', send_window=.001, ledger=ledger, kinesis=kinesis, partition_by='xid')
+    writer = AsyncWriter(stream_writer, max_in_flight)
+    consume = Consume(formatter, writer, ledger)
+    engine = ReplicationEngine(reader, consume, writer, tick_interval=.001, yield_every=1)
+
+    run_until(engine, lambda: cursor.exhausted and not len(ledger) and not len(writer))
+    writer.close()
+
+    assert cursor.exhausted
+    assert sum(len(record) for record in kinesis.records) > 0
+    assert ledger.flushed_lsn == len(payloads), 'Everything read was delivered'
+    assert cursor.feedback[-1] == len(payloads), 'and acknowledged'
+    flushed = [lsn for lsn in cursor.feedback if lsn]
+    assert flushed == sorted(flushed), 'Acknowledgements never go backwards'
+    assert kinesis.max_in_flight <= max_in_flight
@@ -0,0 +1,54 @@
+from __future__ import unicode_literals
+import json
+
+import mock
+import pytest
+
+from pg2kinesis import codec
+from pg2kinesis.codec import JsonCodec, available_codecs, get_codec
+
+DOCUMENT = {'xid': 1, 'change': {'kind': 'insert', 'columnnames': ['a', 'b/c'],
+                                 'columnvalues': [1.5, 'été "quoted" ☃', None, True, 2 ** 40]}}
+# Numbers the backends read or write differently from the standard library.
+NUMBERS = ('[123456789012345678901234567890, -9223372036854775809, 18446744073709551615, 1e+16, 1e-07, '
+           'NaN, Infinity, -Infinity]')
+
+
+@pytest.mark.parametrize('name', available_codecs())
+def test_codecs_agree(name):
+    reference = JsonCodec()
+    test_codec = get_codec(name)
+
+    assert test_codec.dumps(DOCUMENT) == reference.dumps(DOCUMENT), 'Every backend writes the same document'
+    assert test_codec.dumps_bytes(DOCUMENT) == reference.dumps(DOCUMENT).encode('utf-8')
+    assert test_codec.loads(reference.dumps(DOCUMENT)) == DOCUMENT
+    assert test_codec.loads(reference.dumps_bytes(DOCUMENT)) == DOCUMENT, 'Reads bytes without decoding them'
+
+    for data in (NUMBERS, NUMBERS.encode('utf-8')):
+        assert test_codec.dumps(test_codec.loads(data)) == NUMBERS
+    assert test_codec.loads('[123456789012345678901234567890]') == [123456789012345678901234567890], \
+        'Not a float'
+    # A test_decoding full change holds the integer as parsed from the text.
+    assert test_codec.dumps_bytes({'v': 10 ** 29}) == b'{"v": 100000000000000000000000000000}'
+
+
+def test_json_codec_writes_what_json_does():
+    assert JsonCodec().dumps({'a': [1, 'b']}) == '{"a": [1, "b"]}'
+    assert JsonCodec().dumps(DOCUMENT) == json.dumps(DOCUMENT), 'What consumers have always read'
+    assert JsonCodec().dumps_bytes(DOCUMENT) == json.dumps(DOCUMENT).encode('utf-8')
+
+
+def test_get_codec():
+    assert get_codec().name == available_codecs()[0]
+    assert get_codec('json').name == 'json'
+    assert available_codecs()[-1] == 'json', 'The standard library is the fallback'
+
+    with mock.patch.object(codec, 'orjson', None), mock.patch.object(codec, 'ujson', None), \
+            mock.patch.object(codec, 'rapidjson', None):
+        assert available_codecs() == ['json']
+        assert isinstance(get_codec(), JsonCodec)
+        with pytest.raises(ImportError):
+            get_codec('orjson')
+
+    with pytest.raises(ValueError):
+        get_codec('yaml')
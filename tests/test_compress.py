@@ -0,0 +1,49 @@
+from __future__ import unicode_literals
+
+import mock
+import pytest
+
+from pg2kinesis import compress
+from pg2kinesis.compress import COMPRESSORS, HEADER_MAGIC, decompress, get_compressor
+
+RECORD = '0,CDC,{"xid":1,"change":{"kind":"insert","columnvalues":["%s"]}}' % ('été ' * 200)
+
+
+@pytest.mark.parametrize('name', list(COMPRESSORS))
+def test_round_trip(name):
+    module, _ = COMPRESSORS[name]
+    if module() is None:
+        pytest.skip('{} is not installed'.format(name))
+    compressor = get_compressor(name)
+
+    compressed = compressor(RECORD)
+    assert bytearray(compressed[:2]) == bytearray([HEADER_MAGIC, compressor.codec_id])
+    assert len(compressed) < len(RECORD) / 5
+    assert decompress(compressed) == RECORD.encode('utf-8')
+
+    binary = b'\xb7\x01' + RECORD.encode('utf-8')
+    assert decompress(compressor(binary)) == binary
+
+
+def test_incompressible_records_are_left_alone():
+    compressor = get_compressor('gzip', 9)
+    assert compressor.level == 9
+    assert compressor('0,CDC,1') == '0,CDC,1', 'Not worth it'
+    assert decompress(b'0,CDC,1') == b'0,CDC,1'
+    assert decompress(b'\xb7\x01\x00') == b'\xb7\x01\x00', 'Binary records are told apart from compressed ones'
+
+
+def test_get_compressor():
+    assert get_compressor('none') is None
+    assert get_compressor(None) is None
+    assert get_compressor('gzip').level == 6
+
+    with pytest.raises(ValueError):
+        get_compressor('brotli')
+
+    with mock.patch.object(compress, 'zstandard', None):
+        with pytest.raises(ImportError):
+            get_compressor('zstd')
+
+    with pytest.raises(ValueError):
+        decompress(b'\xc3\x09data')
@@ -0,0 +1,76 @@
+from mock import Mock
+
+from pg2kinesis import metrics
+from pg2kinesis.controller import BatchController
+
+
+def controller(**kwargs):
+    kwargs.setdefault('max_send_window', 8)
+    kwargs.setdefault('max_in_flight', 4)
+    return BatchController(busy_bytes=1000, min_send_window=1, min_agg_bytes=1024, max_agg_bytes=8192, **kwargs)
+
+
+def test_idle_and_busy():
+    batch = controller()
+    writer = Mock()
+    batch.attach(writer)
+    # Starts at the maximums.
+    writer.tune.assert_called_once_with(8, 8192)
+
+    for _ in range(5):
+        assert batch.adjust(10, 5, .5, 0) == 'idle'
+    assert (batch.send_window, batch.agg_bytes, batch.in_flight) == (1, 1024, 4), 'Down to the minimums'
+    writer.tune.assert_called_with(1, 1024)
+    assert metrics.ADAPTIVE_SEND_WINDOW.labels(pipeline='pg2kinesis').get() == 1
+    assert metrics.ADAPTIVE_AGGREGATE_BYTES.labels(pipeline='pg2kinesis').get() == 1024
+
+    assert batch.adjust(5000, 5, .5, 0) == 'busy'
+    assert (batch.send_window, batch.agg_bytes) == (2, 2048)
+    for _ in range(5):
+        batch.adjust(5000, 5, .5, 0)
+    assert (batch.send_window, batch.agg_bytes) == (8, 8192), 'Up to the maximums'
+
+
+def test_throttled():
+    batch = controller()
+    batch.async_writer = Mock(max_in_flight=4)
+    batch.adjust(10, 10, 1, 0)
+
+    assert batch.adjust(10, 10, 1, 5) == 'throttled', 'Throttled whatever the lag'
+    assert batch.in_flight == 2
+    assert batch.async_writer.max_in_flight == 2
+    assert batch.send_window == 8, 'Fewer, fuller records'
+    batch.adjust(5000, 10, 1, 5)
+    batch.adjust(5000, 10, 1, 5)
+    assert batch.in_flight == 1, 'Never below one'
+    assert metrics.ADAPTIVE_IN_FLIGHT.labels(pipeline='pg2kinesis').get() == 1
+
+    assert batch.adjust(5000, 100, 10, 1) == 'busy', 'A few throttles are fine'
+    assert batch.in_flight == 2
+    batch.adjust(5000, 100, 200, 0)
+    assert batch.in_flight == 2, 'Puts slower than latency_target'
+    for _ in range(5):
+        batch.adjust(5000, 100, 10, 0)
+    assert batch.in_flight == 4, 'Up to max_in_flight'
+
+
+def test_lag_monitor_listener():
+    batch = controller()
+    for _ in range(3):
+        batch.sent(.25)
+    batch.throttled()
+    batch.adjust = Mock()
+
+    batch(Mock(byte_lag=5000))
+    batch.adjust.assert_called_once_with(5000, 3, .75, 1)
+    # Only what was reported since the last poll.
+    batch(Mock(byte_lag=10))
+    batch.adjust.assert_called_with(10, 0, 0, 0)
+
+
+def test_metrics_per_pipeline():
+    orders, users = controller(pipeline='orders'), controller(pipeline='users')
+    orders.adjust(10, 5, .5, 0)
+    assert metrics.ADAPTIVE_SEND_WINDOW.labels(pipeline='orders').get() == 4
+    assert metrics.ADAPTIVE_SEND_WINDOW.labels(pipeline='users').get() == 8
+    assert metrics.ADAPTIVE_ADJUSTMENTS.labels(pipeline='orders', mode='idle').get() == 1
@@ -1,12 +1,21 @@
 # coding=utf-8
 from __future__ import unicode_literals
+import binascii
+from decimal import Decimal
+import io
 import json
+import re
 
 import mock
 import pytest
 
+from pg2kinesis.__main__ import main
 from pg2kinesis.slot import PrimaryKeyMapItem
-from pg2kinesis.formatter import Change, CSVFormatter, CSVPayloadFormatter, Formatter, get_formatter
+from pg2kinesis import formatter as formatter_module
+from pg2kinesis.formatter import AvroFormatter, BinaryFormatter, Change, CSVFormatter, CSVPayloadFormatter, \
+    Formatter, FullChange, Message, MsgPackFormatter, PgOutputDecoder, PgOutputMessage, ProtobufFormatter, Relation, \
+    get_formatter, _value_kind, parse_test_decoding_tuple, ENVELOPE_MAX_BYTES
+from pg2kinesis.schema import ENVELOPE_KIND, RECORD_KIND, SCHEMA_KIND, unpack_header
 
 
 def get_formatter_produce_formatted_message(cls):
@@ -41,18 +50,12 @@ def formatter(request, pkey_map):
     return request.param(pkey_map)
 
 
-def test___init__(formatter):
-    # processes primary key map (adds colon)
-
-    patterns = formatter._primary_key_patterns
-
-    assert len(patterns) == 2
-    assert u'public.test_table:' in patterns, 'with colon'
-    assert u'public.test_table2:' in patterns, 'with colon'
-    assert u'public.test_table' not in patterns, 'without colon should not be in patterns'
-    assert u'public.test_table2' not in patterns, 'without colon should not be in patterns'
-    assert patterns[u'public.test_table:'].pattern == r"uuid\[uuid\]:'?([\w\-]+)'?"
-    assert patterns[u'public.test_table2:'].pattern == r"name\[character varying\]:'?([\w\-]+)'?"
+def test___init__(formatter, pkey_map):
+    assert formatter.primary_key_map is pkey_map
+    assert formatter.output_plugin == u'test_decoding'
+    assert not formatter.full_change
+    assert formatter.table_re.search(u'public.test_table')
+    assert formatter.cur_xact == ''
 
 
 def test__preprocess_test_decoding_change(formatter):
@@ -77,7 +80,7 @@ def test__preprocess_test_decoding_change(formatter):
     with mock.patch.object(formatter, '_log_and_raise') as mock_log_and_raise:
         formatter._preprocess_test_decoding_change(u"table not_a_table: UPDATE: uuid[uuid]:'00079f3e-0479-4475-acff-4f225cc5188a'")
         assert mock_log_and_raise.called
-        mock_log_and_raise.assert_called_with(u'Unable to locate table: "not_a_table:"')
+        mock_log_and_raise.assert_called_with(u'Unable to locate table: "not_a_table"')
 
     with mock.patch.object(formatter, '_log_and_raise') as mock_log_and_raise:
         formatter._preprocess_test_decoding_change(u"table public.test_table: UPDATE: not[not]:'00079f3e-0479-4475-acff-4f225cc5188a'")
@@ -103,6 +106,106 @@ def test__preprocess_test_decoding_change(formatter):
     assert change.pkey == u'Bling-2'
 
 
+def test_parse_test_decoding_tuple():
+    columns, old_key = parse_test_decoding_tuple(
+        u"id[integer]:1 name[character varying]:'O''Brien, the ''elder''' note[text]:null "
+        u"\"Odd \"\"Col\"\"\"[text]:'a b' tags[text[]]:'{a,\"b c\"}' ok[boolean]:true")
+    assert old_key is None
+    assert columns == [(u'id', u'integer', u'1'),
+                       (u'name', u'character varying', u"O'Brien, the 'elder'"),
+                       (u'note', u'text', None),
+                       (u'Odd "Col"', u'text', u'a b'),
+                       (u'tags', u'text[]', u'{a,"b c"}'),
+                       (u'ok', u'boolean', u'true')]
+
+    columns, old_key = parse_test_decoding_tuple(
+        u"old-key: id[integer]:1 new-tuple: id[integer]:2 name[text]:'null'")
+    assert old_key == [(u'id', u'integer', u'1')]
+    assert columns == [(u'id', u'integer', u'2'), (u'name', u'text', u'null')], 'Quoted null is a string'
+
+    assert parse_test_decoding_tuple(u'(no-tuple-data)') == ([], None)
+
+    with pytest.raises(ValueError):
+        parse_test_decoding_tuple(u"id[integer]:1 name[text]:'unterminated")
+
+
+def test__preprocess_test_decoding_composite_key(formatter):
+    formatter.primary_key_map[u'public.pair'] = PrimaryKeyMapItem(u'public.pair', (u'a', u'b'),
+                                                                  (u'text', u'integer'), (1, 2))
+    formatter.cur_xact = u'7'
+
+    change = formatter._preprocess_test_decoding_change(
+        u"table public.pair: INSERT: a[text]:'x y' b[integer]:2 c[text]:'z'")[0]
+    assert change == Change(xid=u'7', table=u'public.pair', operation=u'INSERT', pkey=u'x y,2')
+
+    with mock.patch.object(formatter, '_log_and_raise') as mock_log_and_raise:
+        formatter._preprocess_test_decoding_change(u"table public.\"Quoted Table\": INSERT: id[integer]:2")
+        mock_log_and_raise.assert_called_with(u'Unable to locate table: "public.Quoted Table"')
+
+    with mock.patch.object(formatter, '_log_and_raise') as mock_log_and_raise:
+        formatter._preprocess_test_decoding_change(u"table public.pair: INSERT: a[text]:null b[integer]:2")
+        mock_log_and_raise.assert_called_with(u'Unable to locate primary key for table "public.pair"')
+
+    with mock.patch.object(formatter, '_log_and_raise') as mock_log_and_raise:
+        assert formatter._preprocess_test_decoding_change(u"table public.pair: INSERT: a[text]:'x") == []
+        mock_log_and_raise.assert_called_with(u'Unable to parse change: "table public.pair: INSERT: a[text]:\'x"')
+
+    assert formatter._preprocess_test_decoding_change(u"table public.pair: TRUNCATE: (no-flags)") == []
+
+
+def test__preprocess_test_decoding_full_change(formatter):
+    formatter.full_change = True
+    formatter.cur_xact = u'7'
+
+    change = formatter._preprocess_test_decoding_change(
+        u"table public.not_mapped: INSERT: id[integer]:1 price[numeric]:1.50 ok[boolean]:false "
+        u"name[text]:'a b' big[text]:unchanged-toast-datum")[0]
+    assert change == FullChange(xid=u'7', change={
+        'kind': u'insert', 'schema': u'public', 'table': u'not_mapped',
+        'columnnames': [u'id', u'price', u'ok', u'name'],
+        'columntypes': [u'integer', u'numeric', u'boolean', u'text'],
+        'columnvalues': [1, 1.5, False, u'a b'],
+    }), 'Tables do not need a known primary key'
+
+    change = formatter._preprocess_test_decoding_change(
+        u"table public.t: UPDATE: old-key: id[integer]:1 new-tuple: id[integer]:2")[0]
+    assert change.change['oldkeys'] == {'keynames': [u'id'], 'keytypes': [u'integer'], 'keyvalues': [1]}
+    assert change.change['columnvalues'] == [2]
+
+    change = formatter._preprocess_test_decoding_change(u"table public.t: DELETE: id[integer]:1")[0]
+    assert change.change == {'kind': u'delete', 'schema': u'public', 'table': u't',
+                             'oldkeys': {'keynames': [u'id'], 'keytypes': [u'integer'], 'keyvalues': [1]}}
+
+
+def test_format_row(pkey_map):
+    formatter = CSVFormatter(pkey_map)
+    formatter.cur_xact = u'7'
+    columns = [(u'uuid', u'uuid', u'00079f3e'), (u'note', u'text', None)]
+    assert formatter.format_row(u'public', u'test_table', columns) == [
+        Message(change=Change(xid=0, table=u'public.test_table', operation=u'INSERT', pkey=u'00079f3e'),
+                fmt_msg=u'0,CDC,0,public.test_table,INSERT,00079f3e')]
+    assert formatter.cur_xact == u'7', 'The transaction of the slot is left alone'
+
+    with pytest.raises(Exception):
+        formatter.format_row(u'public', u'not_mapped', columns)
+
+    formatter = CSVPayloadFormatter({}, u'wal2json', full_change=True)
+    message, = formatter.format_row(u'public', u'not_mapped', [(u'id', u'integer', u'1'), (u'note', u'text', None)])
+    assert message.change == FullChange(xid=0, change={
+        'kind': u'insert', 'schema': u'public', 'table': u'not_mapped', 'columnnames': [u'id', u'note'],
+        'columntypes': [u'integer', u'text'], 'columnvalues': [1, None]})
+
+
+def test_table_wanted(pkey_map):
+    formatter = Formatter(pkey_map, table_pat=u'^public\\.', exclude_tables=[(u'public', u'secret')])
+    assert formatter.table_wanted(u'public', u'blue')
+    assert not formatter.table_wanted(u'public', u'secret')
+    assert not formatter.table_wanted(u'other', u'blue')
+
+    formatter = Formatter(pkey_map, u'wal2json', table_pat=u'^blue$')
+    assert formatter.table_wanted(u'other', u'blue'), 'wal2json matches table_pat on the table name'
+
+
 def test__preprocess_wal2json_change(formatter):
     formatter.cur_xact = ''
     result = formatter._preprocess_wal2json_change(u"""{
@@ -276,6 +379,72 @@ def test___call__(formatter):
         mock_pfm.assert_called_with('blue')
 
 
+def test__preprocess_wal2json_chunk(formatter):
+    chunks = [u'{"xid":1337,"change":[',
+              u'{"kind":"insert","schema":"public","table":"test_table",'
+              u'"columnnames":["uuid"],"columntypes":["uuid"],"columnvalues":["abc"]}',
+              u',{"kind":"delete","schema":"public","table":"test_table",'
+              u'"oldkeys":{"keynames":["uuid"],"keytypes":["uuid"],"keyvalues":["def"]}}',
+              u']}']
+
+    changes = [c for chunk in chunks for c in formatter._preprocess_wal2json_chunk(chunk)]
+    assert changes == [Change(xid=1337, table=u'public.test_table', operation=u'insert', pkey=u'abc'),
+                       Change(xid=1337, table=u'public.test_table', operation=u'delete', pkey=u'def')]
+
+    changes = formatter._preprocess_wal2json_chunk(
+        u'{"xid":1338,"change":[{"kind":"insert","schema":"public","table":"test_table",'
+        u'"columnnames":["uuid"],"columntypes":["uuid"],"columnvalues":["ghi"]}]}')
+    assert changes == [Change(xid=1338, table=u'public.test_table', operation=u'insert', pkey=u'ghi')]
+
+
+def test__preprocess_wal2json_v2_change(formatter):
+    assert formatter._preprocess_wal2json_v2_change(u'{"action":"B","xid":1337}') == []
+    assert formatter.cur_xact == 1337
+
+    change = formatter._preprocess_wal2json_v2_change(
+        u'{"action":"U","schema":"public","table":"test_table",'
+        u'"columns":[{"name":"uuid","type":"uuid","value":"abc"},{"name":"n","type":"integer","value":2}],'
+        u'"identity":[{"name":"uuid","type":"uuid","value":"abd"}]}')
+    assert change == [Change(xid=1337, table=u'public.test_table', operation=u'update', pkey=u'abc')]
+
+    change = formatter._preprocess_wal2json_v2_change(
+        u'{"action":"D","schema":"public","table":"test_table",'
+        u'"identity":[{"name":"uuid","type":"uuid","value":"abc"}]}')
+    assert change == [Change(xid=1337, table=u'public.test_table', operation=u'delete', pkey=u'abc')]
+
+    assert formatter._preprocess_wal2json_v2_change(u'{"action":"T","schema":"public","table":"test_table"}') == []
+    assert formatter._preprocess_wal2json_v2_change(u'{"action":"C","xid":1337}') == []
+
+    with mock.patch.object(formatter, '_log_and_raise') as mock_log_and_raise:
+        formatter._preprocess_wal2json_v2_change(
+            u'{"action":"I","schema":"public","table":"test_table",'
+            u'"columns":[{"name":"other","type":"integer","value":1}]}')
+        mock_log_and_raise.assert_called_with(u'Unable to locate primary key for table "public.test_table"')
+
+    formatter.full_change = True
+    change = formatter._preprocess_wal2json_v2_change(
+        u'{"action":"U","schema":"public","table":"test_table",'
+        u'"columns":[{"name":"uuid","type":"uuid","value":"abc"},{"name":"n","type":"integer","value":null}],'
+        u'"identity":[{"name":"uuid","type":"uuid","value":"abd"}]}')[0]
+    assert change == FullChange(xid=1337, change={
+        'kind': u'update', 'schema': u'public', 'table': u'test_table',
+        'columnnames': [u'uuid', u'n'], 'columntypes': [u'uuid', u'integer'], 'columnvalues': [u'abc', None],
+        'oldkeys': {'keynames': [u'uuid'], 'keytypes': [u'uuid'], 'keyvalues': [u'abd']},
+    }), 'Rows look like format 1 ones'
+
+
+def test_wal2json_format_dispatch(pkey_map):
+    formatter = Formatter(pkey_map, u'wal2json', wal2json_format_version=2)
+    with mock.patch.object(formatter, '_preprocess_wal2json_v2_change', return_value=[]) as mocked:
+        formatter(u'{}')
+        mocked.assert_called_once_with(u'{}')
+
+    formatter = Formatter(pkey_map, u'wal2json', wal2json_write_in_chunks=True)
+    with mock.patch.object(formatter, '_preprocess_wal2json_chunk', return_value=[]) as mocked:
+        formatter(u'{}')
+        mocked.assert_called_once_with(u'{}')
+
+
 def test_get_formatter():
     with mock.patch.object(Formatter, '__init__', return_value=None) as mocked:
         result = get_formatter('CSVPayload', 1, 2, 3, 4)
@@ -288,3 +457,410 @@ def test_get_formatter():
         assert isinstance(result, CSVFormatter)
         assert mocked.called
         mocked.assert_called_with(1, 2, 3, 4)
+
+    with mock.patch.object(Formatter, '__init__', return_value=None) as mocked:
+        get_formatter('CSV', 1, 2, 3, 4, wal2json_format_version=2)
+        mocked.assert_called_with(1, 2, 3, 4, wal2json_format_version=2)
+
+
+def test_formatter_json_codec(pkey_map):
+    formatter = CSVPayloadFormatter(pkey_map, u'wal2json', wal2json_format_version=2, json_codec=u'json')
+    assert formatter.codec.name == u'json'
+
+    formatter(b'{"action":"B","xid":1337}')
+    messages = formatter(b'{"action":"I","schema":"public","table":"test_table",'
+                         b'"columns":[{"name":"uuid","type":"uuid","value":"\xc3\xa9t\xc3\xa9"}]}')
+    assert messages[0].fmt_msg == (u'0,CDC,{"xid": 1337, "table": "public.test_table", '
+                                   u'"operation": "insert", "pkey": "\\u00e9t\\u00e9"}'), 'Payloads are read as bytes'
+
+
+FULL_UPDATE = FullChange(xid=1337, change={
+    'kind': u'update', 'schema': u'public', 'table': u'test_table',
+    'columnnames': [u'uuid', u'n', u'price', u'ok', u'tags', u'note'],
+    'columntypes': [u'uuid', u'int4', u'numeric(10,2)', u'bool', u'integer[]', u'text'],
+    'columnvalues': [u'abc', -3, Decimal('1.50'), True, u'{1,2}', None],
+    'oldkeys': {'keynames': [u'uuid'], 'keytypes': [u'uuid'], 'keyvalues': [u'abd']},
+})
+
+
+def binary_formatter(cls, pkey_map):
+    formatter = cls(pkey_map, u'wal2json', True, wal2json_format_version=2)
+    formatter.cur_xact = 1337
+    return formatter
+
+
+@pytest.mark.parametrize('cls', [MsgPackFormatter, ProtobufFormatter, AvroFormatter])
+def test_binary_formatter_schema_records(cls, pkey_map):
+    if cls is MsgPackFormatter:
+        pytest.importorskip('msgpack')
+    formatter = binary_formatter(cls, pkey_map)
+
+    with mock.patch.object(formatter, '_preprocess', return_value=[FULL_UPDATE]):
+        record_msg, = formatter(u'')
+        assert formatter(u'') == [record_msg], 'Every record carries its schema'
+    assert len(formatter._schema_records) == 1, 'The schema is only built once'
+
+    assert record_msg.change == FULL_UPDATE
+    formatter_id, kind, sid, payload = unpack_header(record_msg.schema)
+    assert (formatter_id, kind) == (cls.FORMATTER_ID, SCHEMA_KIND)
+    assert unpack_header(record_msg.fmt_msg)[:3] == (cls.FORMATTER_ID, RECORD_KIND, sid)
+    assert json.loads(payload.decode('utf-8'))
+
+    pkey_change = Change(xid=u'7', table=u'public.test_table', operation=u'insert', pkey=u'abc')
+    table_schema = formatter._schema_of(pkey_change)
+    assert table_schema.key_columns == ((u'uuid', u'uuid'),), 'Keys come from the primary key map'
+    assert formatter.produce_formatted_message(pkey_change).change == pkey_change
+
+
+def test_binary_formatter_exact_numeric(pkey_map):
+    formatter = binary_formatter(ProtobufFormatter, pkey_map)
+    change, = formatter._preprocess(
+        u'{"action":"I","schema":"public","table":"t","columns":['
+        u'{"name":"price","type":"numeric(30,9)","value":12345678901234567890.123456789},'
+        u'{"name":"ratio","type":"double precision","value":0.5}]}')
+    assert change.change['columnvalues'] == [Decimal('12345678901234567890.123456789'), 0.5]
+    assert formatter._typed(u'string', change.change['columnvalues'][0]) == u'12345678901234567890.123456789'
+
+    formatter = ProtobufFormatter(pkey_map, u'test_decoding', True)
+    change, = formatter._preprocess(u"table public.t: INSERT: price[numeric]:1.50 ratio[double precision]:0.5")
+    assert change.change['columnvalues'] == [u'1.50', 0.5], 'Numeric text is kept as it is'
+
+    assert _value_kind(u'numeric(10,2)') == u'string'
+    assert _value_kind(u'double precision') == u'double'
+
+
+def test_MsgPackFormatter(pkey_map):
+    msgpack = pytest.importorskip('msgpack')
+    formatter = binary_formatter(MsgPackFormatter, pkey_map)
+
+    record = formatter.produce_formatted_message(FULL_UPDATE).fmt_msg
+    assert msgpack.unpackb(unpack_header(record)[3], raw=False) == [
+        1337, u'update', None, [u'abc', -3, u'1.50', True, u'{1,2}', None], [u'abd']]
+
+    with mock.patch('pg2kinesis.formatter.msgpack', None), pytest.raises(ImportError):
+        binary_formatter(MsgPackFormatter, pkey_map)
+
+
+def test_ProtobufFormatter(pkey_map):
+    from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+    file_proto = descriptor_pb2.FileDescriptorProto(name=u'pg2kinesis_test.proto', package=u'pg2kinesis_test',
+                                                    syntax=u'proto3')
+    value = file_proto.message_type.add(name=u'Value')
+    value.oneof_decl.add(name=u'value')
+    for number, (name, field_type) in enumerate([(u'long', 'TYPE_SINT64'), (u'double', 'TYPE_DOUBLE'),
+                                                 (u'boolean', 'TYPE_BOOL'), (u'string', 'TYPE_STRING')], 1):
+        value.field.add(name=name, number=number, oneof_index=0, label=1,
+                        type=getattr(descriptor_pb2.FieldDescriptorProto, field_type))
+    change = file_proto.message_type.add(name=u'Change')
+    for number, (name, field_type, label) in enumerate([(u'xid', 'TYPE_UINT64', 1), (u'operation', 'TYPE_STRING', 1),
+                                                        (u'columns', 'TYPE_MESSAGE', 3),
+                                                        (u'old_keys', 'TYPE_MESSAGE', 3),
+                                                        (u'pkey', 'TYPE_STRING', 1)], 1):
+        change.field.add(name=name, number=number, label=label,
+                         type=getattr(descriptor_pb2.FieldDescriptorProto, field_type),
+                         type_name=u'.pg2kinesis_test.Value' if field_type == 'TYPE_MESSAGE' else None)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    change_cls = message_factory.GetMessageClass(pool.FindMessageTypeByName(u'pg2kinesis_test.Change'))
+
+    formatter = binary_formatter(ProtobufFormatter, pkey_map)
+    decoded = change_cls.FromString(unpack_header(formatter.produce_formatted_message(FULL_UPDATE).fmt_msg)[3])
+    assert decoded.xid == 1337
+    assert decoded.operation == u'update'
+    assert [v.WhichOneof(u'value') and getattr(v, v.WhichOneof(u'value')) for v in decoded.columns] == [
+        u'abc', -3, u'1.50', True, u'{1,2}', None]
+    assert [v.string for v in decoded.old_keys] == [u'abd']
+    assert decoded.pkey == u''
+
+    pkey_change = Change(xid=u'7', table=u'public.test_table', operation=u'delete', pkey=u'abc')
+    decoded = change_cls.FromString(unpack_header(formatter.produce_formatted_message(pkey_change).fmt_msg)[3])
+    assert (decoded.xid, decoded.operation, decoded.pkey, len(decoded.columns)) == (7, u'delete', u'abc', 0)
+
+
+def test_AvroFormatter(pkey_map):
+    fastavro = pytest.importorskip('fastavro')
+    formatter = binary_formatter(AvroFormatter, pkey_map)
+
+    with mock.patch.object(formatter, '_preprocess', return_value=[FULL_UPDATE]):
+        record_msg, = formatter(u'')
+
+    avro_schema = fastavro.parse_schema(json.loads(unpack_header(record_msg.schema)[3].decode('utf-8')))
+    decoded = fastavro.schemaless_reader(io.BytesIO(unpack_header(record_msg.fmt_msg)[3]), avro_schema)
+    assert decoded == {
+        'xid': 1337, 'operation': u'update', 'pkey': None,
+        'columns': {'uuid': u'abc', 'n': -3, 'price': u'1.50', 'ok': True, 'tags': u'{1,2}', 'note': None},
+        'oldkeys': {'uuid': u'abd'},
+    }
+
+    table_schema = formatter.schemas.get(u'public.1 odd', ((u'a-b', u'text'), (u'a b', u'int8')), ())[0]
+    fields = formatter.avro_schema(table_schema)['fields'][3]['type'][1]['fields']
+    assert [(f['name'], f['pg_name']) for f in fields] == [(u'a_b', u'a-b'), (u'a_b_1', u'a b')]
+    assert formatter.avro_schema(table_schema)['name'] == u'public_1_odd'
+
+
+# pgoutput protocol 1 messages of a transaction on
+#   CREATE TABLE public.test_table (uuid uuid PRIMARY KEY, n integer, note text)
+PGOUTPUT = dict((name, binascii.unhexlify(data)) for name, data in [
+    ('BEGIN', b'4200000000016b374800026bbefdd5640000000539'),
+    ('RELATION', b'52000040017075626c696300746573745f7461626c650064000301757569640000000b86ffffffff006e0000000017'
+                 b'ffffffff006e6f74650000000019ffffffff'),
+    ('INSERT', b'49000040014e0003740000000361626374000000022d33740000000469742773'),
+    ('UPDATE', b'55000040014b000374000000036162646e6e4e0003740000000361626374000000013475'),
+    ('DELETE', b'44000040014b000374000000036162636e6e'),
+    ('TRUNCATE', b'54000000010000004001'),
+    ('COMMIT', b'430000000000016b374800000000016b377800026bbefdd56400'),
+])
+
+
+def test_PgOutputDecoder():
+    decoder = PgOutputDecoder()
+
+    assert decoder.decode(PGOUTPUT['BEGIN']) == PgOutputMessage('B', 1337, None, None, None)
+
+    relation = decoder.decode(PGOUTPUT['RELATION']).relation
+    assert relation == Relation(16385, u'public', u'test_table', [(True, u'uuid', u'uuid'), (False, u'n', u'integer'),
+                                                                  (False, u'note', u'text')])
+    assert decoder.relations == {16385: relation}
+
+    assert decoder.decode(PGOUTPUT['INSERT']) == PgOutputMessage(
+        'I', None, relation, [(u'uuid', u'uuid', u'abc'), (u'n', u'integer', u'-3'), (u'note', u'text', u"it's")], None)
+    assert decoder.decode(PGOUTPUT['UPDATE']) == PgOutputMessage(
+        'U', None, relation, [(u'uuid', u'uuid', u'abc'), (u'n', u'integer', u'4')],
+        [(u'uuid', u'uuid', u'abd')]), 'Unchanged TOAST values and non key columns of K tuples are left out'
+    assert decoder.decode(PGOUTPUT['DELETE']) == PgOutputMessage('D', None, relation, [(u'uuid', u'uuid', u'abc')],
+                                                                 None)
+    assert decoder.decode(PGOUTPUT['TRUNCATE']).relation == [relation]
+    assert decoder.decode(PGOUTPUT['COMMIT']).action == 'C'
+
+    decoder.decode(b'Y\x00\x00\x40\x02public\x00mood\x00')
+    assert decoder.type_name(16386) == u'mood'
+
+    with pytest.raises(ValueError):
+        decoder.decode(b'Z')
+
+
+def test__preprocess_pgoutput_change(pkey_map):
+    formatter = Formatter(pkey_map, u'pgoutput')
+
+    changes = [c for name in ('BEGIN', 'RELATION', 'INSERT', 'UPDATE', 'DELETE', 'TRUNCATE', 'COMMIT')
+               for c in formatter._preprocess_pgoutput_change(PGOUTPUT[name])]
+    assert changes == [Change(xid=1337, table=u'public.test_table', operation=u'INSERT', pkey=u'abc'),
+                       Change(xid=1337, table=u'public.test_table', operation=u'UPDATE', pkey=u'abc'),
+                       Change(xid=1337, table=u'public.test_table', operation=u'DELETE', pkey=u'abc')]
+
+    formatter = Formatter({}, u'pgoutput')
+    formatter._preprocess_pgoutput_change(PGOUTPUT['RELATION'])
+    assert formatter._preprocess_pgoutput_change(PGOUTPUT['DELETE'])[0].pkey == u'abc', \
+        'Falls back to the replica identity'
+
+    with pytest.raises(Exception) as excinfo:
+        Formatter({}, u'pgoutput')._preprocess_pgoutput_change(PGOUTPUT['INSERT'])
+    assert u'Unable to parse change' in str(excinfo.value), 'Changes to unknown relations cannot be read'
+
+
+def test_primary_key_refresh():
+    pkey_map = mock.MagicMock()
+    pkey_map.__getitem__.return_value = PrimaryKeyMapItem(u'public.t', u'id', u'integer', 0)
+    pkey_map.refresh.return_value = PrimaryKeyMapItem(u'public.t', u'uid', u'integer', 0)
+
+    formatter = Formatter(pkey_map)
+    change, = formatter._preprocess_test_decoding_change(u"table public.t: INSERT: uid[integer]:7")
+    assert change.pkey == u'7', 'The key is looked up again when the cached one is missing'
+    pkey_map.refresh.assert_called_once_with(u'public.t')
+
+    formatter = Formatter(pkey_map, u'wal2json')
+    change, = formatter._preprocess_wal2json_change(
+        u'{"xid":1,"change":[{"kind":"insert","schema":"public","table":"t","columnnames":["uid"],'
+        u'"columntypes":["integer"],"columnvalues":[8]}]}')
+    assert change.pkey == u'8'
+
+    pkey_map.refresh.return_value = pkey_map.__getitem__.return_value
+    with pytest.raises(Exception) as excinfo:
+        formatter._preprocess_wal2json_change(
+            u'{"xid":1,"change":[{"kind":"insert","schema":"public","table":"t","columnnames":["uid"],'
+            u'"columntypes":["integer"],"columnvalues":[8]}]}')
+    assert u'Unable to locate primary key' in str(excinfo.value)
+
+    formatter = Formatter(pkey_map, u'pgoutput')
+    assert formatter._preprocess_pgoutput_change(PGOUTPUT['RELATION']) == []
+    # A relation is sent again after the table changed, its key may have too.
+    pkey_map.invalidate.assert_called_once_with(u'public.test_table')
+
+
+def test__preprocess_pgoutput_full_change(pkey_map):
+    formatter = Formatter(pkey_map, u'pgoutput', True)
+    for name in ('BEGIN', 'RELATION'):
+        formatter(PGOUTPUT[name])
+
+    assert formatter._preprocess_pgoutput_change(PGOUTPUT['UPDATE']) == [FullChange(xid=1337, change={
+        'kind': u'update', 'schema': u'public', 'table': u'test_table',
+        'columnnames': [u'uuid', u'n'], 'columntypes': [u'uuid', u'integer'], 'columnvalues': [u'abc', 4],
+        'oldkeys': {'keynames': [u'uuid'], 'keytypes': [u'uuid'], 'keyvalues': [u'abd']},
+    })]
+    assert formatter._preprocess_pgoutput_change(PGOUTPUT['DELETE'])[0].change == {
+        'kind': u'delete', 'schema': u'public', 'table': u'test_table',
+        'oldkeys': {'keynames': [u'uuid'], 'keytypes': [u'uuid'], 'keyvalues': [u'abc']},
+    }
+
+    formatter.table_re = re.compile(u'other_table')
+    assert formatter(PGOUTPUT['INSERT']) == []
+
+
+def test_formatter_tables(pkey_map):
+    formatter = Formatter(pkey_map, u'wal2json', wal2json_format_version=2,
+                          tables=[(u'public', u'*')], exclude_tables=[(u'*', u'test_table2')])
+    formatter.cur_xact = 1
+
+    def insert(schema, table):
+        return formatter._preprocess_wal2json_v2_change(
+            u'{"action":"I","schema":"%s","table":"%s","columns":[{"name":"uuid","type":"uuid","value":"a"},'
+            u'{"name":"name","type":"text","value":"b"}]}' % (schema, table))
+
+    assert insert(u'public', u'test_table')
+    assert insert(u'public', u'test_table2') == [], 'Excluded'
+    assert insert(u'other', u'test_table') == [], 'Not included'
+
+    formatter.table_re = re.compile(u'nothing')
+    assert insert(u'public', u'test_table') == [], '--table-pat still applies'
+
+
+def test_transaction_envelopes(pkey_map):
+    formatter = CSVPayloadFormatter(pkey_map, u'test_decoding', transaction_envelopes=True)
+    update = u"table public.test_table: UPDATE: uuid[uuid]:'{}' another_col[text]:'bling'"
+
+    assert formatter(u'BEGIN 100') == []
+    assert formatter(update.format(u'a')) == []
+    assert formatter(update.format(u'b')) == [], 'Held until the commit'
+    envelope, = formatter(u'COMMIT 100')
+
+    assert envelope.change == Change(xid=u'100', table=u'public.test_table', operation=u'UPDATE', pkey=u'a')
+    assert envelope.fmt_msg.startswith(u'0,TXN,')
+    assert json.loads(envelope.fmt_msg.split(u',', 2)[-1]) == {
+        u'xid': u'100', u'part': 0, u'final': True,
+        u'changes': [{u'xid': u'100', u'table': u'public.test_table', u'operation': u'UPDATE', u'pkey': key}
+                     for key in (u'a', u'b')]}
+
+    assert formatter(u'BEGIN 101') == []
+    assert formatter(u'COMMIT 101') == [], 'Nothing to publish for an empty transaction'
+
+    # Large transactions are split, by the bytes of the whole envelope.
+    update = u"table public.test_table: UPDATE: uuid[uuid]:'{}\xe9\xe9' another_col[text]:'bling'"
+    formatter(u'BEGIN 102')
+    formatter(update.format(u'a'))
+    formatter(update.format(u'b'))
+    envelope, = formatter(u'COMMIT 102')
+    # One byte to spare: a comma is counted for every change, the last one has none.
+    formatter.envelope_max_bytes = len(envelope.fmt_msg.replace(u'true', u'false').encode('utf-8')) + 1
+
+    formatter(u'BEGIN 102')
+    parts = []
+    for key in u'abcde':
+        parts += formatter(update.format(key))
+    parts += formatter(u'COMMIT 102')
+    payloads = [json.loads(part.fmt_msg.split(u',', 2)[-1]) for part in parts]
+    assert [(p[u'part'], p[u'final'], len(p[u'changes'])) for p in payloads] == [(0, False, 2), (1, False, 2),
+                                                                               (2, True, 1)]
+    assert [c[u'pkey'] for p in payloads for c in p[u'changes']] == [key + u'\xe9\xe9' for key in u'abcde']
+    assert all(len(part.fmt_msg.encode('utf-8')) <= formatter.envelope_max_bytes for part in parts)
+
+    formatter.envelope_max_bytes = 10
+    formatter(u'BEGIN 102')
+    parts = formatter(update.format(u'a')) + formatter(update.format(u'b')) + formatter(u'COMMIT 102')
+    assert [len(json.loads(part.fmt_msg.split(u',', 2)[-1])[u'changes']) for part in parts] == [1, 1], \
+        'Changes too large for an envelope get one of their own'
+    formatter.envelope_max_bytes = ENVELOPE_MAX_BYTES
+
+    formatter(u'BEGIN 103')
+    formatter(update.format(u'f'))
+    assert json.loads(formatter(u'COMMIT 103')[0].fmt_msg.split(u',', 2)[-1])[u'part'] == 0
+
+
+def test_transaction_envelopes_wal2json(pkey_map):
+    formatter = CSVFormatter(pkey_map, u'wal2json', transaction_envelopes=True)
+    envelope, = formatter(json.dumps({u'xid': 7, u'change': [
+        {u'kind': u'insert', u'schema': u'public', u'table': u'test_table', u'columnnames': [u'uuid'],
+         u'columntypes': [u'uuid'], u'columnvalues': [key]} for key in (u'a', u'b')]}))
+    assert json.loads(envelope.fmt_msg.split(u',', 2)[-1]) == {
+        u'xid': 7, u'part': 0, u'final': True,
+        u'records': [u'0,CDC,7,public.test_table,insert,a', u'0,CDC,7,public.test_table,insert,b']}
+
+    formatter = CSVFormatter(pkey_map, u'wal2json', wal2json_format_version=2, transaction_envelopes=True)
+    assert formatter(u'{"action":"B","xid":8}') == []
+    assert formatter(u'{"action":"I","schema":"public","table":"test_table",'
+                     u'"columns":[{"name":"uuid","type":"uuid","value":"c"}]}') == []
+    envelope, = formatter(u'{"action":"C","xid":8}')
+    assert json.loads(envelope.fmt_msg.split(u',', 2)[-1])[u'records'] == [u'0,CDC,8,public.test_table,insert,c']
+
+
+def test_transaction_envelope_bytes(pkey_map):
+    formatter = CSVFormatter(pkey_map, u'wal2json', transaction_envelopes=True)
+    envelope, = formatter(json.dumps({u'xid': 7, u'change': [
+        {u'kind': u'insert', u'schema': u'public', u'table': u'test_table', u'columnnames': [u'uuid'],
+         u'columntypes': [u'uuid'], u'columnvalues': [key]} for key in (u'a', u'b\xe9', u'c')]}))
+    records = json.loads(envelope.fmt_msg.split(u',', 2)[-1])[u'records']
+    # The separator counted after the last record is the only slack.
+    assert formatter._envelope_frame_bytes(7) + sum(formatter._envelope_record_bytes(r) for r in records) - 2 == \
+        len(envelope.fmt_msg.replace(u'true', u'false').encode('utf-8'))
+
+
+def test_default_envelope(pkey_map):
+    messages = [Message(change=None, fmt_msg=u'one'), Message(change=None, fmt_msg=u'two')]
+    assert json.loads(Formatter(pkey_map).produce_envelope(u'7', 1, True, messages)) == {
+        u'xid': u'7', u'part': 1, u'final': True, u'records': [u'one', u'two']}
+
+
+def test_default_encoding(pkey_map):
+    formatter = BinaryFormatter(pkey_map, u'wal2json', True)
+    table_schema, _ = formatter._row_schema(FULL_UPDATE)
+    assert json.loads(formatter.encode(table_schema, 1337, u'update', None, FULL_UPDATE.change[u'columnvalues'],
+                                       None).decode('utf-8')) == \
+        [1337, u'update', None, [u'abc', -3, u'1.50', True, u'{1,2}', None], None]
+
+
+@pytest.mark.parametrize('name', next(param.type.choices for param in main.params
+                                      if param.name == 'message_formatter'))
+def test_formatters_override_the_defaults(name):
+    formatter_f = getattr(formatter_module, '{}Formatter'.format(name))
+    assert formatter_f.produce_envelope != Formatter.produce_envelope
+    if issubclass(formatter_f, BinaryFormatter):
+        assert formatter_f.encode != BinaryFormatter.encode
+
+
+def test_binary_transaction_envelope(pkey_map):
+    formatter = ProtobufFormatter(pkey_map, u'wal2json', True, wal2json_format_version=2,
+                                  transaction_envelopes=True)
+    expected = ProtobufFormatter(pkey_map, u'wal2json', True)._format([FULL_UPDATE])
+    formatter(u'{"action":"B","xid":1337}')
+    with mock.patch.object(formatter, '_preprocess', return_value=[FULL_UPDATE]):
+        assert formatter(u'') == []
+    envelope, = formatter(u'{"action":"C","xid":1337}')
+
+    formatter_id, kind, sid, payload = unpack_header(envelope.fmt_msg)
+    assert (formatter_id, kind, sid) == (ProtobufFormatter.FORMATTER_ID, ENVELOPE_KIND, 0)
+
+    stream = io.BytesIO(payload)
+
+    def varint():
+        shift = result = 0
+        while True:
+            byte = ord(stream.read(1))
+            result |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return result
+
+    assert (varint(), varint(), varint(), varint()) == (1337, 0, 1, 2), 'xid, part, final and 2 records'
+    records = [stream.read(varint()) for _ in range(2)]
+    assert records == [expected[0].schema, expected[0].fmt_msg], 'The schema record and the row'
+    assert stream.read() == b''
+
+    formatter.envelope_max_bytes = len(envelope.fmt_msg) + 2
+    formatter(u'{"action":"B","xid":1338}')
+    with mock.patch.object(formatter, '_preprocess', return_value=[FULL_UPDATE, FULL_UPDATE]):
+        parts = formatter(u'')
+    parts += formatter(u'{"action":"C","xid":1338}')
+    assert len(parts) == 2, 'Schema records count towards the size'
+    for part in parts:
+        assert len(part.fmt_msg) <= formatter.envelope_max_bytes
+        assert part.fmt_msg.count(expected[0].schema) == 1, 'Every part can be read on its own'
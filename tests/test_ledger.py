@@ -0,0 +1,35 @@
+from pg2kinesis.ledger import LsnLedger
+
+
+def test_track_without_messages():
+    ledger = LsnLedger()
+    ledger.track(10, 0)
+    assert ledger.flushed_lsn == 10, 'Changes with nothing to deliver are flushed right away'
+    assert len(ledger) == 0
+
+
+def test_contiguous_watermark():
+    ledger = LsnLedger()
+    first = ledger.track(10, 2)
+    second = ledger.track(20, 1)
+    ledger.track(30, 0)
+
+    assert ledger.flushed_lsn == 0
+    assert len(ledger) == 3
+
+    assert ledger.delivered([second]) == 0, 'Later batch landed first, first change still pending'
+    assert ledger.delivered([first]) == 0, 'Only one of the two messages was delivered'
+    assert ledger.delivered([first]) == 30, 'Everything delivered, including the change after it'
+    assert len(ledger) == 0
+
+
+def test_duplicate_lsns():
+    ledger = LsnLedger()
+    begin = ledger.track(10, 0)
+    change = ledger.track(10, 1)
+
+    assert begin != change
+    assert ledger.flushed_lsn == 10
+    ledger.delivered([change, None])
+    assert ledger.flushed_lsn == 10
+    assert len(ledger) == 0
@@ -0,0 +1,100 @@
+from __future__ import unicode_literals
+
+import mock
+import pytest
+
+from pg2kinesis.metrics import Registry, PrometheusServer, StatsdReporter
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+
+@pytest.fixture()
+def registry():
+    registry = Registry()
+    registry.counter('pg2kinesis_things_total', 'Things.').inc(3)
+    registry.gauge('pg2kinesis_depth', 'Depth.').set_function(lambda: 7)
+    stage = registry.histogram('pg2kinesis_stage_seconds', 'Stages.', labelnames=('stage',), buckets=(.1, 1))
+    stage.labels(stage='put').observe(.05)
+    stage.labels(stage='put').observe(.5)
+    stage.labels(stage='put').observe(5)
+    return registry
+
+
+def test_render(registry):
+    assert registry.render().splitlines() == [
+        '# HELP pg2kinesis_things_total Things.',
+        '# TYPE pg2kinesis_things_total counter',
+        'pg2kinesis_things_total 3',
+        '# HELP pg2kinesis_depth Depth.',
+        '# TYPE pg2kinesis_depth gauge',
+        'pg2kinesis_depth 7',
+        '# HELP pg2kinesis_stage_seconds Stages.',
+        '# TYPE pg2kinesis_stage_seconds histogram',
+        'pg2kinesis_stage_seconds_bucket{stage="put",le="0.1"} 1',
+        'pg2kinesis_stage_seconds_bucket{stage="put",le="1"} 2',
+        'pg2kinesis_stage_seconds_bucket{stage="put",le="+Inf"} 3',
+        'pg2kinesis_stage_seconds_sum{stage="put"} 5.55',
+        'pg2kinesis_stage_seconds_count{stage="put"} 3',
+    ]
+
+
+def test_histogram_bucket_bounds_are_inclusive():
+    histogram = Registry().histogram('h', 'H.', buckets=(1, 2))
+    histogram.observe(1)
+    histogram.observe(2)
+    histogram.observe(2.5)
+    assert histogram.counts == [1, 1, 1]
+
+
+def test_take_and_merge():
+    worker, parent = Registry(), Registry()
+    worker_histogram = worker.histogram('h', 'H.', buckets=(1, 2))
+    parent_histogram = parent.histogram('h', 'H.', buckets=(1, 2))
+    worker_counter, parent_counter = worker.counter('c', 'C.'), parent.counter('c', 'C.')
+    worker_histogram.observe(.5)
+    worker_histogram.observe(3)
+    worker_counter.inc(2)
+    parent_histogram.observe(1.5)
+    parent_counter.inc()
+
+    parent_histogram.merge(worker_histogram.take())
+    parent_counter.inc(worker_counter.take())
+    assert (parent_histogram.counts, parent_histogram.sum, parent_histogram.count) == ([1, 1, 1], 5, 3)
+    assert parent_counter.get() == 3
+    assert (worker_histogram.counts, worker_histogram.count, worker_counter.get()) == ([0, 0, 0], 0, 0), \
+        'Taken, so only counted once'
+
+
+def test_statsd_lines(registry):
+    reporter = StatsdReporter(registry, 'localhost', prefix='app')
+    assert sorted(reporter.lines()) == [
+        'app.depth:7|g',
+        'app.stage_seconds.put.count:3|c',
+        'app.stage_seconds.put.sum:5.55|c',
+        'app.things_total:3|c',
+    ]
+
+    counter = list(registry)[0]
+    counter.inc(2)
+    assert reporter.lines() == ['app.things_total:2|c', 'app.depth:7|g'], 'Counters go out as deltas'
+
+
+def test_statsd_push(registry):
+    reporter = StatsdReporter(registry, 'localhost', 9999)
+    with mock.patch.object(reporter, '_socket') as mock_socket:
+        reporter.push()
+    packet, address = mock_socket.sendto.call_args[0]
+    assert address == ('localhost', 9999)
+    assert b'pg2kinesis.things_total:3|c' in packet.split(b'\n')
+
+
+def test_prometheus_server(registry):
+    server = PrometheusServer(registry, 0, host='127.0.0.1').start()
+    try:
+        body = urlopen('http://127.0.0.1:%s/metrics' % server.port, timeout=5).read().decode('utf-8')
+        assert body == registry.render()
+    finally:
+        server.stop()
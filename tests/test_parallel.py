@@ -0,0 +1,89 @@
+from __future__ import unicode_literals
+import json
+
+import mock
+import pytest
+
+from pg2kinesis import metrics
+from pg2kinesis.formatter import CSVPayloadFormatter, get_formatter
+from pg2kinesis.parallel import FormatterFactory, FormatterPool
+from pg2kinesis.slot import PrimaryKeyMapItem
+
+PKEY_MAP = {'public.foo': PrimaryKeyMapItem('public.foo', 'id', 'integer', 1)}
+
+
+def payload(xid, rows):
+    return json.dumps({'xid': xid, 'change': [
+        {'kind': 'insert', 'schema': 'public', 'table': 'foo', 'columnnames': ['id'], 'columntypes': ['integer'],
+         'columnvalues': [row]} for row in range(rows)]}).encode('utf-8')
+
+
+def test_formatter_factory():
+    formatter = FormatterFactory('CSVPayload', 'wal2json', True, None, primary_key_map=PKEY_MAP,
+                                 json_codec='json')()
+    assert isinstance(formatter, CSVPayloadFormatter)
+    assert formatter.full_change and formatter.codec.name == 'json'
+
+    with mock.patch('psycopg2.connect') as mock_connect:
+        formatter = FormatterFactory('CSV', 'wal2json', False, None, db_config={'database': 'db'})()
+    mock_connect.assert_called_once_with(database='db')
+    cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = [('public.foo', 'id', 'integer', 1)]
+    assert formatter.primary_key_map['public.foo'].col_name == 'id', 'Keys are looked up on its own connection'
+
+
+def test_parallel_safe():
+    assert get_formatter('CSV', PKEY_MAP, 'wal2json', False, None).parallel_safe
+    assert not get_formatter('CSV', PKEY_MAP, 'wal2json', False, None, wal2json_format_version=2).parallel_safe
+    assert not get_formatter('CSV', PKEY_MAP, 'wal2json', False, None, wal2json_write_in_chunks=True).parallel_safe
+    assert not get_formatter('CSV', PKEY_MAP, 'test_decoding', False, None).parallel_safe
+    assert not get_formatter('CSV', PKEY_MAP, 'pgoutput', False, None).parallel_safe
+
+
+def test_formatter_pool():
+    payloads = [payload(xid, xid % 5) for xid in range(1, 41)]
+    formatter = CSVPayloadFormatter(PKEY_MAP, 'wal2json', True)
+    pool = FormatterPool(FormatterFactory('CSVPayload', 'wal2json', True, None, primary_key_map=PKEY_MAP), 3,
+                         max_pending=8, batch_bytes=1000, batch_wait=60)
+    formatted = metrics.CHANGES_FORMATTED.get()
+    decoded = metrics.DECODE_SECONDS.count
+    try:
+        results = []
+        for lsn, p in enumerate(payloads):
+            pool.submit(lsn, p)
+            assert pool._batch_size < 1000, 'Sent to the workers in batches'
+            results.extend(pool.completed())
+            assert len(pool) <= 8
+        results.extend(pool.completed(keep=0))
+        assert len(pool) == 0
+
+        assert [lsn for lsn, _ in results] == list(range(len(payloads))), 'Back in the order submitted'
+        expected = [formatter(p) for p in payloads]
+        assert [fmt_msgs for _, fmt_msgs in results] == expected
+        assert metrics.DECODE_SECONDS.count - decoded == len(payloads) * 2, 'Metrics of the workers, and ours'
+        assert metrics.CHANGES_FORMATTED.get() - formatted == sum(len(fmt_msgs) for fmt_msgs in expected) * 2
+
+        pool.submit(40, payloads[0])
+        assert len(pool) == 1 and not list(pool.completed()), 'Waiting for the batch to fill'
+        pool.dispatch()
+        assert [lsn for lsn, _ in pool.completed(keep=0)] == [40]
+
+        pool.submit(41, b'not json')
+        with pytest.raises(ValueError):
+            list(pool.completed(keep=0))
+    finally:
+        pool.close()
+
+
+def test_formatter_pool_rows():
+    columns = [('id', 'integer', '7')]
+    formatter = CSVPayloadFormatter(PKEY_MAP, 'wal2json', True)
+    pool = FormatterPool(FormatterFactory('CSVPayload', 'wal2json', True, None, primary_key_map=PKEY_MAP), 1)
+    try:
+        pool.submit_row('row', 'public', 'foo', columns)
+        pool.submit('change', payload(1, 1))
+        assert pool._batch_size == 1 + len(payload(1, 1)), 'Rows are measured by their values'
+        assert list(pool.completed(keep=0)) == [('row', formatter.format_row('public', 'foo', columns)),
+                                                ('change', formatter(payload(1, 1)))]
+    finally:
+        pool.close()
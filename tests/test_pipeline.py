@@ -0,0 +1,162 @@
+import threading
+import time
+
+from mock import Mock
+import pytest
+
+from pg2kinesis.pipeline import ByteQueue, QueueClosed, SendOrder, SenderPool
+
+
+def test_byte_queue_fifo():
+    queue = ByteQueue(100)
+    queue.put('a', 10)
+    queue.put('b', 20)
+
+    assert len(queue) == 2
+    assert queue.bytes == 30
+    assert queue.get() == 'a'
+    assert queue.get() == 'b'
+    assert queue.bytes == 0
+
+
+def test_byte_queue_backpressure():
+    queue = ByteQueue(100)
+    queue.put('big', 150)
+    assert queue.bytes == 150, 'An oversize item is accepted by an empty queue'
+
+    done = threading.Event()
+
+    def producer():
+        queue.put('next', 10)
+        done.set()
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    assert not done.wait(.1), 'put blocks while the queue is full'
+
+    assert queue.get() == 'big'
+    assert done.wait(1), 'put resumes once there is room'
+    thread.join()
+    assert queue.get() == 'next'
+
+
+def test_byte_queue_close():
+    queue = ByteQueue(100)
+    queue.put('a', 10)
+    queue.close()
+
+    assert queue.get() == 'a', 'Closing still lets the queue drain'
+    assert queue.get() is None
+
+    with pytest.raises(QueueClosed):
+        queue.put('b', 10)
+
+    queue = ByteQueue(100)
+    queue.put('a', 10)
+    queue.close(drop=True)
+    assert queue.get() is None
+    assert queue.bytes == 0
+
+
+def test_send_order():
+    order = SendOrder()
+    order.add(frozenset(['a']), 1)
+    order.add(frozenset(['a', 'b']), 2)
+    order.add(frozenset(['b']), 3)
+    order.add(frozenset(['c']), 4)
+
+    assert order.take() == (frozenset(['a']), 1)
+    assert order.take() == (frozenset(['c']), 4), 'b waits behind the batch to a and b'
+    assert order.take() is None
+    order.done(frozenset(['a']))
+    assert order.take() == (frozenset(['a', 'b']), 2)
+    order.done(frozenset(['a', 'b']))
+    assert order.take() == (frozenset(['b']), 3)
+    assert not len(order)
+
+
+class FakeWriter(object):
+    """
+    Aggregates nothing and sends to the shard named by the first letter of
+    a message, slowly, noting what overlaps.
+    """
+
+    def __init__(self, delay=.005):
+        self.delay = delay
+        self.sent = []
+        self.in_flight = set()
+        self.overlapped = False
+        self.load_shards = Mock()
+        self._lock = threading.Lock()
+
+    def collect(self, fmt_msg, token):
+        return [(fmt_msg, [token])] if fmt_msg else []
+
+    def shards_of(self, records):
+        return frozenset([records[0]])
+
+    def send(self, records, tokens):
+        with self._lock:
+            assert records[0] not in self.in_flight, 'One send per shard at a time'
+            self.overlapped |= bool(self.in_flight)
+            self.in_flight.add(records[0])
+        time.sleep(self.delay)
+        with self._lock:
+            self.in_flight.discard(records[0])
+            self.sent.append((records, tokens))
+
+
+def test_sender_pool():
+    writer = FakeWriter(delay=0)
+
+    pool = SenderPool(writer, 100)
+    pool.submit(0, ['a1', 'a2'], 5)
+    pool.submit(None, [None], 0)
+    pool.submit(1, ['a3'], 5)
+    pool.close()
+
+    assert writer.sent == [('a1', [0]), ('a2', [0]), ('a3', [1])], \
+        'Messages are sent in order along with their ledger token'
+
+
+def test_sender_pool_order():
+    writer = FakeWriter()
+
+    pool = SenderPool(writer, 1000, senders=4)
+    for i in range(20):
+        pool.submit(i, ['{}{}'.format(shard, i) for shard in 'abc'], 5)
+    pool.close()
+
+    assert writer.load_shards.called
+    assert writer.overlapped, 'Shards are sent to in parallel'
+    for shard in 'abc':
+        sent = [records for records, _ in writer.sent if records[0] == shard]
+        assert sent == ['{}{}'.format(shard, i) for i in range(20)], 'In order within a shard'
+
+
+def test_sender_pool_error():
+    writer = FakeWriter(delay=0)
+    writer.send = Mock(side_effect=ValueError('boom'))
+
+    pool = SenderPool(writer, 100)
+    pool.submit(10, ['a'], 5)
+    for thread in pool._threads:
+        thread.join()
+
+    with pytest.raises(ValueError):
+        pool.submit(20, ['b'], 5)
+
+    with pytest.raises(ValueError):
+        pool.close()
+
+
+def test_sender_pool_terminate():
+    writer = FakeWriter(delay=.05)
+    pool = SenderPool(writer, 1000)
+    for token in range(20):
+        pool.submit(token, ['a%s' % token], 5)
+
+    pool.terminate()
+    assert not any(thread.is_alive() for thread in pool._threads)
+    assert len(writer.sent) < 20, 'What was queued is dropped'
+    assert pool.error is None
@@ -0,0 +1,109 @@
+import mock
+import pytest
+
+from pg2kinesis.ratelimit import ShardRateLimiter, TokenBucket
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket():
+    clock = Clock()
+    bucket = TokenBucket(100, clock=clock)
+
+    assert bucket.reserve(100) == 0, 'Starts full'
+    assert bucket.reserve(50) == .5, 'In debt, wait until it is paid back'
+
+    clock.now = 1.0
+    assert bucket.reserve(10) == 0, 'Paid back and refilled'
+    assert bucket.reserve(100) == pytest.approx(.6)
+    clock.now = 10.0
+    assert bucket.reserve(0) == 0
+    assert bucket.tokens == 100, 'Never refills past capacity'
+
+    bucket.set_rate(10)
+    assert bucket.capacity == 10
+    assert bucket.tokens == 10
+
+
+def test_acquire_paces_per_shard():
+    clock = Clock()
+    limiter = ShardRateLimiter(bytes_per_sec=1000, records_per_sec=10, clock=clock, sleep=clock.sleep)
+
+    assert limiter.acquire('a', 1000) == 0
+    assert limiter.acquire('b', 1000) == 0, 'Shards have their own budget'
+    assert limiter.acquire('a', 500) == .5
+    assert clock.now == .5, 'We slept it off'
+    assert limiter.waited == .5
+
+    for _ in range(10):
+        assert limiter.acquire('c', 1) == 0
+    assert limiter.acquire('c', 1) == pytest.approx(.1), 'Record limit applies too'
+
+
+def test_throttle_and_recover():
+    clock = Clock()
+    limiter = ShardRateLimiter(bytes_per_sec=1000, records_per_sec=10, floor=.2, recovery=.1,
+                               clock=clock, sleep=clock.sleep)
+
+    limiter.throttled('a')
+    assert limiter.rates()['a'] == (500, 5)
+    limiter.throttled('a')
+    limiter.throttled('a')
+    assert limiter.rates()['a'] == (200, 2), 'Never below the floor'
+    assert limiter.throttles == 3
+
+    limiter.succeeded('a')
+    assert limiter.rates()['a'] == (pytest.approx(300), pytest.approx(3))
+    for _ in range(20):
+        limiter.succeeded('a')
+    assert limiter.rates()['a'] == (1000, 10), 'Never above the limit'
+
+
+def test_fraction():
+    limiter = ShardRateLimiter(bytes_per_sec=1000, records_per_sec=10, fraction=.8)
+    limiter.acquire('a', 1)
+    assert limiter.rates()['a'] == (800, 8)
+    limiter.succeeded('a')
+    assert limiter.rates()['a'] == (800, 8)
+
+
+def test_report():
+    clock = Clock()
+    limiter = ShardRateLimiter(bytes_per_sec=1000, records_per_sec=10, report_interval=60,
+                               clock=clock, sleep=clock.sleep)
+
+    with mock.patch.object(limiter, 'report') as mock_report:
+        limiter.acquire('a', 1)
+        assert not mock_report.called
+        clock.now = 60
+        limiter.acquire('a', 1)
+        assert mock_report.called, 'Reported once the interval passed'
+
+    with mock.patch('logging.Logger.info') as mock_log:
+        limiter.report()
+        mock_log.assert_called_with('Rate limiter: shards: 1 slowest: 1000 bytes/s throttles: 0 waited: 0.0s')
+
+
+def test_for_stream():
+    clock = Clock()
+    limiter = ShardRateLimiter(bytes_per_sec=1000, records_per_sec=10, clock=clock, sleep=clock.sleep)
+    one, two = limiter.for_stream('one'), limiter.for_stream('two')
+
+    assert one.acquire('shardId-0', 1000) == 0
+    assert two.acquire('shardId-0', 1000) == 0, 'The same shard id of another stream is another shard'
+    assert one.acquire('shardId-0', 500) == .5
+    assert one.waited == two.waited == limiter.waited == .5
+
+    two.throttled('shardId-0')
+    assert limiter.rates() == {'one/shardId-0': (1000, 10), 'two/shardId-0': (500, 5)}
+    two.succeeded('shardId-0')
+    assert limiter.rates()['two/shardId-0'][0] == 510
@@ -0,0 +1,31 @@
+from __future__ import unicode_literals
+
+import pytest
+
+from pg2kinesis.schema import HEADER, SCHEMA_KIND, SchemaCache, pack_header, schema_id, unpack_header
+
+
+def test_schema_cache():
+    cache = SchemaCache()
+    columns = (('id', 'integer'), ('name', 'text'))
+
+    table_schema, is_new = cache.get('public.t', columns, (('id', 'integer'),))
+    assert is_new
+    assert table_schema.schema_id == schema_id('public.t', columns, (('id', 'integer'),)), 'Ids are stable'
+
+    assert cache.get('public.t', columns, (('id', 'integer'),)) == (table_schema, False)
+
+    altered, is_new = cache.get('public.t', columns + (('note', 'text'),), (('id', 'integer'),))
+    assert is_new, 'A changed table gets a new schema'
+    assert altered.schema_id != table_schema.schema_id
+    assert len(cache) == 2
+
+
+def test_header():
+    table_schema = SchemaCache().get('public.t', (), ())[0]
+    data = pack_header(3, SCHEMA_KIND, table_schema) + b'payload'
+    assert len(data) == HEADER.size + 7
+    assert unpack_header(data) == (3, SCHEMA_KIND, table_schema.schema_id, b'payload')
+
+    with pytest.raises(ValueError):
+        unpack_header(b'\x00' * HEADER.size)
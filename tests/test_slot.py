@@ -4,7 +4,9 @@ import pytest
 import psycopg2
 import psycopg2.errorcodes
 
-from pg2kinesis.slot import SlotReader
+from pg2kinesis import metrics
+from pg2kinesis.slot import LagMonitor, PeekedMessage, PrimaryKeyMapItem, PrimaryKeyResolver, SlotReader, \
+    format_lsn, parse_lsn
 
 
 @pytest.fixture
@@ -82,6 +84,19 @@ def test_create_slot(slot):
                                                                          output_plugin=u'test_decoding')
 
 
+def test_create_slot_export_snapshot(slot):
+    slot._repl_conn.server_version = 100005
+    slot._repl_cursor.fetchone.return_value = ('pg2kinesis', '0/16B3748', '00000003-00000002-1', 'test_decoding')
+    assert slot.create_slot(export_snapshot=True) == '00000003-00000002-1'
+    slot._repl_cursor.execute.assert_called_once_with(
+        'CREATE_REPLICATION_SLOT "pg2kinesis" LOGICAL test_decoding EXPORT_SNAPSHOT')
+
+    slot._repl_conn.server_version = 90600
+    slot._repl_cursor.execute.reset_mock()
+    slot.create_slot(export_snapshot=True)
+    slot._repl_cursor.execute.assert_called_once_with('CREATE_REPLICATION_SLOT "pg2kinesis" LOGICAL test_decoding')
+
+
 def test_delete_slot(slot):
     with patch.object(psycopg2.ProgrammingError, 'pgcode',
                       new_callable=PropertyMock,
@@ -122,22 +137,49 @@ def test__get_connection(slot):
 
 
 def test_primary_key_map(slot):
-    slot._execute_and_fetch = Mock(return_value=[('test_table', 'pkey', 'uuid', 0),
-                                                 ('test_table2', 'pkey', 'uuid', 0),
-                                                 ('blue', 'bkey', 'char var', 10)
-                                                 ])
+    slot._execute_and_fetch = Mock(return_value=[('public.blue', 'bkey', 'char var', 10)])
 
     pkey_map = slot.primary_key_map
+    assert isinstance(pkey_map, PrimaryKeyResolver)
+    assert pkey_map is slot.primary_key_map, 'One resolver per slot'
+    assert not slot._execute_and_fetch.called, 'Nothing is looked up at start up'
+
+    assert pkey_map['public.blue'] == PrimaryKeyMapItem('public.blue', 'bkey', 'char var', 10)
+    slot._execute_and_fetch.assert_called_once_with(PrimaryKeyResolver.PK_SQL, 'public.blue', '"public"."blue"')
+
+
+def test_primary_key_resolver():
+    tables = {
+        '"public"."pair"': [('public.pair', 'a', 'text', 2), ('public.pair', 'b', 'integer', 1)],
+        '"public"."no_pk"': [('public.no_pk', None, None, None)],
+        '"odd ""schema"""."Table"': [('odd "schema".Table', 'id', 'uuid', 1)],
+    }
+    execute_and_fetch = Mock(side_effect=lambda sql, table_name, regclass: tables.get(regclass, []))
+    resolver = PrimaryKeyResolver(execute_and_fetch)
+
+    assert resolver['public.pair'] == PrimaryKeyMapItem('public.pair', ('a', 'b'), ('text', 'integer'), (2, 1))
+    assert resolver['public.pair'].col_names == ('a', 'b'), 'Composite keys keep key order'
+    assert resolver['public.no_pk'].col_names == (None,)
+    assert resolver['odd "schema".Table'].col_name == 'id', 'Names are quoted for to_regclass'
+    assert execute_and_fetch.call_count == 3
+
+    assert resolver['public.pair'] and execute_and_fetch.call_count == 3, 'Keys are cached'
+    assert len(resolver) == 3
 
-    assert len(pkey_map) == 3
-    assert 'test_table' in pkey_map
-    assert 'test_table2' in pkey_map
-    assert 'blue' in pkey_map
+    with pytest.raises(KeyError):
+        resolver['public.created_later']
+    assert resolver.get('public.created_later') is None
+    assert 'public.created_later' not in resolver
 
-    assert pkey_map['blue'].table_name == 'blue'
-    assert pkey_map['blue'].col_name == 'bkey'
-    assert pkey_map['blue'].col_type == 'char var'
-    assert pkey_map['blue'].col_ord_pos == 10
+    tables['"public"."created_later"'] = [('public.created_later', 'id', 'integer', 1)]
+    assert 'public.created_later' in resolver, 'Misses are looked up again'
+
+    resolver.invalidate('public.pair')
+    resolver['public.pair']
+    assert resolver.refresh('public.pair').col_names == ('a', 'b')
+    resolver.invalidate()
+    assert len(resolver) == 0
+    assert resolver.lookups == execute_and_fetch.call_count == 9
 
 
 def test_execute_and_fetch(slot):
@@ -157,8 +199,220 @@ def test_execute_and_fetch(slot):
 
 def test_process_replication_stream(slot):
     consume = Mock()
-    slot.process_replication_stream(consume)
+    tick = Mock()
+    slot._repl_cursor.read_message = Mock(side_effect=['msg1', None, 'msg2', KeyboardInterrupt])
+
+    with patch('select.select') as mock_select, patch('time.time', side_effect=[0, 0, 0, .5, .5, 2, 2, 2]), \
+            pytest.raises(KeyboardInterrupt):
+        slot.process_replication_stream(consume, tick)
+
+    assert call.start_replication('pg2kinesis', options=None, decode=True) in slot._repl_cursor.method_calls, 'We started replication'
+    assert consume.call_args_list == [call('msg1'), call('msg2')], 'We pass each message to consume'
+    mock_select.assert_called_once_with([slot._repl_cursor], [], [], .5), 'Waited until the next tick'
+    tick.assert_called_once_with(slot._repl_cursor)
+
+    slot.output_plugin = 'wal2json'
+    slot._repl_cursor.read_message = Mock(side_effect=KeyboardInterrupt)
+    with pytest.raises(KeyboardInterrupt):
+        slot.process_replication_stream(consume)
+    assert call.start_replication('pg2kinesis', options={'include-xids': 1}, decode=False) in slot._repl_cursor.method_calls
+
+    slot.wal2json_format_version = 2
+    with pytest.raises(KeyboardInterrupt):
+        slot.process_replication_stream(consume)
+    assert slot._repl_cursor.start_replication.call_args == call(
+        'pg2kinesis', options={'include-xids': 1, 'format-version': 2}, decode=False)
+
+    slot.wal2json_format_version = 1
+    slot.wal2json_write_in_chunks = True
+    with pytest.raises(KeyboardInterrupt):
+        slot.process_replication_stream(consume)
+    assert slot._repl_cursor.start_replication.call_args == call(
+        'pg2kinesis', options={'include-xids': 1, 'write-in-chunks': 1}, decode=False)
+
+    slot.output_plugin = 'pgoutput'
+    with pytest.raises(KeyboardInterrupt):
+        slot.process_replication_stream(consume)
+    assert slot._repl_cursor.start_replication.call_args == call(
+        'pg2kinesis', options={'proto_version': '1', 'publication_names': 'pg2kinesis'}, decode=False)
+
+    slot.output_plugin = 'wal2json'
+    slot.wal2json_write_in_chunks = False
+    slot.tables = [('public', 'a b'), ('*', 'c')]
+    slot.exclude_tables = [('public', '*')]
+    with pytest.raises(KeyboardInterrupt):
+        slot.process_replication_stream(consume)
+    assert slot._repl_cursor.start_replication.call_args == call(
+        'pg2kinesis', options={'include-xids': 1, 'add-tables': 'public.a\\ b,*.c', 'filter-tables': 'public.*'},
+        decode=False)
+
+
+def test_create_publication(slot):
+    slot._execute = Mock()
+    slot._execute_and_fetch = Mock(return_value=[(1,)])
+    slot.create_publication()
+    assert not slot._execute.called, 'Existing publications are left alone'
+
+    slot._execute_and_fetch = Mock(return_value=[])
+    slot.create_publication()
+    slot._execute.assert_called_once_with('CREATE PUBLICATION "pg2kinesis" FOR ALL TABLES')
+
+    slot._execute.reset_mock()
+    slot.tables = [('public', '*'), ('*', 'c')]
+    slot.exclude_tables = [('public', 'b')]
+    slot._execute_and_fetch = Mock(side_effect=[[], [('public', 'a'), ('public', 'b'), ('other', 'c'),
+                                                     ('other', 'd'), ('public', 'Odd')]])
+    slot.create_publication()
+    slot._execute.assert_called_once_with(
+        'CREATE PUBLICATION "pg2kinesis" FOR TABLE "public"."a", "other"."c", "public"."Odd"')
+
+    slot._execute.reset_mock()
+    slot.tables = slot.exclude_tables = None
+    slot.publication_names = 'first, second,third'
+    slot._execute_and_fetch = Mock(side_effect=[[], [(1,)], []])
+    slot.create_publication()
+    assert slot._execute_and_fetch.call_args_list == [call(slot.PUBLICATION_EXISTS_SQL, name)
+                                                      for name in ('first', 'second', 'third')]
+    assert slot._execute.call_args_list == [call('CREATE PUBLICATION "first" FOR ALL TABLES'),
+                                            call('CREATE PUBLICATION "third" FOR ALL TABLES')]
+
+
+def test_lag_monitor():
+    clock = Mock(return_value=100.0)
+    execute_and_fetch = Mock(return_value=[(1000, 400, 300)])
+    monitor = LagMonitor(execute_and_fetch, 'pg2kinesis', 110005, clock=clock)
+    assert 'pg_current_wal_lsn' in monitor.sql and 'confirmed_flush_lsn' in monitor.sql
+    listener = Mock()
+    monitor.listeners.append(listener)
+
+    monitor.poll()
+    execute_and_fetch.assert_called_once_with(monitor.sql, 'pg2kinesis')
+    listener.assert_called_once_with(monitor)
+    assert (monitor.byte_lag, monitor.retained_bytes, monitor.seconds_lag) == (600, 700, 0)
+
+    clock.return_value = 110.0
+    execute_and_fetch.return_value = [(1500, 900, 800)]
+    monitor.poll()
+    assert monitor.byte_lag == 600
+    assert monitor.seconds_lag == 10, 'The server was at 1000 when polled 10s ago, the slot has not reached it'
+
+    clock.return_value = 120.0
+    execute_and_fetch.return_value = [(2000, 1200, 1100)]
+    monitor.poll()
+    assert monitor.seconds_lag == 10, 'Caught up with the first poll, the second was 10s ago'
+
+    clock.return_value = 130.0
+    execute_and_fetch.return_value = [(2000, 2000, 1900)]
+    monitor.poll()
+    assert (monitor.byte_lag, monitor.seconds_lag) == (0, 0)
+
+    execute_and_fetch.return_value = []
+    monitor.poll()
+    assert listener.call_count == 4, 'Nothing to report when the slot is gone'
+
+
+def test_lag_monitor_metrics():
+    orders = LagMonitor(Mock(return_value=[(1000, 400, 300)]), 'orders', 110005, pipeline='orders')
+    users = LagMonitor(Mock(return_value=[(1000, 900, 800)]), 'users', 110005, pipeline='users')
+    orders.poll()
+    users.poll()
+    assert metrics.SLOT_LAG_BYTES.labels(pipeline='orders').get() == 600
+    assert metrics.SLOT_LAG_BYTES.labels(pipeline='users').get() == 100
+    assert metrics.SLOT_RETAINED_BYTES.labels(pipeline='orders').get() == 700
+
+    LagMonitor(Mock(return_value=[(5000, 0, 0)]), 'unlabeled', 110005).poll()
+    # Only exported with a pipeline.
+    assert (('pipeline', 'unlabeled'),) not in [labels for _, labels, _ in metrics.SLOT_LAG_BYTES.samples()]
+
+
+def test_lag_monitor_sql_by_version():
+    assert 'pg_current_xlog_location' in LagMonitor(Mock(), 's', 90603).sql
+    assert 'confirmed_flush_lsn' in LagMonitor(Mock(), 's', 90603).sql
+    assert 'confirmed_flush_lsn' not in LagMonitor(Mock(), 's', 90500).sql
+
+
+def test_start_lag_monitor(slot):
+    slot._normal_conn.server_version = 120000
+    with patch.object(LagMonitor, 'start', lambda self: self):
+        monitor = slot.start_lag_monitor(5)
+    assert monitor.interval == 5
+    monitor._execute_and_fetch = Mock(return_value=[(1000, 400, 300)])
+    monitor.poll()
+    assert slot.cur_lag == 600
+    assert metrics.SLOT_LAG_BYTES.labels(pipeline=slot.slot_name).get() == 600, 'Labeled with the slot by default'
+
+    slot.__exit__(None, None, None)
+    assert monitor._stopped.is_set()
+
+
+def test_lsn():
+    assert parse_lsn('16/B374D848') == 0x16B374D848
+    assert format_lsn(0x16B374D848) == '16/B374D848'
+    assert format_lsn(parse_lsn('0/0')) == '0/0'
+
+
+def test_catch_up(slot):
+    slot.output_plugin = 'wal2json'
+    slot.tables = [('public', '*')]
+    lags = iter([5000, 3000, 10])
+
+    def poll():
+        slot.lag_monitor.byte_lag = next(lags)
+
+    slot.lag_monitor = Mock(poll=Mock(side_effect=poll))
+    batches = iter([[('0/10', 1, memoryview(b'{"xid":1}')), ('0/20', 2, memoryview(b'{"xid":2}'))],
+                    [('0/30', 3, memoryview(b'{"xid":3}'))]])
+    slot._execute_and_fetch = Mock(side_effect=lambda sql, *params: next(batches) if 'peek' in sql else [])
+    slot._normal_conn.server_version = 110000
+
+    consumed = []
+
+    class Consume(object):
+        def __call__(self, msg):
+            consumed.append(msg)
+
+        def flush(self, cursor):
+            cursor.send_feedback(flush_lsn=consumed[-1].data_start)
+
+    assert slot.catch_up(Consume(), 1000, 2) == 3
+    assert [(m.payload, m.data_start, m.data_size) for m in consumed] == [
+        (b'{"xid":1}', 0x10, 9), (b'{"xid":2}', 0x20, 9), (b'{"xid":3}', 0x30, 9)]
+
+    peek, advance, peek2, advance2 = slot._execute_and_fetch.call_args_list
+    assert peek == call(SlotReader.PEEK_SQL, 'pg2kinesis', 2,
+                        ['add-tables', 'public.*', 'include-xids', '1'])
+    assert advance == call(SlotReader.ADVANCE_SQL, 'pg2kinesis', '0/20'), 'Advanced to what was acknowledged'
+    assert advance2 == call(SlotReader.ADVANCE_SQL, 'pg2kinesis', '0/30')
+    assert slot.lag_monitor.poll.call_count == 3, 'Streams once under the lag'
+
+
+def test_catch_up_test_decoding(slot):
+    slot.lag_monitor = Mock(byte_lag=5000)
+    slot._execute_and_fetch = Mock(side_effect=[[('0/10', 1, memoryview(b'BEGIN 1'))], [], []])
+    slot._normal_conn.server_version = 100000
+    consume = Mock()
+
+    assert slot.catch_up(consume, 1000) == 1
+    assert consume.call_args[0][0] == PeekedMessage('BEGIN 1', 0x10, 7, consume.flush.call_args[0][0])
+    assert len(slot._execute_and_fetch.call_args_list) == 2, 'An empty batch ends catching up'
+    assert slot._execute_and_fetch.call_args_list[0][0][3] == [], 'test_decoding takes no options'
+
+
+def test_catch_up_pgoutput(slot):
+    slot.output_plugin = 'pgoutput'
+    slot._execute_and_fetch = Mock()
+    assert slot.catch_up(Mock(), 1000) == 0
+    assert not slot._execute_and_fetch.called
+
 
-    assert call.start_replication('pg2kinesis', options=None) in  slot._repl_cursor.method_calls, 'We started replication event loop'
-    assert call.consume_stream(consume) in slot._repl_cursor.method_calls, 'We pass consume to this method'
+def test_advance_slot(slot):
+    slot._execute_and_fetch = Mock()
+    slot._normal_conn.server_version = 110000
+    slot.advance_slot(0x20)
+    slot._execute_and_fetch.assert_called_once_with(SlotReader.ADVANCE_SQL, 'pg2kinesis', '0/20')
 
+    slot._execute_and_fetch.reset_mock()
+    # Before 11 the changes are decoded again.
+    slot._normal_conn.server_version = 100000
+    slot.advance_slot(0x20)
+    slot._execute_and_fetch.assert_called_once_with(SlotReader.CONSUME_SQL, 'pg2kinesis', '0/20', [])
@@ -0,0 +1,220 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import threading
+
+from mock import MagicMock, Mock
+import pytest
+
+from pg2kinesis.formatter import CSVFormatter
+from pg2kinesis.slot import PrimaryKeyMapItem
+from pg2kinesis.snapshot import Backfill, Chunk, _CopyRows, parse_copy_line
+
+COLUMNS = {
+    '"public"."blue"': [('id', 'integer'), ('note', 'text')],
+    '"public"."green"': [('name', 'text'), ('note', 'text')],
+    '"public"."empty"': [('id', 'bigint')],
+}
+# The oids of the types in COLUMNS.
+OIDS = {'integer': 23, 'bigint': 20, 'text': 25, 'numeric': 1700, 'mood': 16386}
+ROWS = {
+    '"public"."blue"': [(i, 'note {}'.format(i)) for i in range(1, 26)],
+    '"public"."green"': [('a', None), ('b', 'tab\there')],
+    '"public"."empty"': [],
+}
+
+
+def copy_line(values):
+    return '\t'.join('\\N' if v is None else str(v).replace('\\', '\\\\').replace('\t', '\\t') for v in values)
+
+
+class FakeCursor(object):
+    """
+    Answers the catalog queries and COPYs of Backfill from COLUMNS and ROWS.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        self.conn.statements.append((sql, params))
+        if 'pg_class' in sql:
+            self._result = [('public', 'green'), ('public', 'blue'), ('other', 'blue'), ('public', 'empty')]
+        elif 'pg_attribute' in sql:
+            self._result = [(name, OIDS[col_type.split('(')[0]], col_type.split('(')[0], col_type.split('(')[0],
+                             col_type) for name, col_type in COLUMNS[params[0]]]
+        elif 'row_number()' in sql:
+            relation = sql.split(' FROM ')[-1].split()[0]
+            keys = sorted(row[0] for row in ROWS[relation])
+            self._result = [(key,) for i, key in enumerate(keys) if not i % params[0]]
+
+    def fetchall(self):
+        return self._result
+
+    def copy_expert(self, sql, file):
+        self.conn.statements.append((sql, None))
+        relation = sql.split(' FROM ')[1].split(' ')[0].rstrip(')')
+        rows = ROWS[relation]
+        if ' WHERE ' in sql:
+            low = int(sql.split('>= ')[1].split(' ')[0].rstrip(')'))
+            high = int(sql.split('< ')[1].split(')')[0]) if ' < ' in sql else float('inf')
+            rows = [row for row in rows if low <= row[0] < high]
+        data = ''.join(copy_line(row) + '\n' for row in rows).encode('utf-8')
+        # In pieces, split mid line.
+        for i in range(0, len(data), 7):
+            file.write(data[i:i + 7])
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.statements = []
+        self.closed = False
+        self.set_session = Mock()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def formatter():
+    return CSVFormatter({'public.blue': PrimaryKeyMapItem('public.blue', 'id', 'integer', 0),
+                         'public.green': PrimaryKeyMapItem('public.green', 'name', 'text', 0),
+                         'public.empty': PrimaryKeyMapItem('public.empty', 'id', 'bigint', 0)},
+                        table_pat=r'^public\.')
+
+
+def test_parse_copy_line():
+    assert parse_copy_line('1\t\\N\ta\\tb\\\\c\\nd') == ['1', None, 'a\tb\\c\nd']
+    assert parse_copy_line('\\x41\\101') == ['AA']
+
+
+def test_copy_rows():
+    rows = []
+    copy_rows = _CopyRows(Chunk('public', 'blue', [('id', 'integer'), ('note', 'text')], ''), rows.append)
+    for piece in (b'1\tone\n2', b'\tt', 'wö\n'.encode('utf-8')):
+        copy_rows.write(piece)
+    assert [columns for _, columns in rows] == [[('id', 'integer', '1'), ('note', 'text', 'one')],
+                                                [('id', 'integer', '2'), ('note', 'text', 'twö')]]
+    assert copy_rows.rows == 2
+
+
+def test_chunks(formatter):
+    backfill = Backfill({}, 'snap', chunk_rows=10)
+    chunks = backfill.chunks(FakeConnection(), formatter)
+
+    assert [(c.schema, c.table) for c in chunks] == [('public', 'blue')] * 3 + [('public', 'green')], \
+        'Filtered by table_pat, empty tables skipped'
+    assert chunks[0].copy_sql == \
+        'COPY (SELECT "id", "note" FROM "public"."blue" WHERE "id" >= 1 AND "id" < 11) TO STDOUT'
+    assert chunks[2].copy_sql.endswith('WHERE "id" >= 21) TO STDOUT'), 'The last chunk takes the rest'
+    assert chunks[3].copy_sql == 'COPY (SELECT "name", "note" FROM "public"."green") TO STDOUT', \
+        'Keys that are not integers are copied whole'
+
+
+def test_chunks_sparse_keys(formatter, monkeypatch):
+    keys = [1, 2, 3, 10 ** 9, 10 ** 12, 10 ** 12 + 1, 2 ** 62]
+    monkeypatch.setitem(ROWS, '"public"."blue"', [(key, 'note') for key in keys])
+    chunks = Backfill({}, 'snap', chunk_rows=3).chunks(FakeConnection(), formatter)
+
+    copy_sql = 'COPY (SELECT "id", "note" FROM "public"."blue" WHERE "id" {}) TO STDOUT'
+    assert [c.copy_sql for c in chunks if c.table == 'blue'] == [
+        copy_sql.format('>= 1 AND "id" < {}'.format(10 ** 9)),
+        copy_sql.format('>= {} AND "id" < {}'.format(10 ** 9, 2 ** 62)),
+        copy_sql.format('>= {}'.format(2 ** 62)),
+    ], 'Chunks of chunk_rows rows however far apart the keys are'
+
+
+@pytest.mark.parametrize('output_plugin, types', [
+    ('test_decoding', ['integer', 'numeric', 'numeric', 'mood']),
+    ('wal2json', ['integer', 'numeric(10,2)', 'numeric', 'mood']),
+    ('pgoutput', ['integer', 'numeric', 'numeric', 'mood']),
+])
+def test_chunks_column_types(monkeypatch, output_plugin, types):
+    monkeypatch.setitem(COLUMNS, '"public"."blue"',
+                        [('id', 'integer'), ('price', 'numeric(10,2)'), ('amount', 'numeric'), ('feel', 'mood')])
+    formatter = CSVFormatter({'public.blue': PrimaryKeyMapItem('public.blue', 'id', 'integer', 0)},
+                             output_plugin=output_plugin, tables=[('public', 'blue')])
+    chunks = Backfill({}, 'snap').chunks(FakeConnection(), formatter)
+    assert [col_type for _, col_type in chunks[0].columns] == types, 'Typed as the stream types them'
+
+
+def test_run(formatter):
+    connections = []
+
+    def connect(**kwargs):
+        assert kwargs == {'database': 'db'}
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    writer = Mock()
+    backfill = Backfill({'database': 'db'}, 'snap', workers=2, chunk_rows=10, connect=connect)
+    assert backfill.run(formatter, writer) == 27
+
+    sent = sorted(call[0][0].fmt_msg for call in writer.put_message.call_args_list)
+    assert sent == sorted(['0,CDC,0,public.blue,INSERT,{}'.format(i) for i in range(1, 26)] +
+                          ['0,CDC,0,public.green,INSERT,a', '0,CDC,0,public.green,INSERT,b'])
+    assert writer.flush.called, 'Partial aggregates are sent before streaming starts'
+
+    assert len(connections) == 3, 'One to plan and one per worker'
+    for conn in connections:
+        conn.set_session.assert_called_once_with(isolation_level='REPEATABLE READ', readonly=True)
+        assert conn.statements[0] == ('SET TRANSACTION SNAPSHOT %s', ('snap',)), 'Every connection sees the snapshot'
+        assert conn.closed
+    copies = [sql for conn in connections[1:] for sql, _ in conn.statements if sql.startswith('COPY')]
+    assert len(copies) == 4
+
+
+def test_run_worker_error(formatter):
+    def connect(**kwargs):
+        conn = FakeConnection()
+        conn.cursor = MagicMock(side_effect=RuntimeError('boom')) if len(connections) else conn.cursor
+        connections.append(conn)
+        return conn
+
+    connections = []
+    with pytest.raises(RuntimeError):
+        Backfill({}, 'snap', workers=1, connect=connect).run(formatter, Mock())
+
+
+def test_run_format_pool(formatter):
+    class InlinePool(object):
+        def __init__(self):
+            self.done = []
+            self.dispatched = 0
+
+        def submit_row(self, item, schema, table, columns):
+            self.done.append((item, formatter.format_row(schema, table, columns)))
+
+        def dispatch(self):
+            self.dispatched += 1
+
+        def completed(self, keep=None):
+            done, self.done = self.done, []
+            return done
+
+    writer = Mock()
+    backfill = Backfill({}, 'snap', workers=2, chunk_rows=10, connect=lambda **kwargs: FakeConnection())
+    assert backfill.run(formatter, writer, InlinePool()) == 27
+    assert writer.put_message.call_count == 27
+
+
+def test_run_writer_error(formatter):
+    """
+    The workers, blocked on a full queue, stop when the writer fails.
+    """
+    writer = Mock()
+    writer.put_message.side_effect = RuntimeError('boom')
+    backfill = Backfill({}, 'snap', workers=2, chunk_rows=5, max_pending=1, connect=lambda **kwargs: FakeConnection())
+    with pytest.raises(RuntimeError):
+        backfill.run(formatter, writer)
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('pg2kinesis-backfill')]
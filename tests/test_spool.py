@@ -0,0 +1,201 @@
+from __future__ import unicode_literals
+import os
+import threading
+
+from mock import Mock
+import pytest
+
+from pg2kinesis.formatter import Change, Message
+from pg2kinesis.ledger import LsnLedger
+from pg2kinesis.spool import FRAME, Spool, SpoolClosed, SpoolCorrupt, SpoolDrainer, SpoolWriter
+
+
+def message(i):
+    return Message(change=Change(xid=i, table='public.blue', operation='UPDATE', pkey=str(i)),
+                   fmt_msg='0,CDC,{},public.blue,UPDATE,{}'.format(i, i))
+
+
+@pytest.fixture
+def clock():
+    return Mock(return_value=100.0)
+
+
+def test_append_and_read(tmpdir, clock):
+    spool = Spool(str(tmpdir), fsync='interval', fsync_interval=1, clock=clock)
+    first = spool.append(message(1))
+    second = spool.append(message(2))
+
+    assert spool.read(0, timeout=0) == [], 'Nothing is durable yet'
+    assert spool.sync() == 0, 'Not time to fsync'
+    clock.return_value = 101.0
+    assert spool.sync() == second
+
+    assert spool.read(0) == [(first, message(1)), (second, message(2))]
+    assert spool.read(first) == [(second, message(2))]
+    assert spool.read(0, max_records=1) == [(first, message(1))]
+    assert spool.read(second, timeout=0) == []
+
+    spool.append(message(3))
+    assert spool.sync(force=True) == spool.write_pos
+    spool.close()
+
+
+def test_segments_and_checkpoint(tmpdir):
+    spool = Spool(str(tmpdir), segment_bytes=100, fsync='always')
+    positions = [spool.append(message(i)) for i in range(10)]
+    segments = sorted(f for f in os.listdir(str(tmpdir)) if f.endswith('.seg'))
+    assert len(segments) > 3
+    assert [p for p, _ in spool.read(0, max_records=100)] == positions, 'Reads across segments'
+
+    spool.drained(positions[5])
+    assert len(os.listdir(str(tmpdir))) < len(segments) + 1, 'Delivered segments are deleted'
+    assert spool.drained_pos == positions[5]
+    spool.close()
+
+    reopened = Spool(str(tmpdir), segment_bytes=100, fsync='always')
+    assert reopened.drained_pos == positions[5]
+    assert reopened.write_pos == positions[-1]
+    assert [m.change.xid for _, m in reopened.read(reopened.drained_pos, max_records=100)] == [6, 7, 8, 9]
+    assert reopened.append(message(10)) > positions[-1]
+    reopened.close()
+
+
+def test_recovers_a_torn_tail(tmpdir):
+    spool = Spool(str(tmpdir), fsync='always')
+    position = spool.append(message(1))
+    spool.append(message(2))
+    spool.close()
+
+    path = os.path.join(str(tmpdir), '{:020d}.seg'.format(0))
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    reopened = Spool(str(tmpdir), fsync='always')
+    assert reopened.write_pos == position
+    assert reopened.read(0) == [(position, message(1))]
+    reopened.close()
+
+
+def test_read_checks_the_checksum(tmpdir):
+    spool = Spool(str(tmpdir), fsync='always')
+    spool.append(message(1))
+    with open(os.path.join(str(tmpdir), '{:020d}.seg'.format(0)), 'r+b') as f:
+        f.seek(FRAME.size + 2)
+        f.write(b'X')
+
+    with pytest.raises(SpoolCorrupt):
+        spool.read(0)
+    spool.close()
+
+
+def test_append_waits_while_full(tmpdir):
+    spool = Spool(str(tmpdir), segment_bytes=1, fsync='never')
+    positions = [spool.append(message(i)) for i in range(3)]
+    spool.max_bytes = spool.bytes
+
+    appended = threading.Event()
+    thread = threading.Thread(target=lambda: appended.set() if spool.append(message(3)) else None)
+    thread.daemon = True
+    thread.start()
+    assert not appended.wait(.2), 'Full'
+
+    spool.drained(positions[1])
+    assert appended.wait(5), 'Room once delivered segments are deleted'
+    thread.join()
+    spool.close()
+
+
+def test_append_after_close(tmpdir):
+    spool = Spool(str(tmpdir), fsync='never')
+    spool.append(message(0))
+    spool.max_bytes = spool.bytes
+
+    errors = []
+
+    def append():
+        try:
+            spool.append(message(1))
+        except SpoolClosed as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=append)
+    thread.daemon = True
+    thread.start()
+    thread.join(.2)
+    assert thread.is_alive(), 'Full'
+
+    spool.close()
+    thread.join(5)
+    assert len(errors) == 1, 'Closing stops the wait without writing to the closed segment'
+    with pytest.raises(SpoolClosed):
+        spool.append(message(2))
+
+
+def test_spool_writer(tmpdir, clock):
+    spool = Spool(str(tmpdir), fsync='interval', fsync_interval=1, clock=clock)
+    ledger = LsnLedger()
+    writer = SpoolWriter(spool, ledger)
+
+    token = ledger.track(10, 2)
+    assert writer.put_message(message(1), token) is None
+    assert writer.put_message(message(2), token) is None
+    assert ledger.flushed_lsn == 0, 'Not on disk yet'
+
+    clock.return_value = 101.0
+    assert writer.put_message(None) == spool.write_pos
+    assert ledger.flushed_lsn == 10, 'Acknowledged once durable'
+
+    token = ledger.track(20, 1)
+    writer.put_message(message(3), token)
+    writer.flush()
+    assert ledger.flushed_lsn == 20, 'flush does not wait for the fsync interval'
+
+    writer.drainer = Mock(error=SpoolCorrupt('bad'))
+    with pytest.raises(SpoolCorrupt):
+        writer.put_message(message(4))
+    spool.close()
+
+
+def test_spool_drainer(tmpdir):
+    spool = Spool(str(tmpdir), fsync='always')
+    positions = [spool.append(message(i)) for i in range(5)]
+
+    sent = []
+
+    class FakeWriter(object):
+        def __init__(self, ledger):
+            self.ledger = ledger
+
+        def put_message(self, fmt_msg, token=None):
+            if fmt_msg:
+                sent.append(fmt_msg)
+                self.ledger.delivered([token])
+                if len(sent) == 5:
+                    drainer._stopped.set()
+
+    drainer = SpoolDrainer(spool, FakeWriter)
+    drainer.drain()
+    assert sent == [message(i) for i in range(5)]
+    assert spool.drained_pos == positions[-1], 'The checkpoint follows deliveries'
+
+
+def test_spool_drainer_retries(tmpdir):
+    spool = Spool(str(tmpdir), fsync='always')
+    spool.append(message(1))
+    writers = []
+
+    def make_writer(ledger):
+        writer = Mock()
+        if not writers:
+            writer.put_message.side_effect = Exception('Kinesis is down')
+        else:
+            writer.put_message.side_effect = lambda *args: drainer._stopped.set()
+        writers.append(writer)
+        return writer
+
+    drainer = SpoolDrainer(spool, make_writer, retry_interval=0)
+    drainer.start()
+    drainer._thread.join(5)
+    assert len(writers) == 2, 'Started over with a new writer'
+    assert writers[1].put_message.call_args[0][0] == message(1), 'From the last delivered record'
+    assert drainer.error is None
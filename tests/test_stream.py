@@ -1,3 +1,4 @@
+import itertools
 import time
 
 from freezegun import freeze_time
@@ -6,7 +7,11 @@ import pytest
 import boto3
 from botocore.exceptions import ClientError
 
-from pg2kinesis.stream import StreamWriter
+from pg2kinesis import metrics
+from pg2kinesis.compress import decompress, get_compressor
+from pg2kinesis.formatter import Change, FullChange, Message
+from pg2kinesis.slot import PrimaryKeyMapItem
+from pg2kinesis.stream import StreamWriter, ShardMap, get_partitioner, hash_key_of
 
 @pytest.fixture()
 def writer():
@@ -34,6 +39,15 @@ def test__init__():
             assert call.get_waiter('stream_exists') not in mock_client.method_calls, "never reached"
 
 
+def test__init__shared_client():
+    shared_client = Mock()
+    with patch.object(boto3, 'client') as mock_boto3_client:
+        writer = StreamWriter('blah', kinesis=shared_client)
+    assert not mock_boto3_client.called, 'Writers sharing a client do not make their own'
+    assert writer._kinesis is shared_client
+    assert shared_client.create_stream.called
+
+
 def test_put_message(writer):
 
     writer._send_agg_record = Mock()
@@ -41,6 +55,7 @@ def test_put_message(writer):
     msg = Mock()
     msg.change.xid = 10
     msg.fmt_msg = object()
+    msg.schema = None
 
     writer.last_send = 1445444940.0 - 10      # "2015-10-21 16:28:50"
     with freeze_time('2015-10-21 16:29:00'):  # -> 1445444940.0
@@ -75,15 +90,20 @@ def test__send_agg_record(writer):
 
     agg_rec = Mock()
     agg_rec.get_contents = Mock(return_value=(1, 2, 'datablob'))
+    agg_rec.get_num_user_records = Mock(return_value=3)
+    agg_rec.get_size_bytes = Mock(return_value=8)
 
     err = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'put_record')
 
     writer._kinesis.put_record = Mock(side_effect=[err, err, err, {'SequenceNumber': 12345}])
 
+    throttles, records_sent = metrics.THROTTLES.get(), metrics.RECORDS_SENT.get()
     with patch.object(time, 'sleep') as mock_sleep:
         writer._send_agg_record(agg_rec)
         assert mock_sleep.call_count == 3, "We had to back off 3 times so we slept"
         assert mock_sleep.call_args_list == [call(.1), call(.2), call(.4)], 'Geometric back off!'
+    assert metrics.THROTTLES.get() - throttles == 3
+    assert metrics.RECORDS_SENT.get() - records_sent == 3
 
     with pytest.raises(ClientError):
         writer._kinesis.put_record = Mock(side_effect=ClientError({'Error': {'Code': 'Something else'}},
@@ -96,3 +116,422 @@ def test__send_agg_record(writer):
         writer._send_agg_record(agg_rec)
         assert e_info.value.message == 'ProvisionedThroughputExceededException caused a backed off too many times!', \
             'We raise on too many throughput errors'
+
+
+def test_put_message_batched(writer):
+    writer._batch_size = 2
+    writer._send_agg_records = Mock()
+
+    agg_rec = Mock()
+    agg_rec.get_size_bytes = Mock(return_value=100)
+    agg_rec.get_partition_key = Mock(return_value='10')
+
+    msg = Mock()
+    msg.change.xid = 10
+    msg.fmt_msg = object()
+    msg.schema = None
+
+    writer.last_send = 1445444940.0
+    with freeze_time('2015-10-21 16:29:00'):  # -> 1445444940.0
+        writer._record_agg.add_user_record = Mock(return_value=agg_rec)
+        assert writer.put_message(msg) is None, 'First full aggregate is held for the batch'
+        assert not writer._send_agg_records.called
+        assert writer._batch == [agg_rec]
+
+        result = writer.put_message(msg)
+        assert result == [agg_rec, agg_rec], 'Second full aggregate fills the batch'
+        writer._send_agg_records.assert_called_with([agg_rec, agg_rec])
+        assert writer._batch == []
+        assert writer._batch_bytes == 0
+
+        writer._send_agg_records.reset_mock()
+        writer._record_agg.add_user_record = Mock(return_value=agg_rec)
+        writer.put_message(msg)
+
+    with freeze_time('2015-10-21 16:29:20'):  # -> 1445444960.0
+        writer._record_agg.clear_and_get = Mock(return_value=None)
+        result = writer.put_message(None)
+        assert result == [agg_rec], 'Timeout flushed the partial batch'
+        writer._send_agg_records.assert_called_with([agg_rec])
+        assert writer.last_send == 1445444960.0, 'updated window'
+
+
+def test_flush(writer):
+    writer._send_agg_record = Mock()
+    writer._record_agg.clear_and_get = Mock(return_value='agg')
+    writer.ledger = Mock()
+    writer._agg_tokens[None] = [1, 2]
+
+    with freeze_time('2015-10-21 16:29:00'):  # -> 1445444940.0
+        writer.flush()
+    writer._send_agg_record.assert_called_once_with('agg')
+    writer.ledger.delivered.assert_called_once_with([1, 2])
+    assert writer.last_send == 1445444940.0
+
+    writer._batch_size = 2
+    writer._send_agg_records = Mock()
+    agg_rec = Mock()
+    agg_rec.get_size_bytes = Mock(return_value=100)
+    agg_rec.get_partition_key = Mock(return_value='10')
+    writer._record_agg.clear_and_get = Mock(return_value=agg_rec)
+    writer.flush()
+    writer._send_agg_records.assert_called_once_with([agg_rec])
+    assert writer._batch == [], 'The partial batch went too'
+
+
+def test_put_message_batched_byte_limit(writer):
+    writer._batch_size = 500
+
+    big_rec = Mock()
+    big_rec.get_size_bytes = Mock(return_value=1024 * 1024 - 1)
+    big_rec.get_partition_key = Mock(return_value='1')
+
+    writer.last_send = time.time()
+    for _ in range(5):
+        assert writer._add_to_batch(big_rec) == [], '5 MB fits'
+
+    assert writer._add_to_batch(big_rec) == [([big_rec] * 5, [])], 'Going past 5 MB takes the batch first'
+    assert writer._batch == [big_rec]
+
+
+def test__send_agg_records(writer):
+    assert writer._send_agg_records([]) is None, 'Do not do anything with an empty batch'
+
+    agg_recs = []
+    for i in range(3):
+        agg_rec = Mock()
+        agg_rec.get_contents = Mock(return_value=(str(i), None, 'datablob%s' % i))
+        agg_rec.get_num_user_records = Mock(return_value=1)
+        agg_rec.get_size_bytes = Mock(return_value=9)
+        agg_recs.append(agg_rec)
+
+    ok = {}
+    throttled = {'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'slow down'}
+    writer._kinesis.put_records = Mock(side_effect=[
+        {'FailedRecordCount': 2, 'Records': [throttled, ok, throttled]},
+        {'FailedRecordCount': 1, 'Records': [ok, throttled]},
+        {'FailedRecordCount': 0, 'Records': [ok]},
+    ])
+
+    with patch.object(time, 'sleep') as mock_sleep:
+        writer._send_agg_records(agg_recs)
+        assert mock_sleep.call_args_list == [call(.1), call(.2)], 'Geometric back off!'
+
+    sent = [[r['PartitionKey'] for r in kall[1]['Records']] for kall in writer._kinesis.put_records.call_args_list]
+    assert sent == [['0', '1', '2'], ['0', '2'], ['2']], 'Only failed entries are retried'
+
+    writer._kinesis.put_records = Mock(return_value={
+        'FailedRecordCount': 1, 'Records': [ok, {'ErrorCode': 'AccessDenied', 'ErrorMessage': 'no'}, ok]})
+    with pytest.raises(Exception):
+        writer._send_agg_records(agg_recs)
+
+    with pytest.raises(ClientError):
+        writer._kinesis.put_records = Mock(side_effect=ClientError({'Error': {'Code': 'Something else'}},
+                                                                   'put_records'))
+        writer._send_agg_records(agg_recs)
+
+    writer.back_off_limit = .3
+    err = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'put_records')
+    writer._kinesis.put_records = Mock(side_effect=err)
+    with pytest.raises(Exception), patch.object(time, 'sleep'):
+        writer._send_agg_records(agg_recs)
+
+
+def test_put_message_ledger(writer):
+    writer.ledger = Mock()
+    writer._send_agg_record = Mock()
+
+    msg = Mock()
+    msg.change.xid = 10
+    msg.fmt_msg = object()
+    msg.schema = None
+
+    writer.last_send = time.time()
+    writer._record_agg.add_user_record = Mock(return_value=None)
+    writer.put_message(msg, 1)
+    writer.put_message(msg, 2)
+    assert not writer.ledger.delivered.called
+
+    writer._record_agg.add_user_record = Mock(return_value='full')
+    writer.put_message(msg, 3)
+    writer.ledger.delivered.assert_called_once_with([1, 2]), 'The new message starts the next aggregate'
+    assert writer._agg_tokens == {None: [3]}
+
+    writer.ledger.delivered.reset_mock()
+    writer.last_send = 0
+    writer._record_agg.clear_and_get = Mock(return_value='partial')
+    writer.put_message(None)
+    writer.ledger.delivered.assert_called_once_with([3])
+    assert writer._agg_tokens == {None: []}
+
+
+def test_put_message_batched_ledger(writer):
+    writer.ledger = Mock()
+    writer._batch_size = 2
+    writer._send_agg_records = Mock()
+
+    agg_rec = Mock()
+    agg_rec.get_size_bytes = Mock(return_value=100)
+    agg_rec.get_partition_key = Mock(return_value='10')
+
+    msg = Mock()
+    msg.change.xid = 10
+    msg.fmt_msg = object()
+    msg.schema = None
+
+    writer.last_send = time.time()
+    writer._record_agg.add_user_record = Mock(return_value=agg_rec)
+    writer.put_message(msg, 1)
+    assert not writer.ledger.delivered.called, 'First aggregate waits for the batch to fill'
+
+    writer.put_message(msg, 2)
+    writer.ledger.delivered.assert_called_once_with([1]), 'Batch of two aggregates, only one held a message'
+
+    writer.put_message(msg, 3)
+    writer.put_message(msg, 4)
+    writer.ledger.delivered.assert_called_with([2, 3])
+
+
+def _shard(shard_id, start, end, closed=False):
+    shard = {'ShardId': shard_id,
+             'HashKeyRange': {'StartingHashKey': str(start), 'EndingHashKey': str(end)},
+             'SequenceNumberRange': {'StartingSequenceNumber': '1'}}
+    if closed:
+        shard['SequenceNumberRange']['EndingSequenceNumber'] = '2'
+    return shard
+
+
+TOP = 2 ** 128 - 1
+HALF = 2 ** 127
+
+
+def test_shard_map():
+    shard_map = ShardMap([_shard('b', HALF, TOP), _shard('old', 0, TOP, closed=True), _shard('a', 0, HALF - 1)])
+
+    assert len(shard_map) == 2, 'Closed shards are ignored'
+    assert shard_map.shard_ids == ['a', 'b']
+    assert shard_map.lookup(0) == 'a'
+    assert shard_map.lookup(HALF - 1) == 'a'
+    assert shard_map.lookup(HALF) == 'b'
+    assert shard_map.lookup(TOP) == 'b'
+
+    kinesis = Mock()
+    kinesis.list_shards = Mock(side_effect=[{'Shards': [_shard('a', 0, HALF - 1)], 'NextToken': 'more'},
+                                            {'Shards': [_shard('b', HALF, TOP)]}])
+    shard_map = ShardMap.from_stream(kinesis, 'blah')
+    assert shard_map.shard_ids == ['a', 'b']
+    assert kinesis.list_shards.call_args_list == [call(StreamName='blah'), call(NextToken='more')]
+
+
+def test_get_partitioner():
+    change = Change(xid=1, table='public.blue', operation='UPDATE', pkey='123')
+    full_change = FullChange(xid=1, change={'kind': 'insert', 'schema': 'public', 'table': 'blue',
+                                            'columnnames': ['name', 'id'], 'columnvalues': ['x', 123]})
+    pk_map = {'public.blue': PrimaryKeyMapItem('public.blue', 'id', 'integer', 0)}
+
+    assert get_partitioner('xid')(change) == '1'
+    assert get_partitioner('table')(change) == 'public.blue'
+    assert get_partitioner('pkey')(change) == '123'
+    assert get_partitioner('table_pkey')(change) == 'public.blue:123'
+
+    assert get_partitioner('table')(full_change) == 'public.blue'
+    assert get_partitioner('pkey', pk_map)(full_change) == '123'
+    assert get_partitioner('pkey')(full_change) == 'public.blue', 'Unknown key falls back to the table'
+
+    delete = FullChange(xid=1, change={'kind': 'delete', 'schema': 'public', 'table': 'blue',
+                                       'oldkeys': {'keynames': ['id'], 'keytypes': ['integer'], 'keyvalues': [7]}})
+    assert get_partitioner('table_pkey')(delete) == 'public.blue:7'
+
+    long_change = Change(xid=1, table='public.blue', operation='UPDATE', pkey='x' * 300)
+    assert len(get_partitioner('pkey')(long_change)) == 32, 'Over long keys are hashed'
+
+    with pytest.raises(ValueError):
+        get_partitioner('nope')
+
+
+def test_sharded_put_message():
+    mock_client = Mock()
+    mock_client.list_shards = Mock(return_value={'Shards': [_shard('a', 0, HALF - 1), _shard('b', HALF, TOP)]})
+
+    with patch.object(boto3, 'client', return_value=mock_client):
+        writer = StreamWriter('blah', partition_by='pkey', shard_count=2)
+    mock_client.create_stream.assert_called_with(StreamName='blah', ShardCount=2)
+    assert writer._shards.shard_ids == ['a', 'b']
+
+    writer._send_agg_record = Mock()
+    writer.ledger = Mock()
+    writer.last_send = time.time()
+
+    keys = {}
+    for i in range(20):
+        keys.setdefault(writer._shards.lookup(hash_key_of(str(i))), []).append(i)
+    assert set(keys) == {'a', 'b'}, 'Sanity: keys spread over both shards'
+
+    for i in range(20):
+        writer.put_message(Message(change=Change(xid=1, table='t', operation='INSERT', pkey=str(i)),
+                                   fmt_msg='row %s' % i), i)
+    assert not writer._send_agg_record.called
+
+    writer.last_send = 0
+    writer.put_message(None)
+    assert writer._send_agg_record.call_count == 2, 'One partial aggregate per shard'
+    sent = [c[0][0] for c in writer._send_agg_record.call_args_list]
+    for agg_record in sent:
+        pk, ehk, _ = agg_record.get_contents()
+        shard_id = writer._shards.lookup(int(ehk))
+        assert agg_record.get_num_user_records() == len(keys[shard_id])
+        assert ehk == str(hash_key_of(pk)), 'Aggregate routed by the hash of its first record'
+
+    delivered = sorted(t for c in writer.ledger.delivered.call_args_list for t in c[0][0])
+    assert delivered == list(range(20))
+
+
+def test_refresh_shards(writer):
+    writer._kinesis.list_shards = Mock(return_value={'Shards': [_shard('a', 0, TOP)]})
+    writer._refresh_shards()
+    old_agg = Mock()
+    writer._aggs['a'] = old_agg
+    writer._agg_tokens['a'] = [1]
+
+    writer._kinesis.list_shards = Mock(return_value={'Shards': [_shard('b', 0, HALF - 1), _shard('c', HALF, TOP)]})
+    closed = writer._refresh_shards()
+    assert closed == [(old_agg.clear_and_get.return_value, [1])]
+    assert 'a' not in writer._aggs, 'Aggregates of closed shards are flushed'
+    assert writer._shards.shard_ids == ['b', 'c']
+
+
+def test_send_with_rate_limiter(writer):
+    writer.rate_limiter = Mock()
+    writer._shards = ShardMap([_shard('a', 0, HALF - 1), _shard('b', HALF, TOP)])
+
+    agg_rec = Mock()
+    agg_rec.get_contents = Mock(return_value=('pk', str(HALF), b'12345'))
+    agg_rec.get_num_user_records = Mock(return_value=1)
+    agg_rec.get_size_bytes = Mock(return_value=5)
+
+    err = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'put_record')
+    writer._kinesis.put_record = Mock(side_effect=[err, {'SequenceNumber': 12345}])
+    with patch.object(time, 'sleep') as mock_sleep:
+        writer._send_agg_record(agg_rec)
+        assert not mock_sleep.called, 'The limiter paces retries'
+
+    assert writer.rate_limiter.acquire.call_args_list == [call('b', 7), call('b', 7)]
+    writer.rate_limiter.throttled.assert_called_once_with('b')
+    writer.rate_limiter.succeeded.assert_called_once_with('b')
+    assert writer._kinesis.put_record.call_args[1]['ExplicitHashKey'] == str(HALF)
+
+    writer.rate_limiter.reset_mock()
+    agg_a = Mock()
+    agg_a.get_contents = Mock(return_value=('pk', '0', b'1'))
+    agg_a.get_num_user_records = Mock(return_value=1)
+    agg_a.get_size_bytes = Mock(return_value=1)
+    throttled = {'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'slow down'}
+    writer._kinesis.put_records = Mock(side_effect=[
+        {'FailedRecordCount': 1, 'Records': [throttled, {}]},
+        {'FailedRecordCount': 0, 'Records': [{}]},
+    ])
+    with patch.object(time, 'sleep') as mock_sleep:
+        writer._send_agg_records([agg_a, agg_rec])
+        assert not mock_sleep.called
+
+    assert writer.rate_limiter.acquire.call_args_list == [call('a', 3), call('b', 7), call('a', 3)]
+    writer.rate_limiter.throttled.assert_called_once_with('a')
+    assert writer.rate_limiter.succeeded.call_args_list == [call('b'), call('a')]
+
+    writer.back_off_limit = 5
+    writer._kinesis.put_record = Mock(side_effect=err)
+    with patch.object(time, 'time', side_effect=itertools.count(0, 2)), pytest.raises(Exception):
+        writer._send_agg_record(agg_rec)
+    assert 1 < writer._kinesis.put_record.call_count < 5, 'Gave up once throttled for longer than the limit'
+
+
+def test_put_message_compressed(writer):
+    writer.compressor = get_compressor('gzip')
+    writer._record_agg.add_user_record = Mock(return_value=None)
+    writer.last_send = time.time()
+
+    msg = Message(change=Change(xid=10, table='public.blue', operation='UPDATE', pkey='1'),
+                  fmt_msg='0,CDC,' + 'x' * 1000)
+    writer.put_message(msg)
+    partition_key, data, _ = writer._record_agg.add_user_record.call_args[0]
+    assert partition_key == '10'
+    assert len(data) < 100, 'The aggregator gets, and counts the size of, the compressed record'
+    assert decompress(data) == msg.fmt_msg.encode('utf-8')
+
+
+def test_tune():
+    controller = Mock()
+    with patch.object(boto3, 'client'):
+        writer = StreamWriter('blah', controller=controller)
+    controller.attach.assert_called_once_with(writer)
+
+    writer.tune(2, 1024)
+    assert writer._send_window == 2
+    assert writer._record_agg.max_size == 1024
+    # The aggregate under way keeps its size, the next one is smaller.
+    writer._record_agg.add_user_record('1', b'x' * 600)
+    assert writer._record_agg.add_user_record('1', b'x' * 600) is None
+    writer._record_agg.clear_and_get()
+    assert writer._record_agg.add_user_record('1', b'x' * 600) is None
+    assert writer._record_agg.add_user_record('1', b'x' * 600) is not None
+
+
+def test_send_reports_to_controller(writer):
+    writer.controller = Mock()
+    writer._kinesis.put_record.side_effect = [
+        ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'put_record'),
+        {'SequenceNumber': '1'}]
+
+    agg_record = Mock()
+    agg_record.get_contents.return_value = ('pk', None, b'data')
+    agg_record.get_num_user_records.return_value = 1
+    agg_record.get_size_bytes.return_value = 4
+    with patch('time.sleep'):
+        writer._send_agg_record(agg_record)
+
+    assert writer.controller.throttled.call_count == 1
+    assert writer.controller.sent.call_count == 1
+
+
+def test_shards_of(writer):
+    assert writer.shards_of(Mock()) == frozenset([None]), 'Every shard while they are unknown'
+
+    writer._shards = ShardMap([
+        {'ShardId': 'a', 'HashKeyRange': {'StartingHashKey': '0'}, 'SequenceNumberRange': {}},
+        {'ShardId': 'b', 'HashKeyRange': {'StartingHashKey': str(2 ** 127)}, 'SequenceNumberRange': {}}])
+    low = Mock(get_explicit_hash_key=Mock(return_value='1'))
+    high = Mock(get_explicit_hash_key=Mock(return_value=str(2 ** 127 + 1)))
+    assert writer.shards_of(low) == frozenset(['a'])
+
+    writer._batch_size = 2
+    assert writer.shards_of([low, high]) == frozenset(['a', 'b'])
+
+
+def _user_records(agg_record):
+    from aws_kinesis_agg import messages_pb2
+    data = agg_record.get_contents()[2]
+    return [r.data for r in messages_pb2.AggregatedRecord.FromString(data[4:-16]).records]
+
+
+def test_put_message_schemas():
+    mock_client = Mock()
+    mock_client.list_shards = Mock(return_value={'Shards': [_shard('a', 0, HALF - 1), _shard('b', HALF, TOP)]})
+    with patch.object(boto3, 'client', return_value=mock_client):
+        writer = StreamWriter('blah', partition_by='pkey', shard_count=2)
+    writer._send_window = 0
+    writer._send_agg_record = Mock()
+
+    schema = b'S' * 1000
+    for i in range(20):
+        writer.put_message(Message(change=Change(xid=1, table='t', operation='INSERT', pkey=str(i)),
+                                   fmt_msg=b'r' * 300000, schema=schema))
+    writer.flush()
+
+    agg_records = [c[0][0] for c in writer._send_agg_record.call_args_list]
+    assert len(agg_records) > 2, 'Aggregates filled up'
+    assert set(writer._shards.lookup(int(a.get_explicit_hash_key())) for a in agg_records) == {'a', 'b'}
+    sent = [_user_records(agg_record) for agg_record in agg_records]
+    assert sum(records.count(b'r' * 300000) for records in sent) == 20
+    for records in sent:
+        assert records[0] == schema, 'Every aggregate, on every shard, starts with the schema'
+        assert records.count(schema) == 1
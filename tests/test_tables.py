@@ -0,0 +1,25 @@
+from __future__ import unicode_literals
+
+from pg2kinesis.tables import parse_tables, tables_re, wal2json_tables
+
+
+def test_parse_tables():
+    assert parse_tables('public.a, *.b ,x.*,c,') == [('public', 'a'), ('*', 'b'), ('x', '*'), ('*', 'c')]
+    assert parse_tables(None) == []
+
+
+def test_tables_re():
+    assert tables_re([]) is None
+
+    regex = tables_re([('public', 'a.b'), ('*', 'c'), ('x', '*')])
+    assert regex.match('public.a.b')
+    assert not regex.match('public.aXb'), 'Names are not patterns'
+    assert not regex.match('public.a.bc')
+    assert regex.match('other.c')
+    assert regex.match('x.anything')
+    assert not regex.match('y.anything')
+
+
+def test_wal2json_tables():
+    assert wal2json_tables([('public', 'a'), ('*', 'b c'), ('x', '*'), ('o\'d', 'a,b.c*')]) == \
+        "public.a,*.b\\ c,x.*,o\\'d.a\\,b\\.c\\*"